@@ -0,0 +1,166 @@
+'''Round-trip benchmarks for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+Runs `add`, `unite` and `find_connected_component` against a
+:class:`~memex_dossier.akagraph.fake_es.FakeElasticsearch` on a
+synthetic graph and reports how many elasticsearch requests each one
+costs, which is what dominates their time against a real cluster.
+Selector values are drawn from a Zipf distribution, so `--skew 0`
+gives a sparse graph of small components and larger values give a few
+popular values that tie much of the graph together::
+
+    python -m memex_dossier.akagraph.benchmark --size 10000 --skew 1.2
+
+'''
+from __future__ import absolute_import, division, print_function
+import argparse
+import bisect
+from collections import Counter
+import json
+import logging
+import random
+import time
+
+from .core import AKAGraph, AKANode
+from .fake_es import FakeElasticsearch, fixed_latency
+
+logger = logging.getLogger(__name__)
+
+#: selector types given to each synthetic record, hard then soft
+BENCHMARK_SELECTORS = ['email', 'phone', 'username']
+
+
+def make_records(size, skew=1.0, values_per_record=2, seed=0):
+    '''generate `size` records, each with `values_per_record` values of
+    each of :data:`BENCHMARK_SELECTORS`, drawn from `size` possible
+    values per type with probability proportional to ``1 / rank **
+    skew``
+    '''
+    rand = random.Random(seed)
+    cumulative = []
+    total = 0
+    for rank in range(1, size + 1):
+        total += 1 / rank ** skew
+        cumulative.append(total)
+
+    def draw():
+        return bisect.bisect(cumulative, rand.random() * total)
+
+    for i in range(size):
+        rec = {'url': u'http://example.com/%d' % i}
+        for selector_type in BENCHMARK_SELECTORS:
+            rec[selector_type] = sorted({
+                u'%s-%d' % (selector_type, draw())
+                for _ in range(values_per_record)})
+        yield rec
+
+
+def run_benchmark(size=1000, skew=1.0, replicas=5, lookups=100,
+                  unites=100, latency=0, buffer_size=20, seed=0):
+    '''ingest a synthetic graph of `size` records into a fresh fake
+    elasticsearch and time `lookups` calls to `find_connected_component`
+    and `unites` calls to `unite` on random nodes
+
+    :returns: dict mapping each of ``add``, ``unite`` and
+      ``find_connected_component`` to a dict of `calls`, the number of
+      elasticsearch requests per operation, `by_request`, those calls
+      broken down by kind of request, `docs_written` per operation,
+      and `seconds` per operation
+
+    '''
+    rand = random.Random(seed)
+    es = FakeElasticsearch(latency=fixed_latency(latency))
+    aka = AKAGraph(
+        index_name='benchmark', conn=es, replicas=replicas,
+        soft_selectors=['username'], hard_selectors=['email', 'phone'],
+        hyper_edge_scorer=lambda s: .5, buffer_size=buffer_size,
+    )
+    aka.create_index()
+    records = list(make_records(size, skew=skew, seed=seed))
+    report = {}
+
+    def measure(name, count, run):
+        es.reset_counts()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        count = max(count, 1)
+        report[name] = {
+            'calls': es.round_trips / count,
+            'by_request': {key: value / count
+                           for key, value in es.calls.items()},
+            'docs_written': es.docs_written / count,
+            'seconds': elapsed / count,
+        }
+        logger.info('%s: %.2f requests and %.4f sec each', name,
+                    report[name]['calls'], report[name]['seconds'])
+
+    def add():
+        with aka:
+            for rec in records:
+                aka.add(rec)
+    measure('add', len(records), add)
+
+    urls = [rec['url'] for rec in records]
+
+    def unite():
+        for _ in range(unites):
+            replica = rand.choice(aka.replica_list)
+            aka.unite(AKANode(rand.choice(urls), replica),
+                      AKANode(rand.choice(urls), replica))
+    measure('unite', unites, unite)
+    aka.sync()
+
+    selectors = [rand.choice(rand.choice(records)[selector_type])
+                 for selector_type in BENCHMARK_SELECTORS
+                 for _ in range(lookups // len(BENCHMARK_SELECTORS))]
+
+    def find_connected_component():
+        for selector in selectors:
+            list(aka.find_connected_component(selector))
+    measure('find_connected_component', len(selectors),
+            find_connected_component)
+
+    report['graph'] = {
+        'size': size,
+        'skew': skew,
+        'replicas': replicas,
+        'largest_component': max(Counter(
+            aka.get_root(AKANode(url, 0)).name for url in urls).values()),
+    }
+    aka.delete_index()
+    return report
+
+
+def main():
+    p = argparse.ArgumentParser(
+        'Count the elasticsearch requests made by AKAGraph operations.')
+    p.add_argument('--size', default=1000, type=int,
+                   help='number of synthetic records')
+    p.add_argument('--skew', default=1.0, type=float,
+                   help='Zipf exponent of the selector value distribution')
+    p.add_argument('--k-replicas', default=5, type=int)
+    p.add_argument('--buffer-size', default=20, type=int)
+    p.add_argument('--lookups', default=100, type=int,
+                   help='number of find_connected_component calls')
+    p.add_argument('--unites', default=100, type=int,
+                   help='number of unite calls')
+    p.add_argument('--latency', default=0, type=float,
+                   help='seconds that each elasticsearch request takes')
+    p.add_argument('--seed', default=0, type=int)
+    p.add_argument('--verbose', action='store_true', default=False)
+    args = p.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO)
+    report = run_benchmark(
+        size=args.size, skew=args.skew, replicas=args.k_replicas,
+        lookups=args.lookups, unites=args.unites, latency=args.latency,
+        buffer_size=args.buffer_size, seed=args.seed)
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
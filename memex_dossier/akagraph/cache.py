@@ -0,0 +1,231 @@
+'''Caches for :class:`~memex_dossier.akagraph.core.AKAGraph` lookups
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+:class:`ComponentCache` holds the results of
+`AKAGraph.find_connected_component`, which otherwise repeats the root
+walk, the member scan and the record fetches on every request.  Each
+entry remembers the generation and cardinality of every root that the
+result was built from.  Uniting anything into a root bumps its
+generation, so an entry can be checked with a single `mget` of those
+roots and is never served stale.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict, defaultdict
+import json
+import logging
+import threading
+import time
+
+import cbor
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    '''thread-safe mapping that holds at most `size` entries, evicting
+    the least recently used; `on_evict(key, value)` is called for each
+    evicted entry.  If `ttl` is given, an entry is also dropped once it
+    is `ttl` seconds old, for values that another process can change.
+    '''
+    def __init__(self, size, on_evict=None, ttl=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.deadlines = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and \
+                    self.deadlines[key] <= time.time():
+                del self.deadlines[key]
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if self.ttl is not None:
+                self.deadlines[key] = time.time() + self.ttl
+            while len(self.data) > self.size:
+                evicted.append(self.data.popitem(last=False))
+                self.deadlines.pop(evicted[-1][0], None)
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            self.deadlines.pop(key, None)
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.deadlines.clear()
+
+
+class ComponentCache(object):
+    '''results of `find_connected_component` keyed by its arguments
+
+    An entry is a dict with `roots`, a list of `[root_id, generation,
+    cardinality]` for the roots the result was built from, and
+    `results`, the list of `[record, confidence]`.  Validating the
+    roots is up to the caller.
+
+    :param size: number of entries to hold in memory
+
+    :param kvl: optional kvlayer client that entries evicted from
+    memory are spilled to, and looked up in on a miss
+
+    '''
+    TABLE = 'akagraph_components'
+
+    _kvlayer_namespace = {
+        # json of the key -> cbor of the entry
+        TABLE: (str,),
+    }
+
+    def __init__(self, size=1000, kvl=None):
+        self.kvl = kvl
+        if kvl is not None:
+            kvl.setup_namespace(self._kvlayer_namespace)
+        self.memory = LRUCache(size, on_evict=self.spill)
+        self.lock = threading.Lock()
+        # selector -> keys of the entries spilled to kvlayer
+        self.spilled = defaultdict(set)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def kvl_key(self, key):
+        return (json.dumps(key),)
+
+    def spill(self, key, entry):
+        if self.kvl is None:
+            return
+        self.kvl.put(self.TABLE, (self.kvl_key(key), cbor.dumps(entry)))
+        with self.lock:
+            self.spilled[key[0]].add(key)
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None or self.kvl is None:
+            return entry
+        for _, value in self.kvl.get(self.TABLE, self.kvl_key(key)):
+            if value is not None:
+                entry = cbor.loads(value)
+                self.memory.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self.memory.put(key, entry)
+
+    def discard(self, key):
+        self.memory.pop(key)
+        if self.kvl is not None:
+            self.kvl.delete(self.TABLE, self.kvl_key(key))
+
+    def discard_selectors(self, selectors):
+        '''drop every entry for any of `selectors`, e.g. because a record
+        having one of them was just added
+        '''
+        selectors = set(selectors)
+        keys = [key for key in self.memory.keys() if key[0] in selectors]
+        with self.lock:
+            for selector in selectors & set(self.spilled):
+                keys.extend(self.spilled.pop(selector))
+        for key in keys:
+            self.discard(key)
+
+
+class ScoreCache(object):
+    '''scores of soft selector values keyed by `(version, value)`, held
+    in memory and optionally in kvlayer, so that they can be shared
+    by every `AKAGraph` and every run that uses the same scorer
+
+    :param version: identifies the scorer; change it whenever the
+    scorer or its models change, so that old scores are not reused
+
+    :param size: number of scores to hold in memory
+
+    :param kvl: optional kvlayer client to keep all scores in
+
+    '''
+    TABLE = 'akagraph_scores'
+
+    _kvlayer_namespace = {
+        # (version, value) -> repr of the score
+        TABLE: (str, str),
+    }
+
+    def __init__(self, version='prob_username/1', size=100000, kvl=None):
+        self.version = version
+        self.kvl = kvl
+        if kvl is not None:
+            kvl.setup_namespace(self._kvlayer_namespace)
+        self.memory = LRUCache(size)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def kvl_key(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return (self.version, value)
+
+    def score_all(self, values, scorer):
+        '''get a dict mapping each of `values` to its score, computing
+        with `scorer` only the ones that are not in memory or kvlayer,
+        which are then looked up and saved in one batch each
+        '''
+        scores = {}
+        missing = set()
+        for value in values:
+            score = self.memory.get(value)
+            if score is None:
+                missing.add(value)
+            else:
+                scores[value] = score
+        if missing and self.kvl is not None:
+            keys = {self.kvl_key(value): value for value in missing}
+            for key, raw in self.kvl.get(self.TABLE, *keys):
+                if raw is not None:
+                    value = keys[key]
+                    scores[value] = float(raw)
+                    self.memory.put(value, scores[value])
+                    missing.discard(value)
+        puts = []
+        for value in missing:
+            scores[value] = scorer(value)
+            self.memory.put(value, scores[value])
+            puts.append((self.kvl_key(value), repr(scores[value])))
+        if puts and self.kvl is not None:
+            self.kvl.put(self.TABLE, *puts)
+        return scores
@@ -8,15 +8,19 @@ import string
 import argparse
 from collections import Counter, defaultdict
 import gzip
+import heapq
 import mmh3
 from itertools import islice
 import json
 import logging
 from operator import itemgetter
 import sys
+import threading
 import time
 import math
 import csv
+from multiprocessing.dummy import Pool as ThreadPool
+import os
 import random
 
 import kvlayer
@@ -25,43 +29,35 @@ import dblogger
 
 import cbor
 
-from elasticsearch import Elasticsearch, RequestError, NotFoundError
-from elasticsearch.helpers import bulk, scan, ScanError
-from collections import OrderedDict
+from elasticsearch import Elasticsearch, RequestError, NotFoundError, \
+    TransportError
+from elasticsearch.helpers import bulk, parallel_bulk, scan, ScanError
 
 from memex_dossier.handles.soft_selector_score import \
     prob_username, load_ngrams
 from .etl import get_etl_transforms
+from .cache import LRUCache
+from .overlay import WriteOverlay
+from .sketch import CountMinSketch
+from .stats import InstrumentedElasticsearch, Metrics, timed
+from .union_find import ArrayUnionFind
 
 logger = logging.getLogger(__name__)
 
 RECORD_TYPE = 'record'
 UNION_FIND_TYPE = 'union_find'
 ROOT_SIZE_TYPE = 'root_size'
+SKETCH_TYPE = 'sketch'
 
-default_soft_selectors = ['name', 'username', 'postal_address']
-default_hard_selectors = ['email', 'phone', 'skype', 'hostname']
-
+#: `_id` of the one popularity sketch of an index
+POPULARITY_ID = 'popularity'
 
-def lru_cache(cache_size):
-    def lru_decorator(f):
-        od = OrderedDict()
-        size = cache_size
-
-        def newfun(*args):
-            key = (tuple(args))
-            print(key)
-            if key in od:
-                val = od.pop(key)
-            else:
-                val = f(*args)
-            od[key] = val
-            if len(od) > size:
-                od.popitem(last=False)
-            return val
+#: hits returned by each of the searches of `find_equivs`, which is
+#: elasticsearch's default size
+SEARCH_HITS = 10
 
-        return newfun
-    return lru_decorator
+default_soft_selectors = ['name', 'username', 'postal_address']
+default_hard_selectors = ['email', 'phone', 'skype', 'hostname']
 
 
 def pseudorandom(*args):
@@ -82,15 +78,19 @@ class AKANode(object):
         # these are set whenever a node is looked up.
         self.rank = None
         self.cardinality = None
+        # number of unions into this root, None if it is a singleton
+        self.generation = None
 
     def set_rank_from_record(self, record=None):
         if record:
             assert('rank' in record and 'cardinality' in record)
             self.rank = record['rank']
             self.cardinality = record['cardinality']
+            self.generation = record.get('generation', 0)
         else:
             self.rank = 1
             self.cardinality = 1
+            self.generation = None
 
     def __hash__(self):
         return hash((self.name, self.replica))
@@ -154,6 +154,21 @@ class AKAGraph(object):
                  shards=None, buffer_size=20, conn=None,
                  num_identifier_downweight=0,
                  popular_identifier_downweight=0,
+                 union_find=None,
+                 path_compression=True,
+                 refresh_interval=30,
+                 selector_index=None,
+                 msearch_chunk_size=100,
+                 msearch_concurrency=4,
+                 msearch_retries=5,
+                 component_cache=None,
+                 mget_chunk_size=100,
+                 record_cache_size=1000,
+                 parent_cache_size=10000,
+                 score_cache=None,
+                 popular_threshold=None,
+                 username_lsh=None,
+                 cache_ttl=60,
                  ):
         '''AKAGraph provides the interface to an elastic-search backed
         probabilistic graph proximity engine
@@ -187,13 +202,83 @@ class AKAGraph(object):
         :param popular_identifier_downweight: identifiers in many
         records should bind loosely
 
+        :param union_find: an in-process union-find, such as
+        :class:`~memex_dossier.akagraph.union_find.ArrayUnionFind`,
+        to hold the forest instead of the `union_find` doc type; see
+        :meth:`push_union_find`
+
+        :param path_compression: whether root lookups made while
+        writing should point the nodes they pass through directly at
+        their roots; read-only queries never write
+
+        :param refresh_interval: minimum number of seconds between
+        elasticsearch refreshes while writing; reads of this graph's
+        own writes since the last refresh are served from
+        `self.overlay`.  None means refresh only on leaving the
+        `with` statement.
+
+        :param selector_index: a
+        :class:`~memex_dossier.akagraph.selector_index.SelectorIndex`
+        that `find_equivs` looks selector values up in instead of
+        searching elasticsearch; it is kept up to date by `add`
+
+        :param msearch_chunk_size: number of searches to send in each
+        msearch request
+
+        :param msearch_concurrency: maximum number of msearch requests
+        in flight at once; the `mget` chunks of record and root
+        lookups and the per-replica member scans share the same pool
+        of this many threads, so it bounds those too
+
+        :param msearch_retries: number of times to resend searches that
+        elasticsearch rejected because its search queue was full
+
+        :param component_cache: a
+        :class:`~memex_dossier.akagraph.cache.ComponentCache` for the
+        results of `find_connected_component`
+
+        :param mget_chunk_size: number of records to get in each
+        `mget` request
+
+        :param record_cache_size: number of whole records to keep in
+        memory, or 0 for none
+
+        :param parent_cache_size: number of `union_find` docs of
+        non-root nodes to keep in memory for root lookups, or 0 for
+        none.  Roots are always read from elasticsearch, but a
+        non-root node's ancestors stay its ancestors whatever is
+        united later, so a cached parent is only wrong if another
+        process `retract`s its component, and for no longer than
+        `cache_ttl`.
+
+        :param score_cache: a
+        :class:`~memex_dossier.akagraph.cache.ScoreCache` for the
+        scores that `hyper_edge_scorer` gives soft selector values
+
+        :param popular_threshold: if given, a count-min sketch of how
+        many records have each selector value is kept up to date by
+        `add` and persisted in the index, and values estimated to be
+        in more records than this are not queried for at all
+
+        :param username_lsh: a
+        :class:`~memex_dossier.akagraph.lsh.UsernameLSH` that `add`
+        files usernames in, and that `find_equivs` asks for similar
+        but unequal usernames to make soft edges to
+
+        :param cache_ttl: seconds that entries in the record and parent
+        caches are used for before they are read again, since other
+        processes can change or retract them; None to keep them until
+        they are evicted, which is only safe when nothing else writes
+        the index, e.g. for an offline ingest
+
         '''
 
+        # counters, timers and histograms behind `stats`
+        self.metrics = Metrics()
         if conn is None:
-            self.conn = Elasticsearch(hosts=hosts, retry_on_timeout=True,
-                                      max_retries=5)
-        else:
-            self.conn = conn
+            conn = Elasticsearch(hosts=hosts, retry_on_timeout=True,
+                                 max_retries=5)
+        self.conn = InstrumentedElasticsearch(conn, self.metrics)
         self.index = index_name
         self.shards = shards
         self.buffer_size = buffer_size
@@ -216,6 +301,70 @@ class AKAGraph(object):
         self.score_cutoff = .001
         self.num_identifier_downweight = num_identifier_downweight
         self.popular_identifier_downweight = popular_identifier_downweight
+        self.union_find = union_find
+        self.path_compression = path_compression
+        self.compression_buffer = {}
+        # request threads of the web app may share this graph
+        self.compression_lock = threading.Lock()
+        # the bulk write of compressions in flight, if any
+        self._compression_pool = None
+        self._compression_result = None
+        self.compressions_written = 0
+        self.union_buffer = []
+        self.refresh_interval = refresh_interval
+        self.overlay = WriteOverlay()
+        self.last_sync = time.time()
+        self.selector_index = selector_index
+        self.msearch_chunk_size = msearch_chunk_size
+        self.msearch_concurrency = msearch_concurrency
+        self.msearch_retries = msearch_retries
+        self.msearch_backoff = 0.1
+        self.search_stats = Counter()
+        self._search_pool = None
+        self.component_cache = component_cache
+        self.mget_chunk_size = mget_chunk_size
+        self.cache_ttl = cache_ttl
+        self.record_cache = None
+        if record_cache_size:
+            self.record_cache = LRUCache(record_cache_size, ttl=cache_ttl)
+        self.parent_cache = None
+        if parent_cache_size:
+            self.parent_cache = LRUCache(parent_cache_size, ttl=cache_ttl)
+        self.score_cache = score_cache
+        self.popular_threshold = popular_threshold
+        # the sketch of all writers' counts, loaded lazily
+        self.popularity = None
+        # the count of each key added by this graph since it last saved
+        self.unsaved_popularity = Counter()
+        self.username_lsh = username_lsh
+
+    def stats(self):
+        '''get a JSON-serializable dict of what this graph has done so
+        far: `counters` of records and edges added and documents
+        written; `timers` of calls and seconds for its main methods and
+        for each kind of elasticsearch request, under ``es.``; the
+        `histograms` of the number of hops to the root in each
+        `get_roots` lookup, under `tree_depth`; the `caches` and their
+        hit rates; and the `search` stats of `msearch`
+        '''
+        stats = self.metrics.to_dict()
+        stats['search'] = dict(self.search_stats)
+        stats['caches'] = {}
+        for name, cache in [
+                ('records', self.record_cache),
+                ('parents', self.parent_cache),
+                ('components', getattr(self.component_cache, 'memory', None)),
+                ('scores', getattr(self.score_cache, 'memory', None))]:
+            if cache is None:
+                continue
+            lookups = cache.hits + cache.misses
+            stats['caches'][name] = {
+                'size': len(cache),
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_rate': cache.hits / lookups if lookups else None,
+            }
+        return stats
 
     def __enter__(self):
         logger.debug('in context')
@@ -224,13 +373,30 @@ class AKAGraph(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.in_context = False
-        if exc_type is None and exc_value is None and traceback is None:
-            self.flush()
+        try:
+            if exc_type is None and exc_value is None and traceback is None:
+                self.flush()
+                if self.overlay:
+                    self.sync()
+        finally:
+            self.close()
+
+    def close(self):
+        '''wait for any background writes and stop the thread pools of
+        this graph; they are started again if it is used after this
+        '''
+        for name in ('_search_pool', '_compression_pool'):
+            pool = getattr(self, name)
+            if pool is not None:
+                setattr(self, name, None)
+                pool.close()
+                pool.join()
 
     def add(self, rec, analyze_and_union=True):
         '''add `rec` to ES;  must be used inside a `with` statement
         '''
         assert self.in_context, 'must use "with" statement to add docs'
+        self.metrics.count('records_added')
         self.record_buffer.append((rec, analyze_and_union))
         if len(self.record_buffer) >= self.buffer_size:
             self.flush_records()
@@ -258,6 +424,7 @@ class AKAGraph(object):
         '''
         
         assert self.in_context, 'must use "with" statement to add docs'
+        self.metrics.count('edges_added')
         self.edge_buffer.append((IDs, strength, evidence))
         if len(self.edge_buffer) >= self.buffer_size:
             self.flush_edges()
@@ -265,15 +432,102 @@ class AKAGraph(object):
     def flush(self):
         self.flush_records()
         self.flush_edges()
+        self.flush_compressions()
 
+    @timed('flush_edges')
     def flush_edges(self):
         local_union_find = MemoryUnionFind()  # this is purely an efficiency hack so we hit ES less redundantly
+        groups = []
         for equivs, score, score_reason in self.edge_buffer:
             logger.debug('given equivs %r with %s strength and evidence %s',
                          equivs, score, score_reason)
-            self.probabilistically_unite_edges(equivs, score, score_reason, local_union_find)
+            groups.extend(self.draw_edge(equivs, score, score_reason, local_union_find))
+        self.unite_groups(groups)
         self.edge_buffer = self.edge_buffer[:0]
+        self.flush_unions()
+        self.maybe_sync()
+
+    def add_edges(self, edges, batch_size=10000):
+        '''unite the identifiers of many edges at once, with the same
+        meaning as calling `add_edge([url_a, url_b], strength,
+        evidence)` for each, but far fewer requests: the edges are
+        deduplicated by :func:`merge_edges`, each replica's draws are
+        united into components in a local `MemoryUnionFind`, and then
+        only the roots of the nodes in those components are looked up
+        and written, `batch_size` nodes at a time.
+
+        :param edges: iterable of `(url_a, url_b, strength)` or `(url_a,
+          url_b, strength, evidence)`, e.g. from :func:`load_edges`
+
+        :returns: number of distinct edges
+
+        '''
+        if not self.conn.indices.exists(index=self.index):
+            self.create_index()
+        edges = merge_edges(edges)
+        for replica in self.replica_list:
+            local_union_find = MemoryUnionFind()
+            for (url_a, url_b, evidence), strength in edges:
+                if strength >= 1:
+                    draw = 0
+                elif evidence:
+                    draw = pseudorandom(evidence, replica)
+                else:
+                    draw = uniform_random()
+                if draw < strength:
+                    local_union_find.find_all_and_union(url_a, url_b)
+            components = defaultdict(lambda: set())
+            for name in list(local_union_find.parents):
+                root = local_union_find._find(name)
+                components[root].update([name, root])
+            batch = []
+            batch_nodes = 0
+            for members in components.itervalues():
+                batch.append([AKANode(name, replica) for name in members])
+                batch_nodes += len(members)
+                if batch_nodes >= batch_size:
+                    self.unite_components(batch)
+                    batch = []
+                    batch_nodes = 0
+            self.unite_components(batch)
+            logger.debug('united %d components in replica %d',
+                         len(components), replica)
+        self.sync()
+        return len(edges)
 
+    def unite_components(self, groups):
+        '''unite the nodes in each of `groups` as `unite_groups` does,
+        and send the writes in one bulk request
+        '''
+        self.unite_groups(groups)
+        self.flush_unions()
+
+    def unite_groups(self, groups):
+        '''queue the unions of the nodes in each of `groups`, which may be
+        in any replicas and may overlap, by looking up all of their
+        roots together in one `get_roots`; groups that turn out to
+        share a root are united as one
+        '''
+        if not groups:
+            return
+        nodes = [node for group in groups for node in group]
+        roots = iter(self.get_roots(nodes))
+        root_union_find = MemoryUnionFind()
+        root_nodes = {}
+        for group in groups:
+            ids = []
+            for _ in group:
+                root = next(roots)
+                root_nodes[root.get_id()] = root
+                ids.append(root.get_id())
+            root_union_find.find_all_and_union(*ids)
+        merged = defaultdict(list)
+        for root_id, root in root_nodes.iteritems():
+            merged[root_union_find._find(root_id)].append(root)
+        self.unite_roots([group for group in merged.itervalues()
+                          if len(group) > 1])
+
+    @timed('flush_records')
     def flush_records(self):
         '''Actually do the work to ingest records gathered by calls to `add`.
         All vertexes are their own roots on initial ingest; so this
@@ -303,28 +557,72 @@ class AKAGraph(object):
             #    'doc_as_upsert': True,
             #})
         bulk(self.conn, actions, timeout='60s')
-        # next find equivalent records via exact match, and union them
+        # next find equivalent records via exact match, and union them;
+        # the records just written are not searchable until the next
+        # refresh, so find_equivs also matches them in the overlay
+        selector_types = self.hard_selectors | self.soft_selectors
+        for rec, _ in self.record_buffer:
+            self.overlay.add_record(rec, selector_types)
+        if self.selector_index is not None:
+            self.selector_index.add_records(
+                [rec for rec, _ in self.record_buffer], selector_types)
+        if self.username_lsh is not None:
+            self.username_lsh.add_records(
+                [rec for rec, _ in self.record_buffer])
+        if self.component_cache is not None:
+            selectors = set()
+            for rec, _ in self.record_buffer:
+                selectors.add(rec['url'])
+                for key in selector_types:
+                    selectors.update(rec.get(key) or [])
+            self.component_cache.discard_selectors(selectors)
+        if self.popular_threshold is not None:
+            popularity = self.get_popularity()
+            for rec, _ in self.record_buffer:
+                for key in selector_types:
+                    for value in set(rec.get(key) or []):
+                        pop_key = popularity_key(key, value)
+                        popularity.add(pop_key)
+                        self.unsaved_popularity[pop_key] += 1
+        if self.record_cache is not None:
+            for rec, _ in self.record_buffer:
+                self.record_cache.pop(rec['url'])
 
-        # uh oh...
-        self.sync()
+        # record_buffer has tuples where the [0] element is the record 
+        # and the [1] element is whether or not to union from it.  Only process the records to union here
+        # this supports adding records and *explicit* edges separately
+        self.unite_equivs([buf[0] for buf in self.record_buffer if buf[1]])
+        self.record_buffer = self.record_buffer[:0]
+        self.flush_unions()
+        self.maybe_sync()
 
+    def unite_equivs(self, records):
+        '''find the records equivalent to each of `records` and queue
+        the unions with them, with the roots of all of them looked up
+        together
+        '''
         # as an efficiency hack we make a local, one-off union find so we hit ES less redundantly
         # batches are likely to have a lot of the same records to union, and we do not want
         # to tell ES about each of a set of redundant unions.  If we catch them locally, we only
         # hit ES with new stuff
         local_union_find = MemoryUnionFind()  
 
-        # record_buffer has tuples where the [0] element is the record 
-        # and the [1] element is whether or not to union from it.  Only process the records to union here
-        # this supports adding records and *explicit* edges separately
-        for rec, score, score_reason, equivs in self.find_equivs([buf[0] for buf in self.record_buffer if buf[1]]):
+        groups = []
+        for rec, score, score_reason, equivs in self.find_equivs(records):
             logger.debug('%s found %d (%f) equivs for %r --> %r',
                          score_reason, len(equivs), score, rec['url'], equivs)
             equivs.add(rec['url'])
-            self.probabilistically_unite_edges(equivs, score, score_reason, local_union_find)
-        self.record_buffer = self.record_buffer[:0]
+            groups.extend(self.draw_edge(equivs, score, score_reason, local_union_find))
+        self.unite_groups(groups)
 
     def probabilistically_unite_edges(self, equivs, score, score_reason, local_union_find=None):
+        self.unite_all(self.draw_edge(equivs, score, score_reason,
+                                      local_union_find))
+
+    def draw_edge(self, equivs, score, score_reason, local_union_find=None):
+        '''get the nodes of `equivs` in each replica that the edge is
+        drawn in, as a list of one group of nodes per replica
+        '''
         if score == 1:
             equivs_len = len(equivs)
             if local_union_find:
@@ -332,29 +630,198 @@ class AKAGraph(object):
                 logger.debug('had %s equivs, now have %s',
                              equivs_len, len(equivs))
             if len(equivs) < 1:
-                return
-        if score_reason:
-            def include_replica(replica):
-                return score == 1 or pseudorandom(score_reason, replica) < score
+                return []
+        # decide which replicas get this edge up front, so that the
+        # roots for all of them can be looked up and written together
+        if score == 1:
+            replicas = list(self.replica_list)
+        elif score_reason:
+            draws = [pseudorandom(score_reason, replica)
+                     for replica in self.replica_list]
+            replicas = [replica for replica, draw
+                        in zip(self.replica_list, draws) if draw < score]
         else:
             # if no reason is given, make it random
-            def include_replica(replica):
-                del replica
-                return score == 1 or uniform_random() < score
+            replicas = [replica for replica in self.replica_list
+                        if uniform_random() < score]
+        return [[AKANode(url, replica) for url in equivs]
+                for replica in replicas]
 
-        for replica in self.replica_list:
-            if include_replica(replica):
-                self.unite(*[AKANode(url, replica) for url in equivs])
+    def remove(self, *urls):
+        '''retract the records of `urls` and rebuild the components that
+        they were in without them; see `retract`
+
+        :returns: number of records whose unions were rebuilt
+
+        '''
+        return self.retract(urls, [])
+
+    def remove_selector(self, value):
+        '''retract `value`, e.g. a spammy phone number, from every record
+        that has it as a hard or soft selector, and rebuild the
+        components of those records without it; see `retract`
+
+        :returns: number of records whose unions were rebuilt
+
+        '''
+        selector_types = sorted(self.hard_selectors | self.soft_selectors)
+        res = scan(
+            self.conn, index=self.index, doc_type=RECORD_TYPE,
+            query={'query': {'constant_score': {'filter': {'bool': {
+                'should': [{'term': {key: value}}
+                           for key in selector_types]}}}}})
+        updated = []
+        for item in res:
+            rec = item['_source']
+            for key in selector_types:
+                if value in (rec.get(key) or []):
+                    rec[key] = [v for v in rec[key] if v != value]
+            updated.append(rec)
+        logger.info('retracting %r from %d records', value, len(updated))
+        return self.retract([], updated)
+
+    @timed('retract')
+    def retract(self, removed, updated):
+        '''delete the records of the urls in `removed` and overwrite the
+        records in `updated`, and then rebuild the unions of just the
+        components that any of them is in, in any replica, by
+        resetting every surviving member to its own root and finding
+        its equivalents again, so that a correction costs time in
+        proportion to the size of those components rather than of the
+        index.
+
+        The same draws are made for each edge as on ingest, except for
+        those with no score reason, so unaffected components keep
+        their shape.  Unions of the affected nodes made by `add_edge`
+        are not recorded anywhere and are lost, and popularity counts
+        are not decremented.
+
+        :returns: number of records whose unions were rebuilt
+
+        '''
+        assert self.union_find is None, \
+            'cannot retract records from an in-process union_find'
+        self.flush()
         self.sync()
+        removed = set(removed)
+        urls = removed | {rec['url'] for rec in updated}
+        if not urls:
+            return 0
+        resp = self.conn.mget(index=self.index, doc_type=RECORD_TYPE,
+                              body={'ids': sorted(urls)})
+        old_recs = [doc['_source'] for doc in resp['docs'] if doc['found']]
+        roots = set(self.get_roots([AKANode(url, replica)
+                                    for url in urls
+                                    for replica in self.replica_list]))
+        members = list(self.iter_members(roots))
+        docs = self.get_union_find_docs([node.get_id() for node in members])
+        # the root walks above may have queued path compressions of the
+        # members, which must land before the resets rather than after
+        self.flush_compressions()
 
+        actions = []
+        for node in members:
+            doc = docs.get(node.get_id())
+            if doc is None:
+                continue
+            if node.name in removed:
+                actions.append({
+                    '_index': self.index,
+                    '_type': UNION_FIND_TYPE,
+                    '_id': node.get_id(),
+                    '_op_type': 'delete',
+                })
+                continue
+            # a new generation tells any cached result that it is stale
+            actions.append({
+                '_index': self.index,
+                '_type': UNION_FIND_TYPE,
+                '_id': node.get_id(),
+                '_op_type': 'index',
+                '_source': {
+                    'child': node.to_record(),
+                    'replica': node.replica,
+                    'rank': 1,
+                    'cardinality': 1,
+                    'generation': doc.get('generation', 0) + 1,
+                    'root': node.to_record(),
+                },
+            })
+        for rec in old_recs:
+            if rec['url'] in removed:
+                actions.append({
+                    '_index': self.index,
+                    '_type': RECORD_TYPE,
+                    '_id': rec['url'],
+                    '_op_type': 'delete',
+                })
+        for rec in updated:
+            actions.append({
+                '_index': self.index,
+                '_type': RECORD_TYPE,
+                '_id': rec['url'],
+                '_source': rec,
+            })
+        bulk(self.conn, actions, timeout='60s')
+        if self.parent_cache is not None:
+            for node in members:
+                self.parent_cache.pop(node.get_id())
+
+        selector_types = self.hard_selectors | self.soft_selectors
+        if self.selector_index is not None:
+            self.selector_index.remove_records(old_recs, selector_types)
+            self.selector_index.add_records(updated, selector_types)
+        if self.username_lsh is not None:
+            self.username_lsh.remove_records(old_recs)
+            self.username_lsh.add_records(updated)
+        if self.component_cache is not None:
+            selectors = set(urls)
+            for rec in old_recs:
+                for key in selector_types:
+                    selectors.update(rec.get(key) or [])
+            self.component_cache.discard_selectors(selectors)
+        if self.record_cache is not None:
+            for url in urls:
+                self.record_cache.pop(url)
+        self.sync()
+
+        survivors = sorted({node.name for node in members} - removed)
+        recs = self.iter_recs(survivors)
+        while True:
+            batch = list(islice(recs, self.buffer_size))
+            if not batch:
+                break
+            self.unite_equivs(batch)
+            self.flush_unions()
+        self.flush_compressions()
+        self.sync()
+        self.metrics.count('records_retracted', len(removed))
+        logger.info('retracted %d records and rebuilt %d in %d trees',
+                    len(removed), len(survivors), len(roots))
+        return len(survivors)
 
+    @timed('sync')
     def sync(self):
         '''Forces data to disk, so that data from all calls to `put` will be
         available for getting and querying.  Generally, this should
         only be used in tests.
 
         '''
+        self.flush_compressions()
+        if self.popular_threshold is not None:
+            self.save_popularity()
         self.conn.indices.refresh(index=self.index)
+        self.overlay.clear()
+        self.last_sync = time.time()
+
+    def maybe_sync(self):
+        '''`sync` if `refresh_interval` seconds have passed since the last
+        refresh
+        '''
+        if self.refresh_interval is None:
+            return
+        if time.time() - self.last_sync >= self.refresh_interval:
+            self.sync()
 
     def analyze_clusters(self, limit=None):
         '''hunt for clusters and return a list of clusters sored by size and
@@ -400,6 +867,82 @@ class AKAGraph(object):
         }
         return data
 
+    def write_clusters(self, fh, replica=0, min_size=2, limit=None,
+                       batch_size=1000):
+        '''write one JSON line per cluster of at least `min_size` records
+        to `fh`, and return aggregate statistics like those of
+        `analyze_clusters`
+
+        Unlike `analyze_clusters`, this scans the `union_find` docs of
+        `replica` once and resolves the forest in memory, then fetches
+        the records of about `batch_size` clusters' worth of urls at a
+        time to find their overlaps, so it makes O(N / batch_size)
+        requests and holds only the forest and the histogram in
+        memory.  The clusters are written in no particular order, and
+        if `limit` is given, no more are written once they hold at
+        least `limit` records between them.
+
+        '''
+        forest = ArrayUnionFind([replica])
+        forest.load_unions(self.get_all_unions(replicas=[replica]))
+        logger.info('loaded %d nodes of replica %d', len(forest), replica)
+
+        histogram = Counter()
+        total = 0
+
+        def write_batch(batch):
+            urls = [url for cluster in batch for url in cluster]
+            recs = {}
+            for rec in self.get_recs(*urls):
+                recs[rec['url']] = rec
+            for cluster in batch:
+                fh.write(json.dumps({
+                    'count': len(cluster),
+                    'urls': cluster,
+                    'overlaps': find_overlaps(
+                        [recs[url] for url in cluster]),
+                }))
+                fh.write('\n')
+
+        batch = []
+        batch_urls = 0
+        for root, _ in forest.iter_roots(replica):
+            cluster = list(forest.members(replica, root))
+            if len(cluster) < min_size:
+                continue
+            histogram[len(cluster)] += 1
+            total += len(cluster)
+            batch.append(cluster)
+            batch_urls += len(cluster)
+            if batch_urls >= batch_size:
+                write_batch(batch)
+                batch = []
+                batch_urls = 0
+            if limit is not None and total >= limit:
+                break
+        if batch:
+            write_batch(batch)
+
+        clusters = sum(histogram.values())
+        if not clusters:
+            return {'clusters': 0, 'histogram': {}}
+        # walk the histogram down from the largest size to the median
+        median = None
+        seen = 0
+        for size in sorted(histogram, reverse=True):
+            seen += histogram[size]
+            if seen > clusters // 2:
+                median = size
+                break
+        return {
+            'clusters': clusters,
+            'largest': max(histogram),
+            'median': median,
+            'mean': total / clusters,
+            'smallest': min(histogram),
+            'histogram': dict(histogram),
+        }
+
     def find_equivs(self, records):
         '''For an iterable of `records`, yield tuples of `(record, score,
         equivs)`, where a `record` from `records` might appear in
@@ -409,6 +952,19 @@ class AKAGraph(object):
         queries = []
         scores = []
         rec_pointers = [] # carries a pointer to a record for each query
+        local_hits = [] # urls matched in the overlay for each query
+        query_pairs = [] # (selector_type, value) pairs for each query
+        fuzzy_records = [] # (record, weight) to find similar usernames for
+        records = list(records)
+        soft_scores = {}
+        if self.score_cache is not None and self.hyper_edge_scorer \
+                and len(self.replica_list) > 1:
+            soft_scores = self.score_cache.score_all(
+                {v for rec in records
+                 for key, values in rec.iteritems()
+                 if key in self.soft_selectors
+                 for v in values if v},
+                self.hyper_edge_scorer)
         for rec in records:
             # compute score multiplies for this record
             weight = 1.0
@@ -419,10 +975,14 @@ class AKAGraph(object):
 
             # first we gather one query for all hard selectors
             hard_or_query = []
+            hard_pairs = []
             for key, values in rec.iteritems():
                 if key in self.hard_selectors:
                     for v in values:
+                        if self.is_popular(key, v):
+                            continue
                         hard_or_query.append({'term': {key: v}})
+                        hard_pairs.append((key, v))
             if hard_or_query:
                 query = {
                     "query": {
@@ -436,19 +996,23 @@ class AKAGraph(object):
                         }
                     }
                 }
-                queries.append({'index': self.index, 'type': RECORD_TYPE, '_source_include': []})
-                queries.append(query)
+                queries.append(({'index': self.index, 'type': RECORD_TYPE, '_source_include': []},
+                                query))
                 scores.append((weight, json.dumps(hard_or_query)))
                 rec_pointers.append(rec)
+                local_hits.append(self.overlay.match_records(hard_pairs))
+                query_pairs.append(hard_pairs)
             else:
                 logger.debug('skipping because no hard identifiers')
             # next, we make separate queries for each soft selector
             if not self.hyper_edge_scorer or len(self.replica_list) == 1:
                 continue
+            if self.username_lsh is not None:
+                fuzzy_records.append((rec, weight))
             for key, values in rec.iteritems():
                 if key not in self.soft_selectors: continue
                 for v in values:
-                    if not v:
+                    if not v or self.is_popular(key, v):
                         continue
                     query = {
                         "query": {
@@ -462,59 +1026,386 @@ class AKAGraph(object):
                             }
                         }
                     }
-                    score = self.hyper_edge_scorer(v)
+                    score = soft_scores.get(v)
+                    if score is None:
+                        score = self.hyper_edge_scorer(v)
                     if score > self.score_cutoff:
                         logger.debug('soft selector score %.3f for %r', score, v)
-                        queries.append({'index': self.index, 'type': RECORD_TYPE, '_source_include': []})
-                        queries.append(query)
+                        queries.append(({'index': self.index, 'type': RECORD_TYPE, '_source_include': []},
+                                        query))
                         scores.append((score * weight, v))
                         rec_pointers.append(rec)
+                        local_hits.append(
+                            self.overlay.match_records([(key, v)]))
+                        query_pairs.append([(key, v)])
+
+        if fuzzy_records:
+            for equivs in self.find_fuzzy_equivs(fuzzy_records, soft_scores):
+                yield equivs
+
+        if self.selector_index is not None:
+            # every selector value is in the index, including those
+            # of the records in this batch, so elasticsearch is not
+            # needed at all; no more urls are used than the searches
+            # would have found, so that the scores come out the same
+            postings = self.selector_index.lookup(
+                (pair for pairs in query_pairs for pair in pairs),
+                limit=SEARCH_HITS + 1)
+            for cursor, record in enumerate(rec_pointers):
+                hits_set = set()
+                for pair in query_pairs[cursor]:
+                    hits_set.update(postings[pair])
+                hits_set.discard(record['url'])
+                hits_set = set(sorted(hits_set)[:SEARCH_HITS])
+                score, score_reason = scores[cursor]
+                equivs = self.make_equivs(record, score, score_reason,
+                                          hits_set)
+                if equivs is not None:
+                    yield equivs
+            return
 
         # helper function for stripping down to just the URL
         def hits_generator(hits):
             for hit in hits['hits']['hits']:
                 yield hit['_id']
-        # now loop until we get answers for all the queries
-        cursor = 0
-        while queries:
-            res = self.conn.msearch(body=queries)
-            for hits in res['responses']:
-                # remove the corresponding two rows of queries and corresponding record
-                queries.pop(0); queries.pop(0)
-                record = rec_pointers[cursor]
-                score, score_reason = scores[cursor]
+        for cursor, hits in enumerate(self.msearch(queries)):
+            if hits is None:
+                # msearch has already logged the failure
+                continue
+            record = rec_pointers[cursor]
+            score, score_reason = scores[cursor]
+            hits_set = set(hits_generator(hits))
+            hits_set.update(local_hits[cursor])
+            equivs = self.make_equivs(record, score, score_reason,
+                                      hits_set)
+            if equivs is not None:
+                yield equivs
+
+    def find_fuzzy_equivs(self, fuzzy_records, soft_scores):
+        '''yield `find_equivs` tuples linking each record in
+        `fuzzy_records`, a list of `(record, weight)`, to the records
+        with usernames that `username_lsh` finds similar to, but not
+        the same as, one of its own.  The score is the similarity times
+        the lower of the two usernames' soft selector scores, and the
+        score reason is the same whichever of the two records it is
+        found from.
+        '''
+        lsh = self.username_lsh
+        key = lsh.selector_type
+        values = {v for rec, _ in fuzzy_records for v in rec.get(key) or []
+                  if v and not self.is_popular(key, v)}
+        similar = lsh.find_similar(values)
+
+        def soft_score(v):
+            if v not in soft_scores:
+                soft_scores[v] = self.hyper_edge_scorer(v)
+            return soft_scores[v]
+
+        for rec, weight in fuzzy_records:
+            for v in rec.get(key) or []:
+                for other, similarity, urls in similar.get(v, []):
+                    score = similarity * min(soft_score(v),
+                                             soft_score(other))
+                    if score <= self.score_cutoff:
+                        continue
+                    score_reason = u'~'.join(sorted([v, other]))
+                    equivs = self.make_equivs(rec, score * weight,
+                                              score_reason, set(urls))
+                    if equivs is not None:
+                        yield equivs
+
+    @timed('msearch')
+    def msearch(self, searches):
+        '''run `searches`, a list of `(header, body)` pairs for the
+        msearch API, and return a list of their responses in the same
+        order
+
+        The searches are sent in chunks of `msearch_chunk_size` with up
+        to `msearch_concurrency` chunks in flight.  Sub-requests that
+        elasticsearch rejects because its search queue is full are
+        resent on their own, after an exponentially growing delay, up
+        to `msearch_retries` times.  The response for a search that
+        fails for good is None.
 
-                # revise_score
-                cursor += 1
-                if 'error' in hits:
-                    # need to run msearch again, starting with the query after the failed one
-                    if 'queue capacity' not in hits['error']:
-                        logger.warn("Error getting equivs for %s: %s", record, hits['error'])
-                    break
+        '''
+        responses = [None] * len(searches)
+        pending = range(len(searches))
+        delay = self.msearch_backoff
+        for attempt in range(self.msearch_retries + 1):
+            if attempt:
+                logger.debug('retrying %d rejected searches in %.2f sec',
+                             len(pending), delay)
+                time.sleep(delay)
+                delay *= 2
+                self.search_stats['retried'] += len(pending)
+            size = self.msearch_chunk_size
+            chunks = [pending[i:i + size]
+                      for i in range(0, len(pending), size)]
+            results = self.map_searches(
+                self.msearch_chunk,
+                [[searches[i] for i in chunk] for chunk in chunks])
+            pending = []
+            for chunk, (elapsed, result) in zip(chunks, results):
+                logger.debug('msearch of %d searches took %.3f sec',
+                             len(chunk), elapsed)
+                self.search_stats['chunks'] += 1
+                self.search_stats['searches'] += len(chunk)
+                self.search_stats['seconds'] += elapsed
+                self.search_stats['max_seconds'] = max(
+                    self.search_stats['max_seconds'], elapsed)
+                for i, hits in zip(chunk, result):
+                    if 'error' not in hits:
+                        responses[i] = hits
+                    elif is_rejection(hits['error']):
+                        pending.append(i)
+                    else:
+                        logger.warn('search %r failed: %s',
+                                    searches[i][1], hits['error'])
+                        self.search_stats['failed'] += 1
+            if not pending:
+                break
+        if pending:
+            logger.warn('giving up on %d searches rejected %d times',
+                        len(pending), self.msearch_retries + 1)
+            self.search_stats['failed'] += len(pending)
+        return responses
+
+    def msearch_chunk(self, searches):
+        '''send one msearch request for `searches` and return the time it
+        took and its list of responses; if the whole request is
+        rejected, every response is a rejection
+        '''
+        body = []
+        for header, query in searches:
+            body.append(header)
+            body.append(query)
+        start = time.time()
+        try:
+            res = self.conn.msearch(body=body)
+        except TransportError, exc:
+            if exc.status_code != 429:
+                raise
+            return (time.time() - start,
+                    [{'error': str(exc)}] * len(searches))
+        return time.time() - start, res['responses']
+
+    def map_searches(self, func, chunks):
+        '''`map(func, chunks)` using up to `msearch_concurrency` threads
+        '''
+        if self.msearch_concurrency <= 1 or len(chunks) <= 1:
+            return map(func, chunks)
+        if self._search_pool is None:
+            self._search_pool = ThreadPool(self.msearch_concurrency)
+        return self._search_pool.map(func, chunks)
+
+    def is_popular(self, selector_type, value):
+        '''whether more than `popular_threshold` records are estimated to
+        have `value`, so that it is not worth querying for
+        '''
+        if self.popular_threshold is None:
+            return False
+        count = self.get_popularity().estimate(
+            popularity_key(selector_type, value))
+        if count > self.popular_threshold:
+            logger.debug('skipping %s %r in about %d records',
+                         selector_type, value, count)
+            return True
+        return False
+
+    def get_popularity(self):
+        '''get the count-min sketch of selector values, loading the counts
+        persisted by other writers the first time
+        '''
+        if self.popularity is None:
+            self.load_popularity()
+        return self.popularity
+
+    def load_popularity(self):
+        '''(re)load `popularity` from the sketch persisted in the index,
+        plus the counts this graph has not saved yet.  Sketches left
+        by writers that each saved their own are folded into it and
+        deleted.
+        '''
+        popularity = CountMinSketch()
+        legacy = {}
+        if self.conn.indices.exists(index=self.index):
+            for item in scan(self.conn, index=self.index,
+                             doc_type=SKETCH_TYPE):
+                sketch = CountMinSketch.from_source(item['_source'])
+                if item['_id'] == POPULARITY_ID:
+                    popularity = sketch
                 else:
-                    hits_set = set(hits_generator(hits))
-                    if hits_set:
-                        if self.score_cutoff < score < 1:
-                            logger.debug("SOFT: %d, %s", score, score_reason)
-                        if self.popular_identifier_downweight:
-                            score = score * math.exp(- self.popular_identifier_downweight * (len(hits_set)-1)) 
-
-                        yield (record, score, score_reason, hits_set)
+                    legacy[item['_id']] = sketch
+        for key, count in self.unsaved_popularity.iteritems():
+            popularity.add(key, count)
+        self.popularity = popularity
+        if legacy:
+            self.save_popularity(legacy.values())
+            bulk(self.conn, [{
+                '_index': self.index,
+                '_type': SKETCH_TYPE,
+                '_id': sketch_id,
+                '_op_type': 'delete',
+            } for sketch_id in legacy], timeout='60s', raise_on_error=False)
+            logger.info('folded %d sketches into %r', len(legacy),
+                        POPULARITY_ID)
+
+    def save_popularity(self, sketches=()):
+        '''add the counts this graph has not saved yet, and those of
+        `sketches`, to the one sketch persisted in the index, and
+        reload `popularity` from it.  The sketch is only replaced if
+        its version is still the one that was read, and is otherwise
+        read again, so that concurrent writers never lose each other's
+        counts.  Only the cells of the keys added since the last save
+        are touched.
+        '''
+        if not self.unsaved_popularity and not sketches:
+            return
+        while True:
+            action = {
+                '_index': self.index,
+                '_type': SKETCH_TYPE,
+                '_id': POPULARITY_ID,
+            }
+            try:
+                doc = self.conn.get(index=self.index, doc_type=SKETCH_TYPE,
+                                    id=POPULARITY_ID)
+            except NotFoundError:
+                merged = CountMinSketch()
+                action['_op_type'] = 'create'
+            else:
+                merged = CountMinSketch.from_source(doc['_source'])
+                action['_op_type'] = 'index'
+                action['_version'] = doc['_version']
+            for key, count in self.unsaved_popularity.iteritems():
+                merged.add(key, count)
+            for sketch in sketches:
+                merged.update(sketch)
+            action['_source'] = merged.to_source()
+            _, errors = bulk(self.conn, [action], timeout='60s',
+                             raise_on_error=False)
+            if not errors:
+                break
+            status = errors[0].values()[0].get('status')
+            if status != 409:
+                raise TransportError(status, 'could not save the sketch',
+                                     errors)
+            logger.debug('sketch saved by another writer; retrying')
+        self.unsaved_popularity = Counter()
+        self.popularity = merged
+
+    def make_equivs(self, record, score, score_reason, hits_set):
+        '''get the `(record, score, score_reason, equivs)` tuple for
+        `find_equivs` from the urls that matched one of its queries, or
+        None if only `record` itself matched
+        '''
+        hits_set.discard(record['url'])
+        if not hits_set:
+            return None
+        if self.score_cutoff < score < 1:
+            logger.debug("SOFT: %d, %s", score, score_reason)
+        if self.popular_identifier_downweight:
+            score = score * math.exp(- self.popular_identifier_downweight * (len(hits_set)-1))
+        return (record, score, score_reason, hits_set)
 
     def get_recs(self, *urls):
         '''get records one or more for `urls`
         '''
         if not urls:
             raise Exception('called get_recs with empty list')
+        for rec in self.iter_recs(urls):
+            yield rec
+
+    def iter_recs(self, urls, fields=None):
+        '''yield the record for each of `urls` in the same order, or just
+        `{"url": url}` for those that are missing
+
+        The records are fetched in `mget` requests of at most
+        `mget_chunk_size` ids, up to `msearch_concurrency` of them at a
+        time, and a window of that many records is held in memory.
+        Whole records are also kept in `record_cache`, so records that
+        are in many components are fetched once every `cache_ttl`
+        seconds.
+
+        :param fields: if given, only these fields (and `url`) of each
+        record are fetched
+
+        '''
+        if fields is not None:
+            fields = sorted(set(fields) | {'url'})
+        urls = iter(urls)
+        window = self.mget_chunk_size * max(1, self.msearch_concurrency)
+        while True:
+            batch = list(islice(urls, window))
+            if not batch:
+                break
+            found = {}
+            missing = []
+            for url in batch:
+                rec = None
+                if self.record_cache is not None:
+                    rec = self.record_cache.get(url)
+                if rec is None:
+                    missing.append(url)
+                elif fields is None:
+                    # callers may modify the records they get
+                    found[url] = dict(rec)
+                else:
+                    found[url] = {key: rec[key] for key in fields
+                                  if key in rec}
+            missing = list(set(missing))
+            size = self.mget_chunk_size
+            chunks = [missing[i:i + size]
+                      for i in range(0, len(missing), size)]
+            for docs in self.map_searches(
+                    lambda chunk: self.mget_recs(chunk, fields), chunks):
+                found.update(docs)
+            for url in batch:
+                yield found[url]
+
+    @timed('mget_recs')
+    def mget_recs(self, urls, fields=None):
+        '''get a dict mapping each of `urls` to its record, with only
+        `fields` if given, in one `mget`
+        '''
+        kwargs = {}
+        if fields is not None:
+            kwargs['_source_include'] = fields
         resp = self.conn.mget(
             index=self.index, doc_type=RECORD_TYPE,
-            body = {'ids': urls})
+            body={'ids': urls}, **kwargs)
+        recs = {}
         for rec in resp['docs']:
             if not rec['found']:
-                yield {"url": rec['_id']}
+                recs[rec['_id']] = {"url": rec['_id']}
                 #raise KeyError('missing: %r' % rec['_id'])
-            else:
-                yield rec['_source']
+                continue
+            recs[rec['_id']] = rec['_source']
+            if fields is None and self.record_cache is not None:
+                self.record_cache.put(rec['_id'], dict(rec['_source']))
+        return recs
+
+    def index_selectors(self):
+        '''add every record in the index to `self.selector_index`, e.g.
+        after adding a selector index to an existing graph
+        '''
+        selector_types = self.hard_selectors | self.soft_selectors
+        res = scan(
+            self.conn, index=self.index, doc_type=RECORD_TYPE,
+            _source_include=list(selector_types | {'url'}),
+            query={'query': {'match_all': {}}})
+        count = 0
+        batch = []
+        for item in res:
+            batch.append(item['_source'])
+            if len(batch) >= self.buffer_size:
+                self.selector_index.add_records(batch, selector_types)
+                count += len(batch)
+                batch = []
+        self.selector_index.add_records(batch, selector_types)
+        count += len(batch)
+        logger.info('indexed selectors of %d records', count)
+        return count
 
     def get_all_urls(self, limit=None):
         '''get all urls in the index
@@ -571,27 +1462,113 @@ class AKAGraph(object):
             logger.warn('akagraph indexes do not exist yet: %s', exc)
             return
 
-    def find_connected_component(self, selector, use_soft=True):
+    def find_connected_component(self, selector, use_soft=True,
+                                 min_score=0, limit=None, fields=None,
+                                 budget=None, timeout=None):
+        '''yield `(record, confidence)` for the records in the connected
+        component of the records matching `selector`, most confident
+        first, skipping those with confidence below `min_score` and
+        stopping after `limit` of them.  If `fields` is given, the
+        records have only those fields and `url`.
+
+        With a `limit`, the traversal stops as soon as the most
+        confident records are known; see `rank_members`.  `budget`
+        and `timeout` bound the traversal of huge components, at the
+        cost of possibly missing some of their members.
+
+        If this graph has a `component_cache`, results are served from
+        it for as long as none of the roots they were built from has
+        changed.  Records added through this graph invalidate the
+        results for their selector values; a record added elsewhere
+        that matches `selector` without being united with anything is
+        not seen until one of the roots changes.  Selectors that match
+        no records at all are never cached.
+
+        '''
+        cache = self.component_cache
+        if self.union_find is not None:
+            cache = None
+        if fields is not None:
+            fields = tuple(sorted(fields))
+        key = (selector, use_soft, min_score, limit, fields, budget, timeout)
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None and self.roots_unchanged(entry['roots']):
+                for rec, confidence in entry['results']:
+                    yield dict(rec), confidence
+                return
         urls = set(self.find_urls_by_selector(selector, use_soft))
         # logger.debug('get %d equivs for %r', len(equivs), selector)
         if not urls:
+            # nothing would change the root of this pseudo-node when
+            # a record with `selector` is added elsewhere, so the
+            # answer cannot be validated later
+            cache = None
             urls.add(selector)
-        ccs = list(self.connected_component(*urls))
+        roots = set(self.get_roots([AKANode(url, replica)
+                                    for url in urls
+                                    for replica in self.replica_list],
+                                   compress=False))
+        snapshot = [[root.get_id(), root.generation, root.cardinality]
+                    for root in roots]
+        # one extra member tells a single-member component apart
+        ranked, truncated = self.rank_members(
+            roots, limit=None if limit is None else limit + 1,
+            budget=budget, timeout=timeout)
+        ccs = list(cutoff_members(ranked))
+        results = []
         if len(ccs) == 1:
             # degenerate case where only this record (potentially empty) was found
             # the only url found is the selector argument, see if it has a real record
-            rec = list(self.get_recs(selector))[0]
+            rec = list(self.iter_recs([selector], fields))[0]
             if len(rec) > 1:  # only yield this record if it is non-empty
-                yield rec, 1.0
+                results.append([rec, 1.0])
         else:
+            scored = []
             for url, count in ccs:
-                rec = list(self.get_recs(url))[0]
-                yield rec, count / len(self.replica_list)
+                confidence = count / len(self.replica_list)
+                if confidence < min_score:
+                    # ccs is sorted by count
+                    break
+                scored.append((url, confidence))
+            scored = scored[:limit]
+            recs = self.iter_recs([url for url, _ in scored], fields)
+            for rec, (_, confidence) in zip(recs, scored):
+                results.append([rec, confidence])
+        if limit is not None:
+            results = results[:limit]
+        if cache is not None and not truncated:
+            cache.put(key, {'roots': snapshot, 'results': results})
+        for rec, confidence in results:
+            yield dict(rec), confidence
+
+    def roots_unchanged(self, roots):
+        '''check, with one `mget`, that each of `[root_id, generation,
+        cardinality]` in `roots` is still a root with the same
+        generation and cardinality
+        '''
+        docs = self.get_union_find_docs([root_id for root_id, _, _ in roots])
+        for root_id, generation, cardinality in roots:
+            doc = docs.get(root_id)
+            if doc is None:
+                if generation is not None:
+                    return False
+            elif 'parent' in doc:
+                return False
+            elif (doc.get('generation', 0), doc['cardinality']) != \
+                    (generation, cardinality):
+                return False
+        return True
 
     def get_children(self, node):
         '''get child URLs of `url`
         '''
         assert node.replica is not None
+        if self.union_find is not None:
+            for name in self.union_find.get_children(int(node.replica),
+                                                     node.name):
+                yield AKANode(name, node.replica)
+            return
         res = scan(
             self.conn, index=self.index, doc_type=UNION_FIND_TYPE,
             _source_include=[],
@@ -607,6 +1584,18 @@ class AKAGraph(object):
         max_tries = 3
         tries = 0
         assert node.replica is not None
+        if self.union_find is not None:
+            replica = int(node.replica)
+            parent = self.union_find.get_parent(replica, node.name)
+            if parent is not None:
+                return AKANode(parent, node.replica)
+            node.rank, node.cardinality = \
+                self.union_find.get_rank(replica, node.name)
+            return None
+        if self.parent_cache is not None:
+            record = self.parent_cache.get(node.get_id())
+            if record is not None:
+                return AKANode.from_record(record['parent'])
         while tries < max_tries:
             tries += 1
             res = self.conn.search(
@@ -620,6 +1609,8 @@ class AKAGraph(object):
                 if hits:
                     record = hits[0]['_source']
                     if 'parent' in record:
+                        if self.parent_cache is not None:
+                            self.parent_cache.put(node.get_id(), record)
                         return AKANode.from_record(record['parent'])
                     else:
                         node.set_rank_from_record(record)
@@ -632,11 +1623,16 @@ class AKAGraph(object):
                 continue
         # if we got here, it means we got errors every time
 
-    def get_all_unions(self):
-        '''
+    def get_all_unions(self, replicas=None):
+        '''yield the source of every `union_find` doc, or only of those in
+        `replicas` if it is given
         '''
+        query = None
+        if replicas is not None:
+            query = {'query': {'terms': {'replica': list(replicas)}}}
         res = scan(
-            self.conn, index=self.index, doc_type=UNION_FIND_TYPE)
+            self.conn, index=self.index, doc_type=UNION_FIND_TYPE,
+            query=query)
         for item in res:
             yield item['_source']
 
@@ -661,34 +1657,136 @@ class AKAGraph(object):
         batch from `pairs`=[(`child`, `parent`), ...]
 
         '''
-        actions = [{
-            '_index': self.index,
-            '_type': UNION_FIND_TYPE,
-            '_id': new_root.get_id(),
-            '_op_type': 'index',
-            '_source': {
-                'child': new_root.to_record(),
-                'replica': new_root.replica,
-                'rank': new_root.rank,
-                'cardinality': new_root.cardinality,
-            },
-        }]
-        for child in others:
-            assert child.name != new_root.name
+        self.queue_parents([(new_root, others)])
+        self.flush_unions()
+
+    def queue_parents(self, unions):
+        '''for each `(new_root, others)` in `unions`, queue the writes that
+        make `new_root` the parent of all of the roots in `others`.
+        No root may appear in more than one of `unions`.  The writes
+        are visible to this graph's own reads right away, and are
+        sent to elasticsearch by `flush_unions`.
+
+        '''
+        if self.union_find is not None:
+            for new_root, others in unions:
+                self.union_find.set_parents(
+                    int(new_root.replica), new_root.name, new_root.rank,
+                    new_root.cardinality, [child.name for child in others])
+            return
+        actions = []
+        absorbed = {}
+        for new_root, others in unions:
+            # any cached result built from this root is now stale
+            new_root.generation = (new_root.generation or 0) + 1
             actions.append({
                 '_index': self.index,
                 '_type': UNION_FIND_TYPE,
-                '_id': child.get_id(),
+                '_id': new_root.get_id(),
                 '_op_type': 'index',
                 '_source': {
-                    'parent': new_root.to_record(),
-                    'child': child.to_record(),
-                    'replica': child.replica
+                    'child': new_root.to_record(),
+                    'replica': new_root.replica,
+                    'rank': new_root.rank,
+                    'cardinality': new_root.cardinality,
+                    'generation': new_root.generation,
+                    'root': new_root.to_record(),
                 },
             })
+            for child in others:
+                assert child.name != new_root.name
+                absorbed[child.get_id()] = (child, new_root)
+                actions.append({
+                    '_index': self.index,
+                    '_type': UNION_FIND_TYPE,
+                    '_id': child.get_id(),
+                    '_op_type': 'index',
+                    '_source': {
+                        'parent': new_root.to_record(),
+                        'child': child.to_record(),
+                        'replica': child.replica,
+                        'root': new_root.to_record(),
+                    },
+                })
+        # move the members of the absorbed trees over to their new roots
+        moved = defaultdict(list)
+        for child, new_root in absorbed.itervalues():
+            moved[new_root.get_id()].append(child)
+        for root_id, member in self.scan_members(
+                [child for child, _ in absorbed.itervalues()]):
+            new_root = absorbed[root_id][1]
+            moved[new_root.get_id()].append(member)
+            actions.append({
+                '_index': self.index,
+                '_type': UNION_FIND_TYPE,
+                '_id': member.get_id(),
+                '_op_type': 'update',
+                'doc': {'root': new_root.to_record()},
+            })
+        for action in actions:
+            if action['_op_type'] == 'index':
+                self.overlay.put_doc(action['_id'], dict(action['_source']))
+                if self.parent_cache is not None:
+                    self.parent_cache.pop(action['_id'])
+        for root_id, members in moved.iteritems():
+            self.overlay.add_members(root_id, members)
+        self.union_buffer.extend(actions)
+
+    @timed('flush_unions')
+    def flush_unions(self):
+        '''send all of the writes queued by `queue_parents` in one bulk
+        request
+        '''
+        if not self.union_buffer:
+            return
+        actions = self.union_buffer
+        self.union_buffer = []
         logger.debug('set_parent bulk actions: %r', actions)
-        bulk(self.conn, actions, timeout='60s')
-        #print(actions)
+        bulk(self.conn, actions, timeout='60s', chunk_size=len(actions))
+
+    def push_union_find(self, thread_count=1):
+        '''write the forest held in `self.union_find` to the `union_find`
+        doc type in one bulk load, with `thread_count` bulk requests in
+        flight at once
+        '''
+        if not self.conn.indices.exists(index=self.index):
+            self.create_index()
+
+        def actions():
+            for replica, name, parent, rank, cardinality \
+                    in self.union_find.iter_nodes():
+                child = AKANode(name, replica)
+                root, _, _ = self.union_find.get_root(replica, name)
+                source = {
+                    'child': child.to_record(),
+                    'replica': replica,
+                    'root': AKANode(root, replica).to_record(),
+                }
+                if parent is not None:
+                    source['parent'] = AKANode(parent, replica).to_record()
+                else:
+                    source['rank'] = rank
+                    source['cardinality'] = cardinality
+                    source['generation'] = \
+                        self.union_find.get_generation(replica, name)
+                yield {
+                    '_index': self.index,
+                    '_type': UNION_FIND_TYPE,
+                    '_id': child.get_id(),
+                    '_op_type': 'index',
+                    '_source': source,
+                }
+        if thread_count > 1:
+            count = 0
+            for ok, item in parallel_bulk(self.conn, actions(),
+                                          thread_count=thread_count,
+                                          timeout='60s', chunk_size=5000):
+                count += 1
+        else:
+            count, errors = bulk(self.conn, actions(), timeout='60s',
+                                 chunk_size=5000)
+        logger.info('pushed %d union_find docs to %s', count, self.index)
+        self.sync()
 
 
     def get_all_roots(self, size_limit=0, candidates_limit=None, replica=0):
@@ -697,9 +1795,14 @@ class AKAGraph(object):
 
         '''
         roots = Counter()
-        for url in self.get_all_urls(limit=candidates_limit):
-            root = self.get_root(AKANode(url, replica))
-            roots[root.name] += 1
+        urls = self.get_all_urls(limit=candidates_limit)
+        while True:
+            batch = [AKANode(url, replica)
+                     for url in islice(urls, self.buffer_size)]
+            if not batch:
+                break
+            for root in self.get_roots(batch, compress=False):
+                roots[root.name] += 1
         for root, count in roots.most_common():
             if count > size_limit:
                 yield root, count
@@ -710,57 +1813,448 @@ class AKAGraph(object):
         been united with anything.  A root `url` has itself as root.
 
         '''
-        seen = set()
+        if self.union_find is not None:
+            name, rank, cardinality = \
+                self.union_find.get_root(int(node.replica), node.name)
+            if name != node.name:
+                node = AKANode(name, node.replica)
+            node.rank, node.cardinality = rank, cardinality
+            return node
+        return self.get_roots([node])[0]
+
+    @timed('get_union_find_docs')
+    def get_union_find_docs(self, ids):
+        '''get the `union_find` docs for a list of node `ids`, in
+        concurrent `mget` requests of `mget_chunk_size` ids each, and
+        return a dict mapping each id to its `_source` or None if it has
+        never been united with anything.
+
+        '''
+        docs = {}
+        missing = []
+        for node_id in ids:
+            source = self.overlay.get_doc(node_id)
+            if source is None and self.parent_cache is not None:
+                source = self.parent_cache.get(node_id)
+            if source is not None:
+                docs[node_id] = source
+            else:
+                missing.append(node_id)
+        if not missing:
+            return docs
+        size = self.mget_chunk_size
+        chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+        for resp in self.map_searches(self.mget_union_find, chunks):
+            for rec in resp['docs']:
+                source = rec['_source'] if rec.get('found') else None
+                docs[rec['_id']] = source
+                if source and 'parent' in source and \
+                        self.parent_cache is not None:
+                    self.parent_cache.put(rec['_id'], source)
+        return docs
+
+    def mget_union_find(self, ids):
+        return self.conn.mget(
+            index=self.index, doc_type=UNION_FIND_TYPE,
+            _source_include=['parent', 'rank', 'cardinality', 'generation'],
+            body={'ids': ids})
+
+    @timed('get_roots')
+    def get_roots(self, nodes, compress=None):
+        '''Find the roots of all of `nodes` together, for any mix of URLs
+        and replicas, and return them as a list in the same order as
+        `nodes`.  The trees are climbed level by level, so this costs
+        one round of `mget` requests per level of the deepest tree,
+        whichever replicas the nodes are in, rather than one search per
+        hop per node.  Each round is split into chunks of
+        `mget_chunk_size` ids sent up to `msearch_concurrency` at a
+        time.
+
+        `compress` says whether to queue path compressions of the
+        nodes passed through, by default `path_compression`; queries
+        pass False so that they never write.
+
+        '''
+        if self.union_find is not None:
+            return [self.get_root(node) for node in nodes]
+        roots = [None] * len(nodes)
+        current = list(nodes)
+        seen = [set() for _ in nodes]
+        paths = [[] for _ in nodes]
+        resolved = {}
+        pending = range(len(nodes))
+        while pending:
+            ids = list({current[i].get_id() for i in pending
+                        if current[i].get_id() not in resolved})
+            docs = self.get_union_find_docs(ids) if ids else {}
+            next_pending = []
+            for i in pending:
+                node = current[i]
+                node_id = node.get_id()
+                if node_id in resolved:
+                    roots[i] = resolved[node_id]
+                    continue
+                record = docs[node_id]
+                if record and 'parent' in record:
+                    parent = AKANode.from_record(record['parent'])
+                    if parent.name in seen[i]:
+                        logger.critical('hit loop: %r', seen[i])
+                        sys.exit()
+                    seen[i].add(parent.name)
+                    paths[i].append((node, parent))
+                    current[i] = parent
+                    next_pending.append(i)
+                else:
+                    node.set_rank_from_record(record)
+                    resolved[node_id] = node
+                    roots[i] = node
+            pending = next_pending
+        for path in paths:
+            self.metrics.observe('tree_depth', len(path))
+        if compress is None:
+            compress = self.path_compression
+        if compress:
+            for path, root in zip(paths, roots):
+                for node, parent in path:
+                    if parent.name != root.name:
+                        self.compress_path(node, root)
+        return roots
+
+    def compress_path(self, node, root):
+        '''queue a write that points `node` directly at `root`, which must
+        be an ancestor of `node`.  When the buffer fills, the writes
+        are sent on a background thread while other work goes on; see
+        `flush_compressions`.
+
+        Only non-root nodes are rewritten, and a non-root node's
+        ancestors never stop being its ancestors, so a queued write
+        stays correct however many unions happen before it is sent.
+        It only touches `parent`; the `root` field is maintained by
+        `set_parents` alone.
+
+        '''
+        self.queue_union_find_update(node, {'parent': root.to_record()})
+
+    def queue_union_find_update(self, node, doc):
+        '''queue a partial update of the `union_find` doc of `node`
+        '''
+        with self.compression_lock:
+            action = self.compression_buffer.setdefault(node.get_id(), {
+                '_index': self.index,
+                '_type': UNION_FIND_TYPE,
+                '_id': node.get_id(),
+                '_op_type': 'update',
+                'doc': {},
+            })
+            action['doc'].update(doc)
+            self.overlay.update_doc(node.get_id(), doc)
+            full = len(self.compression_buffer) >= self.buffer_size
+        if self.parent_cache is not None and 'parent' in doc:
+            # the new parent is an ancestor too, so keep it cached
+            self.parent_cache.put(node.get_id(), {'parent': doc['parent']})
+        if full:
+            self.flush_compressions(wait=False)
+
+    @timed('flush_compressions')
+    def flush_compressions(self, wait=True):
+        '''send the parent pointer rewrites queued by `compress_path` in
+        one bulk request on a background thread, once the previous one
+        has finished.  Unless `wait` is False, this then waits for the
+        request to finish, and raises any error that it hit.  Until
+        then this graph reads the rewrites from `overlay`.
+        '''
+        # compressions may point at docs that are still queued
+        self.flush_unions()
+        with self.compression_lock:
+            actions = self.compression_buffer.values()
+            self.compression_buffer = {}
+            pending, self._compression_result = \
+                self._compression_result, None
+        if pending is not None:
+            pending.get()
+        if actions:
+            logger.debug('compressing %d paths', len(actions))
+            with self.compression_lock:
+                if self._compression_pool is None:
+                    self._compression_pool = ThreadPool(1)
+            pending = self._compression_pool.apply_async(
+                self._write_compressions, (actions,))
+            if not wait:
+                with self.compression_lock:
+                    pending, self._compression_result = \
+                        self._compression_result, pending
+                if pending is None:
+                    return
+            pending.get()
+
+    def _write_compressions(self, actions):
+        bulk(self.conn, actions, timeout='60s')
+        self.compressions_written += len(actions)
+
+    def compress(self):
+        '''flatten every replica's forest, so that every node points
+        directly at its root; returns the number of nodes rewritten.
+
+        This also fills in the `root` field of indexes built before
+        it was maintained, so it should be run once on those, while
+        nothing else is writing to the index.
+
+        '''
+        res = scan(
+            self.conn, index=self.index, doc_type=UNION_FIND_TYPE,
+            _source_include=['child', 'parent', 'root'],
+            query={'query': {'match_all': {}}})
+        docs = (item['_source'] for item in res)
+        self.flush_compressions()
+        start = self.compressions_written
         while True:
-            parent = self.get_parent(node)
-            if not parent: break
-            if parent.name in seen:
-                logger.critical('hit loop: %r', seen)
-                sys.exit()
-            seen.add(parent.name)
-            node = parent
-        assert(node.cardinality)
-        # TODO: turn get_root, into get_roots
-        # TODO: implement path compression
-        return node
+            batch = list(islice(docs, self.buffer_size))
+            if not batch:
+                break
+            nodes = [AKANode.from_record(doc['child']) for doc in batch]
+            for doc, node, root in zip(batch, nodes, self.get_roots(nodes)):
+                update = {}
+                if doc.get('root') != root.to_record():
+                    update['root'] = root.to_record()
+                if 'parent' in doc and doc['parent'][0] != root.name:
+                    update['parent'] = root.to_record()
+                if update:
+                    self.queue_union_find_update(node, update)
+        self.flush_compressions()
+        self.sync()
+        return self.compressions_written - start
 
     def unite(self, *nodes):
-        roots = {root.name: root for root in [self.get_root(node) for node in nodes]}
-        roots = sorted(roots.values(), key=lambda n: (n.rank, pseudorandom(n.name, n.replica)))
-        if len(roots) == 1:
-            logger.debug('already united')
-            return
-        
-        new_root = roots.pop()
-        if new_root.rank == roots[-1].rank:
-            new_root.rank += 1
-        for root in roots:
-            new_root.cardinality += root.cardinality
-            #logger.debug('%d pairs built for union', len(roots))
-        self.set_parents(new_root, *roots)
+        new_root = self.unite_all([nodes])[0]
+        self.flush_unions()
         return new_root
 
+    @timed('unite_all')
+    def unite_all(self, groups):
+        '''unite the nodes in each of `groups`, which must not share any
+        roots, e.g. because each is in a different replica.  The roots
+        of all of the groups are looked up together and the writes
+        are queued for `flush_unions`.  Returns the new root of each
+        group, or None for groups that were already united.
+
+        '''
+        nodes = [node for group in groups for node in group]
+        all_roots = self.get_roots(nodes)
+        root_groups = []
+        start = 0
+        for group in groups:
+            roots = all_roots[start:start + len(group)]
+            start += len(group)
+            root_groups.append({root.name: root for root in roots}.values())
+        return self.unite_roots(root_groups)
+
+    def unite_roots(self, groups):
+        '''queue the writes that unite each of `groups` of distinct roots
+        by rank, and return the new root of each group, or None for
+        groups of one root
+        '''
+        unions = []
+        new_roots = []
+        for roots in groups:
+            roots = sorted(roots, key=lambda n: (n.rank, pseudorandom(n.name, n.replica)))
+            if len(roots) == 1:
+                logger.debug('already united')
+                new_roots.append(None)
+                continue
+
+            new_root = roots.pop()
+            if new_root.rank == roots[-1].rank:
+                new_root.rank += 1
+            for root in roots:
+                new_root.cardinality += root.cardinality
+                #logger.debug('%d pairs built for union', len(roots))
+            unions.append((new_root, roots))
+            new_roots.append(new_root)
+        self.queue_parents(unions)
+        return new_roots
+
     def connected_component(self, *urls):
-        frontier = set()
-        for url in urls:
-            for replica in self.replica_list:
-                frontier.add(self.get_root(AKANode(url, replica)))
-        frontier = list(frontier)
+        frontier = set(self.get_roots([AKANode(url, replica)
+                                       for url in urls
+                                       for replica in self.replica_list],
+                                      compress=False))
+        return self.count_members(frontier)
+
+    def probability(self, url_a, url_b):
+        '''get the fraction of replicas in which `url_a` and `url_b` are in
+        the same tree, which is the confidence that they are the same,
+        without fetching either of their components; see
+        `probabilities`
+        '''
+        return self.probabilities([(url_a, url_b)])[0]
+
+    def probabilities(self, pairs):
+        '''get `probability` for each of `pairs` of urls, in the same
+        order, from the roots of all of their urls in all replicas,
+        which are looked up together in one `get_roots`
+        '''
+        pairs = list(pairs)
+        urls = sorted({url for pair in pairs for url in pair})
+        nodes = [AKANode(url, replica)
+                 for url in urls for replica in self.replica_list]
+        roots = {}
+        for node, root in zip(nodes, self.get_roots(nodes, compress=False)):
+            roots[node.name, node.replica] = root.name
+        results = []
+        for url_a, url_b in pairs:
+            shared = sum(1 for replica in self.replica_list
+                         if roots[url_a, replica] == roots[url_b, replica])
+            results.append(shared / len(self.replica_list))
+        return results
+
+    def count_members(self, frontier):
+        '''yield `(url, count)` for the members of the trees rooted at the
+        nodes in `frontier`, where `count` is the number of trees it is
+        in, highest counts first
+        '''
+        ranked, _ = self.rank_members(frontier)
+        return cutoff_members(ranked)
+
+    def rank_members(self, frontier, limit=None, budget=None, timeout=None):
+        '''get a list of `(url, count)` for the members of the trees
+        rooted at the nodes in `frontier`, as for `count_members` but
+        without its cutoff, and whether it was cut short by `budget`
+        or `timeout`
+
+        The trees are scanned a replica at a time, smallest first,
+        since their members are the likeliest to be in every replica.
+        With a `limit`, the scan stops as soon as no url that has not
+        made the top `limit` so far could still overtake them in the
+        replicas left, and the counts of just those urls are then
+        finished with a root lookup in each of the replicas left, so
+        the result is the same as for a full scan.  `budget` stops the
+        scan after that many nodes, even partway through a tree, and
+        `timeout` after the first replica that ends that many seconds
+        after starting; the counts of the urls seen by then are
+        finished in the same way, but members that were never seen are
+        missing.
+
+        The replicas are fetched concurrently, `msearch_concurrency` at
+        a time, or all at once if there is nothing to stop early for,
+        so the time taken approaches that of the largest tree rather
+        than the sum over replicas.  A wave fetched past a stopping
+        point is wasted, but never changes the result.
+
+        '''
+        start = time.time()
+        by_replica = defaultdict(list)
+        for root in frontier:
+            by_replica[int(root.replica)].append(root)
+        order = sorted(by_replica, key=lambda replica: (sum(
+            root.cardinality or 1 for root in by_replica[replica]), replica))
         counts = defaultdict(lambda: 0)
-        for node in frontier:
-            counts[node.name] += 1
-            frontier.extend(self.get_children(node))
-            # compute a cutoff?
-    # sort all of the nodes in connected components so the highest count urls are first
-        sorted_list = sorted(counts.items(), key=(lambda t: (-t[1], t[0])))
-        # compute a cutoff?
-        # arbitrary cutoff is: yielded at least 10 and count <= 2
-        so_far = 0
-        for url, count in sorted_list:
-            so_far += 1
-            if so_far > 10 and count <= 2:
-                break
-            yield url, count
+        visited = 0
+        truncated = False
+        remaining = list(order)
+        wave_size = len(order)
+        if limit is not None or budget is not None or timeout is not None:
+            wave_size = max(1, self.msearch_concurrency)
+
+        def scan_replica(replica):
+            members = self.iter_members(by_replica[replica])
+            if budget is not None:
+                members = islice(members, budget + 1)
+            return [node.name for node in members]
+
+        stopped = False
+        while remaining and not stopped:
+            wave = remaining[:wave_size]
+            if self.union_find is not None:
+                # the forest is in memory, so there is nothing to wait on
+                members = map(scan_replica, wave)
+            else:
+                members = self.map_searches(scan_replica, wave)
+            for names in members:
+                visited += len(names)
+                if budget is not None and visited > budget:
+                    # the members seen within the budget are still
+                    # counted, by the root lookup in the replicas left
+                    for name in names[:len(names) - (visited - budget)]:
+                        counts.setdefault(name, 0)
+                    truncated = stopped = True
+                    break
+                for name in names:
+                    counts[name] += 1
+                remaining.pop(0)
+                if timeout is not None and time.time() - start >= timeout:
+                    truncated = bool(remaining)
+                    stopped = True
+                    break
+                if limit is not None and \
+                        top_members_known(counts, limit, len(remaining)):
+                    stopped = True
+                    break
+        if truncated:
+            self.metrics.count('components_truncated')
+        if len(remaining) < len(order):
+            self.metrics.observe('replicas_scanned',
+                                 len(order) - len(remaining))
+        ranked = sorted(counts.items(), key=(lambda t: (-t[1], t[0])))
+        if not remaining or not ranked:
+            return ranked[:limit], truncated
+        candidates = [url for url, _ in ranked[:limit]]
+        root_names = {replica: {root.name for root in by_replica[replica]}
+                      for replica in remaining}
+        nodes = [AKANode(url, replica)
+                 for url in candidates for replica in remaining]
+        for node, root in zip(nodes, self.get_roots(nodes, compress=False)):
+            if root.name in root_names[node.replica]:
+                counts[node.name] += 1
+        ranked = sorted(((url, counts[url]) for url in candidates),
+                        key=(lambda t: (-t[1], t[0])))
+        return ranked, truncated
+
+    def get_members(self, root):
+        '''yield all of the nodes in the tree under `root`, including
+        `root` itself
+        '''
+        return self.iter_members([root])
+
+    def iter_members(self, roots):
+        '''yield all of the nodes in the trees under each of `roots`,
+        including the `roots` themselves
+        '''
+        if self.union_find is not None:
+            for root in roots:
+                for name in self.union_find.members(int(root.replica),
+                                                    root.name):
+                    yield AKANode(name, root.replica)
+            return
+        for root in roots:
+            yield root
+        for _, node in self.scan_members(roots):
+            yield node
+
+    def scan_members(self, roots):
+        '''yield `(root_id, node)` for the nodes other than `roots` whose
+        `root` field is one of `roots`, using one terms query for each
+        chunk of `roots`.
+        '''
+        roots = list(roots)
+        for start in range(0, len(roots), 1000):
+            root_ids = [root.get_id() for root in roots[start:start + 1000]]
+            res = scan(
+                self.conn, index=self.index, doc_type=UNION_FIND_TYPE,
+                _source_include=['child', 'root'],
+                query={'query': {'constant_score': {
+                    'filter': {'terms': {'root': root_ids}}}}})
+            seen = set(root_ids)
+            for item in res:
+                if item['_id'] not in seen:
+                    seen.add(item['_id'])
+                    yield (item['_source']['root'][1],
+                           AKANode.from_record(item['_source']['child']))
+            # members moved since the last refresh are not searchable yet
+            for root_id in root_ids:
+                for node in self.overlay.get_members(root_id):
+                    if node.get_id() not in seen:
+                        seen.add(node.get_id())
+                        yield root_id, node
 
     def delete_index(self):
         try:
@@ -829,12 +2323,37 @@ class AKAGraph(object):
                             "type": "string",
                             "index": "not_analyzed",
                         },
+                        # the root of the tree that the child is in, so
+                        # that a whole component can be fetched at once
+                        "root": {
+                            "type": "string",
+                            "index": "not_analyzed",
+                        },
                         "rank": {
                             "type": "integer",
                          },
                         "cardinality": {
                             "type": "integer",
                         },
+                        "generation": {
+                            "type": "integer",
+                        },
+                    },
+                },
+            })
+
+        self.conn.indices.put_mapping(
+            index=self.index, doc_type=SKETCH_TYPE, body={
+                SKETCH_TYPE: {
+                    '_all': {
+                        'enabled': False,
+                    },
+                    # the one count-min sketch of selector popularity,
+                    # which each writer merges its new counts into
+                    'properties': {
+                        'counts': {
+                            'type': 'binary',
+                        },
                     },
                 },
             })
@@ -861,6 +2380,45 @@ class AKAGraph(object):
             })
 
 
+def popularity_key(selector_type, value):
+    return u'%s:%s' % (selector_type, value)
+
+
+def top_members_known(counts, limit, remaining):
+    '''whether the `limit` urls with the highest `counts` are sure to
+    stay on top, when any url could gain at most `remaining` more
+    '''
+    if not remaining:
+        return True
+    if len(counts) < limit:
+        # a url that has not been seen yet could still make it
+        return False
+    top = heapq.nlargest(limit + 1, counts.itervalues())
+    runner_up = top[limit] if len(top) > limit else 0
+    return top[limit - 1] > runner_up + remaining
+
+
+def cutoff_members(ranked):
+    '''yield the `(url, count)` in `ranked`, highest counts first, up to
+    an arbitrary cutoff: at least 10, then only those with counts
+    above 2
+    '''
+    so_far = 0
+    for url, count in ranked:
+        so_far += 1
+        if so_far > 10 and count <= 2:
+            break
+        yield url, count
+
+
+def is_rejection(error):
+    '''whether the `error` of an msearch response means that the search
+    queue was full, so that the search can be retried
+    '''
+    error = unicode(error)
+    return 'queue capacity' in error or 'rejected' in error
+
+
 def find_overlaps(recs):
     '''Find all of the overlapping identifiers in a list of records and
     return them as a map<identifier_type, list<identifier>>
@@ -893,14 +2451,60 @@ def main():
     p.add_argument('--delete', action='store_true', default=False)
     p.add_argument('--parent')
     p.add_argument('--query')
-    p.add_argument('--make-pairs', help='path to a csv file to create')
+    p.add_argument('--make-pairs',
+                   help='path to a csv file to create; with --query, of '
+                   'scored pairs from its cluster, otherwise of candidate '
+                   'pairs from the whole index')
+    p.add_argument('--block-cap', default=100, type=int,
+                   help='with --make-pairs, do not pair up records by '
+                   'a selector or username n-gram that is in more than '
+                   'this many records')
     p.add_argument('--input-format', default=None)
     p.add_argument('--ingest', nargs='+',
                    help='record files in gzipped CBOR or an ETL format.')
+    p.add_argument('--ingest-edges', nargs='+', metavar='PATH',
+                   help='edge lists of "url_a, url_b, strength[, evidence]" '
+                   'in tab-separated text ending in ".tsv" or CBOR lists, '
+                   'optionally gzipped, to unite in bulk')
+    p.add_argument('--remove', nargs='+', metavar='URL',
+                   help='retract the records of these urls and rebuild '
+                   'the components they were in')
+    p.add_argument('--remove-selector', nargs='+', metavar='VALUE',
+                   help='retract these selector values from every record '
+                   'that has them and rebuild the components of those '
+                   'records')
     p.add_argument('--analyze', action='store_true', default=False,
                    help='output analysis of all clusters')
+    p.add_argument('--analyze-out', default=None,
+                   help='with --analyze, resolve clusters from a single '
+                   'scan of the forest, write one JSON line per cluster to '
+                   'this path and output only the aggregate stats')
+    p.add_argument('--compress', action='store_true', default=False,
+                   help='point every node directly at its root in all '
+                   'replicas')
     p.add_argument('--limit', default=None, type=int,
                    help='number of records to process.')
+    p.add_argument('--union-find', default=None,
+                   help='path to an in-process union-find used in place of '
+                   'the union_find doc type during --ingest; it is loaded '
+                   'if it exists, saved afterwards, and then bulk loaded '
+                   'into elasticsearch.')
+    p.add_argument('--export', default=None, metavar='PATH',
+                   help='write a binary snapshot of the index to PATH')
+    p.add_argument('--import', default=None, metavar='PATH',
+                   dest='import_path',
+                   help='load a binary snapshot written by --export into '
+                   'the index')
+    p.add_argument('--popular-threshold', default=None, type=int,
+                   help='skip querying for selector values that are '
+                   'estimated to be in more than this many records')
+    p.add_argument('--stats-interval', default=60, type=float,
+                   help='seconds between logging the stats of a '
+                   'single-process --ingest')
+    p.add_argument('--workers', default=1, type=int,
+                   help='number of processes to use for --ingest; each '
+                   'one loads and analyzes a share of the records and then '
+                   'unites a share of the replicas.')
     config = Config()
     args = yakonfig.parse_args(p, [dblogger, config, kvlayer, yakonfig])
 
@@ -908,6 +2512,8 @@ def main():
 
     aka = config.akagraph
     aka.buffer_size = args.buffer_size
+    if args.popular_threshold is not None:
+        aka.popular_threshold = args.popular_threshold
 
     if args.parent:
         data = [aka.get_parent(AKANode(unicode(args.parent), i))
@@ -926,6 +2532,7 @@ def main():
         else:
             assert args.make_pairs.endswith('.csv'),\
                 '--make-pairs must end in ".csv"'
+            from .pairs import make_pairs
             # make the four-column Memex eval format
             # these functions are used in the loop below
 
@@ -954,60 +2561,136 @@ def main():
                 return False
             with open(args.make_pairs, 'ab') as fh:
                 writer = csv.writer(fh)
-                # consider all pairs
-                for i in range(len(cluster)):
-                    for j in range(i, len(cluster)):
-                        r1 = cluster[i]
-                        r2 = cluster[j]
-                        if 'bogus' in r1['url']: continue
-                        if 'bogus' in r2['url']: continue
-                        c1 = r1['confidence']
-                        c2 = r2['confidence']
-                        if not (1 <= c1 or 1 <= c2):
-                            continue
-                        score = min(r1['confidence'], r2['confidence'])
-                        pair_key = ','.join([args.query, domain(r1), domain(r2)])
-                        tld_key = ','.join(sorted([tld(r1), tld(r2)]))
-                        identifier_types = ['email', 'username']  #### IGNORE phone and bitconin and name
-                        for k1 in identifier_types:
-                            if k1 not in r1: continue
-                            for k2 in identifier_types:
-                                if k2 not in r2: continue
-                                identifier_type_key = ','.join(sorted([k1, k2]))
-                                for n1 in r1[k1]:
-                                    for n2 in r2[k2]:
-                                        if k1 == 'email':
-                                            n1 = n1.split('@')[0]
-                                        if k2 == 'email':
-                                            n2 = n2.split('@')[0]  ### they only want to *see* a username-like string
-                                        if bad_username(n1): continue
-                                        if bad_username(n2): continue
-                                        row = (
-                                            r1['url'],
-                                            n1.encode('utf8'),
-                                            r2['url'],
-                                            n2.encode('utf8'),
-                                            score,
-                                            identifier_type_key,
-                                            pair_key,
-                                            tld_key,
-                                        )
-                                        writer.writerow(row)
+                # only consider pairs that share a blocking key, and
+                # each record with itself
+                index = {rec['url']: i for i, rec in enumerate(cluster)}
+                pairs = [(i, i) for i in range(len(cluster))]
+                for url_a, url_b, _ in make_pairs(
+                        cluster, block_cap=args.block_cap,
+                        workers=args.workers):
+                    pairs.append(tuple(sorted([index[url_a], index[url_b]])))
+                for i, j in sorted(pairs):
+                    r1 = cluster[i]
+                    r2 = cluster[j]
+                    if 'bogus' in r1['url']: continue
+                    if 'bogus' in r2['url']: continue
+                    c1 = r1['confidence']
+                    c2 = r2['confidence']
+                    if not (1 <= c1 or 1 <= c2):
+                        continue
+                    score = min(r1['confidence'], r2['confidence'])
+                    pair_key = ','.join([args.query, domain(r1), domain(r2)])
+                    tld_key = ','.join(sorted([tld(r1), tld(r2)]))
+                    identifier_types = ['email', 'username']  #### IGNORE phone and bitconin and name
+                    for k1 in identifier_types:
+                        if k1 not in r1: continue
+                        for k2 in identifier_types:
+                            if k2 not in r2: continue
+                            identifier_type_key = ','.join(sorted([k1, k2]))
+                            for n1 in r1[k1]:
+                                for n2 in r2[k2]:
+                                    if k1 == 'email':
+                                        n1 = n1.split('@')[0]
+                                    if k2 == 'email':
+                                        n2 = n2.split('@')[0]  ### they only want to *see* a username-like string
+                                    if bad_username(n1): continue
+                                    if bad_username(n2): continue
+                                    row = (
+                                        r1['url'],
+                                        n1.encode('utf8'),
+                                        r2['url'],
+                                        n2.encode('utf8'),
+                                        score,
+                                        identifier_type_key,
+                                        pair_key,
+                                        tld_key,
+                                    )
+                                    writer.writerow(row)
+        sys.exit()
+
+    if args.make_pairs:
+        # without --query, pair up the records of the whole index
+        assert args.make_pairs.endswith('.csv'),\
+            '--make-pairs must end in ".csv"'
+        from .pairs import make_pairs
+        records = (hit['_source'] for hit in scan(
+            aka.conn, index=aka.index, doc_type=RECORD_TYPE,
+            _source_include=['url', 'phone', 'email', 'username']))
+        with open(args.make_pairs, 'ab') as fh:
+            writer = csv.writer(fh)
+            for url_a, url_b, key in make_pairs(
+                    records, block_cap=args.block_cap, workers=args.workers):
+                writer.writerow([url_a.encode('utf8'), url_b.encode('utf8'),
+                                 key.encode('utf8')])
         sys.exit()
 
     if args.delete:
         aka.delete_index()
         sys.exit()
 
+    if args.export:
+        from .snapshot import export_snapshot
+        export_snapshot(aka, args.export)
+        sys.exit()
+
+    if args.import_path:
+        from .snapshot import import_snapshot
+        import_snapshot(aka, args.import_path)
+        sys.exit()
+
     if args.input_format:
         loader = get_etl_transforms(args.input_format)
     else:
         loader = None
 
     if args.ingest:
+        if args.union_find and args.workers > 1:
+            p.error('--union-find cannot be combined with --workers')
+        if args.union_find:
+            if os.path.exists(args.union_find):
+                aka.union_find = ArrayUnionFind.load(args.union_find)
+            else:
+                aka.union_find = ArrayUnionFind(len(aka.replica_list))
+                if aka.conn.indices.exists(index=aka.index):
+                    aka.union_find.load_unions(aka.get_all_unions())
         logger.debug('running ingest with loader=%r: %r',
                      loader, aka)
-        run_ingest(args, loader, aka)
+        if args.workers > 1:
+            # imported here because parallel imports this module
+            from .parallel import parallel_ingest
+            parallel_ingest(aka, args.ingest, loader=loader,
+                            workers=args.workers)
+        else:
+            run_ingest(args, loader, aka)
+        if args.union_find:
+            aka.union_find.save(args.union_find)
+            aka.push_union_find()
+
+    if args.ingest_edges:
+        edges = (edge for path in args.ingest_edges
+                 for edge in load_edges(path))
+        count = aka.add_edges(edges)
+        logger.info('united %d distinct edges', count)
+
+    if args.remove:
+        count = aka.remove(*[unicode(url) for url in args.remove])
+        logger.info('rebuilt the unions of %d records', count)
+
+    if args.remove_selector:
+        for value in args.remove_selector:
+            count = aka.remove_selector(unicode(value))
+            logger.info('rebuilt the unions of %d records', count)
+
+    if args.compress:
+        count = aka.compress()
+        logger.info('compressed %d paths', count)
+        sys.exit()
+
+    if args.analyze and args.analyze_out:
+        with open(args.analyze_out, 'wb') as fh:
+            stats = aka.write_clusters(fh, limit=args.limit)
+        print(json.dumps(stats, indent=4, sort_keys=True))
+        sys.exit()
 
     if args.analyze:
         stats = aka.analyze_clusters(limit=args.limit)
@@ -1017,44 +2700,19 @@ def main():
 
 def run_ingest(args, loader, aka):
     '''calls on `aka.add` on each record from `loader` acting on each path
-    in `args.ingest`
+    in `args.ingest`, logging `aka.stats()` every `args.stats_interval`
+    seconds if it is set
 
     '''
+    stats_interval = getattr(args, 'stats_interval', None)
     total = 0
     start = time.time()
+    last_stats = start
     with aka:
         for rec_path in args.ingest:
             logger.debug('loading %r', rec_path)
-            if loader:
-                temp_loader = loader
-            else:
-                def temp_loader(path, **kwargs):
-                    del kwargs
-                    fopen = open
-                    loads = cbor.load
-                    if path.endswith('.gz'):
-                        fopen = gzip.open
-                    elif path.endswith('.json'):
-                        def loads(f):
-                            while True:
-                                line = fdoc.readline()
-                                if not line:
-                                    raise EOFError()
-                                try:
-                                    return json.loads(line)
-                                except ValueError:
-                                    logger.debug('failed to decode json %s', line)
-                    elif path == '-':
-                        fopen = lambda s: sys.stdin
-                    with fopen(path) as fdoc:
-                        while True:
-                            try:
-                                yield loads(fdoc)
-                            except EOFError:
-                                break
-
-            for rec in temp_loader(rec_path,
-                                   hard_selectors=aka.hard_selectors):
+            for rec in (loader or load_records)(
+                    rec_path, hard_selectors=aka.hard_selectors):
                 logger.debug(rec)
                 aka.add(rec)
                 total += 1
@@ -1063,8 +2721,96 @@ def run_ingest(args, loader, aka):
                     rate = total / elapsed
                     logger.debug('%d done in %.1f sec --> %.1f per sec', 
                                 total, elapsed, rate)
+                    if stats_interval is not None and \
+                            time.time() - last_stats >= stats_interval:
+                        logger.info('stats after %d records: %s', total,
+                                    json.dumps(aka.stats(), sort_keys=True))
+                        last_stats = time.time()
             logger.debug('finished %s, total recs=%d', rec_path, total)
     logger.debug('finished %d recs', total)
+    if stats_interval is not None:
+        logger.info('stats after %d records: %s', total,
+                    json.dumps(aka.stats(), sort_keys=True))
+
+
+def load_records(path, **kwargs):
+    '''yield the records in the CBOR file at `path`, which may also be
+    gzipped, a file of JSON lines ending in ".json", or "-" for CBOR on
+    stdin
+    '''
+    del kwargs
+    fopen = open
+    loads = cbor.load
+    if path.endswith('.gz'):
+        fopen = gzip.open
+    elif path.endswith('.json'):
+        def loads(fdoc):
+            while True:
+                line = fdoc.readline()
+                if not line:
+                    raise EOFError()
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    logger.debug('failed to decode json %s', line)
+    elif path == '-':
+        fopen = lambda s: sys.stdin
+    with fopen(path) as fdoc:
+        while True:
+            try:
+                yield loads(fdoc)
+            except EOFError:
+                break
+
+
+def load_edges(path):
+    '''yield `(url_a, url_b, strength)` or `(url_a, url_b, strength,
+    evidence)` for the edges in `path`, which is either tab-separated
+    text ending in ".tsv" or a CBOR file of lists, either of which may
+    also be gzipped
+    '''
+    fopen = gzip.open if path.endswith('.gz') else open
+    with fopen(path, 'rb') as fh:
+        if path.endswith('.tsv') or path.endswith('.tsv.gz'):
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.decode('utf-8').split('\t')
+                parts[2] = float(parts[2])
+                yield tuple(parts)
+        else:
+            while True:
+                try:
+                    yield tuple(cbor.load(fh))
+                except EOFError:
+                    break
+
+
+def merge_edges(edges):
+    '''get a sorted list of `((url_a, url_b, evidence), strength)` for
+    the distinct edges in `edges`, ignoring their direction and any
+    self-loops.  As for `AKAGraph.add_edge`, repeats of an edge
+    without evidence are independent, so their strengths combine as
+    `1 - (1 - s1) * (1 - s2)`, while repeats with the same evidence
+    are not, so the strongest wins.
+    '''
+    merged = {}
+    for edge in edges:
+        url_a, url_b, strength = edge[:3]
+        evidence = edge[3] if len(edge) > 3 else None
+        if url_a == url_b:
+            continue
+        if url_b < url_a:
+            url_a, url_b = url_b, url_a
+        key = (url_a, url_b, evidence)
+        if key not in merged:
+            merged[key] = strength
+        elif evidence is None:
+            merged[key] = 1 - (1 - merged[key]) * (1 - strength)
+        else:
+            merged[key] = max(merged[key], strength)
+    return sorted(merged.items())
 
 
 if __name__ == '__main__':
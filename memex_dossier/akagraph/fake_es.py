@@ -0,0 +1,433 @@
+'''In-process stand-in for the subset of the elasticsearch-py client
+used by :mod:`memex_dossier.akagraph.core`.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+:class:`FakeElasticsearch` keeps every index in ordinary dicts, counts
+every request it serves, and optionally sleeps according to a latency
+model so that round-trip costs can be measured without a live
+cluster.  It mimics the visibility rules that matter to AKAGraph:
+``get`` and ``mget`` are realtime, while ``search``, ``msearch`` and
+``scan`` only see documents as of the last ``indices.refresh``.  Every
+document has a ``_version``, which bulk actions may give to be applied
+only if it is still current.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import Counter
+import copy
+import itertools
+import json
+import threading
+import time
+
+from elasticsearch import NotFoundError, RequestError
+from elasticsearch.serializer import JSONSerializer
+
+
+def fixed_latency(seconds, **per_request):
+    '''make a latency model for :class:`FakeElasticsearch` in which
+    every request takes `seconds`, except those named in
+    `per_request`, e.g. ``fixed_latency(.001, bulk=.01)``
+    '''
+    def latency(name):
+        return per_request.get(name.replace('.', '_'), seconds)
+    return latency
+
+
+def _values(source, field):
+    '''return the list of values that `field` has in `source`
+    '''
+    if field == '_id':
+        return []
+    val = source.get(field)
+    if val is None:
+        return []
+    if isinstance(val, list):
+        return val
+    return [val]
+
+
+def _term(value):
+    '''string fields index numbers by their text, so compare as text'''
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    return value
+
+
+def _matches(query, _id, source):
+    '''evaluate the supported subset of the query DSL against one
+    document
+    '''
+    if not query:
+        return True
+    (kind, spec), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'term':
+        (field, value), = spec.items()
+        if isinstance(value, dict):
+            value = value['value']
+        return _term(value) in map(_term, _values(source, field))
+    if kind == 'terms':
+        spec = dict(spec)
+        spec.pop('execution', None)
+        (field, values), = spec.items()
+        return bool(set(map(_term, _values(source, field))).intersection(
+            map(_term, values)))
+    if kind == 'ids':
+        return _id in spec['values']
+    if kind == 'exists':
+        return bool(_values(source, spec['field']))
+    if kind == 'missing':
+        return not _values(source, spec['field'])
+    if kind == 'constant_score':
+        return _matches(spec.get('filter') or spec.get('query'), _id, source)
+    if kind == 'filtered':
+        return (_matches(spec.get('query'), _id, source) and
+                _matches(spec.get('filter'), _id, source))
+    if kind == 'bool':
+        def as_list(clauses):
+            if clauses is None:
+                return []
+            if isinstance(clauses, dict):
+                return [clauses]
+            return clauses
+        for clause in as_list(spec.get('must')) + as_list(spec.get('filter')):
+            if not _matches(clause, _id, source):
+                return False
+        for clause in as_list(spec.get('must_not')):
+            if _matches(clause, _id, source):
+                return False
+        should = as_list(spec.get('should'))
+        if should:
+            return any(_matches(clause, _id, source) for clause in should)
+        return True
+    raise RequestError(400, 'unsupported query: %r' % kind, query)
+
+
+def _project(source, includes):
+    if not includes:
+        return copy.deepcopy(source)
+    if isinstance(includes, basestring):
+        includes = includes.split(',')
+    return {key: copy.deepcopy(source[key])
+            for key in includes if key in source}
+
+
+def _as_list(doc_type):
+    if doc_type is None:
+        return None
+    if isinstance(doc_type, basestring):
+        return doc_type.split(',')
+    return list(doc_type)
+
+
+class FakeIndices(object):
+    '''the `indices` namespace of :class:`FakeElasticsearch`
+    '''
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index, **kwargs):
+        self.es._request('indices.exists')
+        return index in self.es.docs
+
+    def create(self, index, body=None, **kwargs):
+        self.es._request('indices.create')
+        with self.es.lock:
+            if index in self.es.docs:
+                raise RequestError(
+                    400, 'IndexAlreadyExistsException[[%s] already exists]'
+                    % index, {})
+            self.es.docs[index] = {}
+            self.es.visible[index] = {}
+            self.es.mappings[index] = {}
+            self.es.versions[index] = {}
+
+    def delete(self, index, **kwargs):
+        self.es._request('indices.delete')
+        with self.es.lock:
+            if index not in self.es.docs:
+                raise NotFoundError(404, 'IndexMissingException', {})
+            del self.es.docs[index]
+            del self.es.visible[index]
+            del self.es.mappings[index]
+            del self.es.versions[index]
+
+    def refresh(self, index=None, **kwargs):
+        self.es._request('indices.refresh')
+        with self.es.lock:
+            for name in ([index] if index else list(self.es.docs)):
+                if name not in self.es.docs:
+                    raise NotFoundError(404, 'IndexMissingException', {})
+                self.es.visible[name] = copy.deepcopy(self.es.docs[name])
+
+    def put_mapping(self, index, doc_type, body, **kwargs):
+        self.es._request('indices.put_mapping')
+        self.es.mappings[index][doc_type] = body
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    '''Stand-in for :class:`elasticsearch.Elasticsearch`.
+
+    :param latency: optional callable taking the name of a request
+      (e.g. ``'mget'``) and returning the number of seconds it should
+      take; this is how a network is simulated.
+
+    :param auto_refresh: if true, every write is immediately visible
+      to searches, as though ``refresh`` were called after each one.
+
+    The number of requests of each kind served is kept in
+    :attr:`calls`, and the number of documents written in
+    :attr:`docs_written`.
+
+    '''
+    transport = FakeTransport()
+
+    def __init__(self, latency=None, auto_refresh=False):
+        self.latency = latency
+        self.auto_refresh = auto_refresh
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.visible = {}
+        self.mappings = {}
+        # index -> (doc_type, _id) -> _version
+        self.versions = {}
+        self.scrolls = {}
+        self.scroll_ids = itertools.count()
+        self.calls = Counter()
+        self.docs_written = 0
+        self.indices = FakeIndices(self)
+        #: optional callable given (index, query) for each `msearch`
+        #: sub-request; returning an error string fails that entry,
+        #: which is how ES reports a full search queue
+        self.msearch_error = None
+
+    def _request(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency is not None:
+            delay = self.latency(name)
+            if delay:
+                time.sleep(delay)
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+            self.docs_written = 0
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def _index_docs(self, index, visible=False):
+        store = self.visible if visible else self.docs
+        if index not in store:
+            raise NotFoundError(404, 'IndexMissingException[[%s] missing]'
+                                % index, {})
+        return store[index]
+
+    def _search(self, index, doc_type, body, size=10, from_=0,
+                _source_include=None, _source=None):
+        body = body or {}
+        query = body.get('query')
+        size = body.get('size', size)
+        from_ = body.get('from', from_)
+        doc_types = _as_list(doc_type)
+        hits = []
+        with self.lock:
+            docs = self._index_docs(index, visible=True)
+            for (_type, _id), source in sorted(docs.items()):
+                if doc_types and _type not in doc_types:
+                    continue
+                if _matches(query, _id, source):
+                    hit = {'_index': index, '_type': _type, '_id': _id,
+                           '_score': 1.0}
+                    if _source is not False:
+                        hit['_source'] = _project(source, _source_include)
+                    hits.append(hit)
+        total = len(hits)
+        if size is not None:
+            hits = hits[from_:from_ + int(size)]
+        return {
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': total, 'hits': hits},
+        }
+
+    def search(self, index=None, doc_type=None, body=None, size=10,
+               search_type=None, scroll=None, _source_include=None,
+               _source=None, **kwargs):
+        if scroll is not None:
+            self._request('search.scroll')
+            resp = self._search(index, doc_type, body, size=None,
+                                _source_include=_source_include,
+                                _source=_source)
+            scroll_id = str(next(self.scroll_ids))
+            hits = resp['hits']['hits']
+            page = int(size or 10)
+            pages = [hits[i:i + page] for i in range(0, len(hits), page)]
+            if search_type != 'scan':
+                first = pages.pop(0) if pages else []
+            else:
+                first = []
+            self.scrolls[scroll_id] = pages
+            resp['hits']['hits'] = first
+            resp['_scroll_id'] = scroll_id
+            return resp
+        self._request('search')
+        return self._search(index, doc_type, body, size=size,
+                            _source_include=_source_include,
+                            _source=_source)
+
+    def scroll(self, scroll_id=None, scroll=None, **kwargs):
+        self._request('scroll')
+        pages = self.scrolls.get(scroll_id)
+        if pages is None:
+            raise NotFoundError(404, 'SearchContextMissingException', {})
+        hits = pages.pop(0) if pages else []
+        if not hits:
+            del self.scrolls[scroll_id]
+        return {
+            '_scroll_id': scroll_id,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': len(hits), 'hits': hits},
+        }
+
+    def clear_scroll(self, scroll_id=None, **kwargs):
+        self._request('clear_scroll')
+        self.scrolls.pop(scroll_id, None)
+
+    def count(self, index=None, doc_type=None, body=None, **kwargs):
+        self._request('count')
+        resp = self._search(index, doc_type, body, size=0)
+        return {'count': resp['hits']['total']}
+
+    def msearch(self, body, index=None, doc_type=None, **kwargs):
+        self._request('msearch')
+        if isinstance(body, basestring):
+            body = [json.loads(line) for line in body.splitlines() if line]
+        responses = []
+        for header, query in zip(body[0::2], body[1::2]):
+            _index = header.get('index', index)
+            error = self.msearch_error and self.msearch_error(_index, query)
+            if error:
+                responses.append({'error': error})
+                continue
+            try:
+                responses.append(self._search(
+                    _index, header.get('type', doc_type), query,
+                    _source_include=header.get('_source_include')))
+            except NotFoundError as exc:
+                responses.append({'error': str(exc)})
+        return {'responses': responses}
+
+    def get(self, index, id, doc_type='_all', _source_include=None,
+            **kwargs):
+        self._request('get')
+        doc = self._get(index, doc_type, id, _source_include)
+        if not doc['found']:
+            raise NotFoundError(404, json.dumps(doc), doc)
+        return doc
+
+    def _get(self, index, doc_type, _id, _source_include=None):
+        with self.lock:
+            docs = self._index_docs(index)
+            doc_types = [doc_type]
+            if doc_type in (None, '_all'):
+                doc_types = sorted({t for t, _ in docs})
+            for _type in doc_types:
+                source = docs.get((_type, _id))
+                if source is not None:
+                    return {'_index': index, '_type': _type, '_id': _id,
+                            'found': True,
+                            '_version': self.versions[index][(_type, _id)],
+                            '_source': _project(source, _source_include)}
+        return {'_index': index, '_type': doc_type, '_id': _id,
+                'found': False}
+
+    def mget(self, body, index=None, doc_type=None, _source_include=None,
+             **kwargs):
+        self._request('mget')
+        docs = []
+        if 'ids' in body:
+            for _id in body['ids']:
+                docs.append(self._get(index, doc_type, _id, _source_include))
+        else:
+            for spec in body['docs']:
+                docs.append(self._get(
+                    spec.get('_index', index), spec.get('_type', doc_type),
+                    spec['_id'], spec.get('_source', _source_include)))
+        return {'docs': docs}
+
+    def bulk(self, body, index=None, doc_type=None, **kwargs):
+        self._request('bulk')
+        if isinstance(body, basestring):
+            lines = [json.loads(line) for line in body.splitlines() if line]
+        else:
+            lines = list(body)
+        items = []
+        with self.lock:
+            while lines:
+                (op_type, meta), = lines.pop(0).items()
+                _index = meta.get('_index', index)
+                _type = meta.get('_type', doc_type)
+                key = (_type, meta['_id'])
+                if _index not in self.docs:
+                    self.docs[_index] = {}
+                    self.visible[_index] = {}
+                    self.mappings[_index] = {}
+                    self.versions[_index] = {}
+                docs = self.docs[_index]
+                versions = self.versions[_index]
+                item = {'_index': _index, '_type': _type,
+                        '_id': meta['_id'], 'status': 200}
+                if '_version' in meta and \
+                        versions.get(key) != meta['_version']:
+                    if op_type != 'delete':
+                        lines.pop(0)
+                    item['status'] = 409
+                    item['error'] = 'VersionConflictEngineException'
+                elif op_type == 'delete':
+                    if docs.pop(key, None) is None:
+                        item['status'] = 404
+                elif op_type == 'update':
+                    data = lines.pop(0)
+                    if key in docs:
+                        docs[key].update(data.get('doc', {}))
+                    elif data.get('doc_as_upsert'):
+                        docs[key] = dict(data['doc'])
+                        item['status'] = 201
+                    elif 'upsert' in data:
+                        docs[key] = dict(data['upsert'])
+                        item['status'] = 201
+                    else:
+                        item['status'] = 404
+                        item['error'] = 'DocumentMissingException'
+                else:
+                    data = lines.pop(0)
+                    if op_type == 'create' and key in docs:
+                        item['status'] = 409
+                        item['error'] = 'DocumentAlreadyExistsException'
+                    else:
+                        item['status'] = 200 if key in docs else 201
+                        docs[key] = data
+                if 200 <= item['status'] < 300:
+                    self.docs_written += 1
+                    if key in docs:
+                        versions[key] = versions.get(key, 0) + 1
+                        item['_version'] = versions[key]
+                    else:
+                        versions.pop(key, None)
+                items.append({op_type: item})
+            if self.auto_refresh:
+                for name in self.docs:
+                    self.visible[name] = copy.deepcopy(self.docs[name])
+        return {'took': 1, 'errors': any(
+            not 200 <= i.values()[0]['status'] < 300 for i in items),
+                'items': items}
@@ -0,0 +1,167 @@
+'''Fuzzy username index for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+Soft selectors only link records whose usernames are exactly equal,
+so ``john_smith88`` and ``johnsmith_88`` never meet.  Comparing every
+username with every other is out of the question, so
+:class:`UsernameLSH` keeps a MinHash signature of the character
+shingles of each username and files it under one bucket per band of
+the signature, in a kvlayer table.  Usernames that share a bucket are
+likely to share many shingles; only those candidates are compared
+with `username_comparison`, and only those similar enough are kept.
+Every entry of a bucket is a key of its own, so parallel writers never
+lose each other's entries.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import defaultdict
+from itertools import islice
+import logging
+
+import mmh3
+
+from memex_dossier.handles.soft_selector_score import username_comparison
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_username(username):
+    '''lowercase `username` and drop everything but letters and digits
+    '''
+    return u''.join(c for c in username.lower() if c.isalnum())
+
+
+class UsernameLSH(object):
+    '''maps MinHash band buckets of usernames to the `(username, url)`
+    pairs filed under them, as keys `(bucket, username, url)` of the
+    kvlayer table `TABLE`
+
+    :param kvl: kvlayer client
+
+    :param num_perm: length of each MinHash signature
+
+    :param bands: number of buckets each username is filed under;
+      usernames whose shingle sets have Jaccard similarity `s` share
+      at least one with probability ``1 - (1 - s ** (num_perm /
+      bands)) ** bands``
+
+    :param shingle_size: length of the character shingles
+
+    :param min_similarity: candidates with a lower `comparison` score
+      are not returned
+
+    :param comparison: function of two usernames that scores their
+      similarity from 0 to 1, by default `username_comparison`
+
+    :param max_postings: read at most this many entries of any one
+      bucket
+
+    '''
+    TABLE = 'akagraph_username_buckets'
+
+    _kvlayer_namespace = {
+        # (band bucket, username, url) -> empty
+        TABLE: (str, str, str),
+    }
+
+    #: the selector type whose values are indexed
+    selector_type = 'username'
+
+    def __init__(self, kvl, num_perm=48, bands=16, shingle_size=3,
+                 min_similarity=.5, comparison=None, max_postings=1000):
+        assert num_perm % bands == 0, 'bands must divide num_perm'
+        self.kvl = kvl
+        self.kvl.setup_namespace(self._kvlayer_namespace)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.min_similarity = min_similarity
+        self.comparison = comparison or username_comparison
+        self.max_postings = max_postings
+
+    def shingles(self, username):
+        name = normalize_username(username).encode('utf-8')
+        if len(name) <= self.shingle_size:
+            return {name}
+        return {name[i:i + self.shingle_size]
+                for i in range(len(name) - self.shingle_size + 1)}
+
+    def buckets(self, username):
+        '''get the keys of the buckets that `username` is filed under
+        '''
+        shingles = self.shingles(username)
+        if not shingles or shingles == {''}:
+            return []
+        signature = [min(mmh3.hash(shingle, seed) for shingle in shingles)
+                     for seed in range(self.num_perm)]
+        rows = self.num_perm // self.bands
+        return ['%d:%x' % (band, mmh3.hash(repr(
+            signature[band * rows:(band + 1) * rows])) & 0xffffffff)
+                for band in range(self.bands)]
+
+    def get_buckets(self, buckets):
+        '''get a dict mapping each of `buckets` to a list of the
+        `(username, url)` filed under it, at most `max_postings` of them
+        '''
+        found = {}
+        for bucket in set(buckets):
+            found[bucket] = [
+                (username.decode('utf-8'), url.decode('utf-8'))
+                for _, username, url in islice(self.kvl.scan_keys(
+                    self.TABLE, ((bucket,), (bucket,))), self.max_postings)]
+        return found
+
+    def entries(self, records):
+        '''get the keys that file each username of each of `records` with
+        its url
+        '''
+        keys = set()
+        for rec in records:
+            for username in rec.get(self.selector_type) or []:
+                if not username:
+                    continue
+                for bucket in self.buckets(username):
+                    keys.add((bucket, username.encode('utf-8'),
+                              rec['url'].encode('utf-8')))
+        return keys
+
+    def add_records(self, records):
+        '''file each username of each of `records` with its url
+        '''
+        keys = self.entries(records)
+        if keys:
+            self.kvl.put(self.TABLE, *[(key, '') for key in keys])
+
+    def remove_records(self, records):
+        '''remove each username of each of `records` with its url, e.g.
+        because the record was retracted
+        '''
+        keys = self.entries(records)
+        if keys:
+            self.kvl.delete(self.TABLE, *keys)
+
+    def find_similar(self, usernames):
+        '''get a dict mapping each of `usernames` to a list of
+        `(other_username, similarity, urls)` for the other usernames in
+        the index that are at least `min_similarity` similar to it
+        '''
+        usernames = set(usernames)
+        keys = {username: self.buckets(username) for username in usernames}
+        buckets = self.get_buckets(key for username_keys in keys.itervalues()
+                                   for key in username_keys)
+        similar = {}
+        for username in usernames:
+            candidates = defaultdict(set)
+            for key in keys[username]:
+                for other, url in buckets.get(key, []):
+                    if other != username:
+                        candidates[other].add(url)
+            similar[username] = []
+            for other in sorted(candidates):
+                similarity = self.comparison(username, other)
+                if similarity >= self.min_similarity:
+                    similar[username].append(
+                        (other, similarity, candidates[other]))
+        return similar
@@ -0,0 +1,75 @@
+'''Read-your-writes overlay for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+Elasticsearch searches only see documents as of the last index
+refresh, and refreshing after every batch caps ingest throughput.
+:class:`WriteOverlay` holds everything an `AKAGraph` has written since
+its last refresh, so that its own reads can be answered from the
+overlay first and refreshes can happen on an interval instead.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import defaultdict
+
+
+class WriteOverlay(object):
+    '''local copy of the writes made since the last refresh:
+
+     * `docs` maps a node id to the latest `union_find` doc that was
+       written for it
+     * `members` maps a root's node id to the nodes that were moved
+       under it, keyed by their node ids
+     * `selectors` maps `(selector_type, value)` to the urls of the
+       records that have it
+
+    '''
+    def __init__(self):
+        self.docs = {}
+        self.members = defaultdict(dict)
+        self.selectors = defaultdict(set)
+
+    def __len__(self):
+        return len(self.docs) + len(self.members) + len(self.selectors)
+
+    def clear(self):
+        self.docs.clear()
+        self.members.clear()
+        self.selectors.clear()
+
+    def put_doc(self, node_id, source):
+        self.docs[node_id] = source
+
+    def update_doc(self, node_id, doc):
+        '''apply a partial update to a doc, if it is held here'''
+        if node_id in self.docs:
+            self.docs[node_id].update(doc)
+
+    def get_doc(self, node_id):
+        '''get the `union_find` doc for `node_id`, or None if it has not
+        been written since the last refresh
+        '''
+        return self.docs.get(node_id)
+
+    def add_members(self, root_id, nodes):
+        members = self.members[root_id]
+        for node in nodes:
+            members[node.get_id()] = node
+
+    def get_members(self, root_id):
+        return self.members.get(root_id, {}).values()
+
+    def add_record(self, rec, selector_types):
+        for key in selector_types:
+            for value in rec.get(key) or []:
+                self.selectors[(key, value)].add(rec['url'])
+
+    def match_records(self, pairs):
+        '''get the urls of records having any of the `(selector_type,
+        value)` `pairs`
+        '''
+        urls = set()
+        for pair in pairs:
+            urls.update(self.selectors.get(pair, ()))
+        return urls
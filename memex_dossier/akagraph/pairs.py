@@ -0,0 +1,179 @@
+'''Blocked candidate pairs of records for ``akagraph --make-pairs``
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+Comparing every record with every other is quadratic.  Instead,
+:func:`make_pairs` gives each record a set of blocking keys from its
+normalized phone numbers, emails and username n-grams, and only pairs
+up records that share a key.  It streams in three phases, with memory
+bounded by the size of one partition rather than of the input:
+
+ 1. each record is spooled as ``[url, keys]`` to the partition files
+    that its keys hash to;
+ 2. each partition counts its keys, and the keys in more than
+    `block_cap` records are dropped everywhere, since a block that big
+    says nothing about any one pair;
+ 3. each partition pairs up the records in each of its blocks.
+
+A pair that shares several keys is only emitted by the block of the
+smallest of them that was not dropped, so pairs are never repeated.
+Phases 2 and 3 run one partition per worker process.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import Counter, defaultdict
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import cbor
+import mmh3
+
+from .parallel import iter_cbor
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_phone(value):
+    '''get the digits of a phone number, without a leading US country
+    code, or None if it is too short to be one
+    '''
+    digits = u''.join(c for c in value if c.isdigit())
+    if len(digits) == 11 and digits.startswith(u'1'):
+        digits = digits[1:]
+    if len(digits) < 7:
+        return None
+    return digits
+
+
+def blocking_keys(rec, ngram_size=4):
+    '''get the set of blocking keys of `rec`: one per normalized phone
+    and email, and the character n-grams of its usernames and of the
+    local parts of its emails
+    '''
+    keys = set()
+    usernames = set()
+    for value in rec.get('phone') or []:
+        phone = normalize_phone(value)
+        if phone:
+            keys.add(u'phone:' + phone)
+    for value in rec.get('email') or []:
+        email = value.strip().lower()
+        if email:
+            keys.add(u'email:' + email)
+            usernames.add(email.split(u'@')[0])
+    for value in rec.get('username') or []:
+        usernames.add(value.strip().lower())
+    for name in usernames:
+        if not name:
+            continue
+        for i in range(max(1, len(name) - ngram_size + 1)):
+            keys.add(u'username:' + name[i:i + ngram_size])
+    return keys
+
+
+def partition_of(key, partitions):
+    return mmh3.hash(key.encode('utf-8')) % partitions
+
+
+def _count_worker(task):
+    '''phase 2: get the keys of one partition that are in more than
+    `block_cap` records
+    '''
+    path, partition, partitions, block_cap = task
+    counts = Counter()
+    for url, keys in iter_cbor(path):
+        counts.update(key for key in keys
+                      if partition_of(key, partitions) == partition)
+    return [key for key, count in counts.iteritems() if count > block_cap]
+
+
+def _pair_worker(task):
+    '''phase 3: write `[url_a, url_b, key]` for the pairs in the blocks
+    of one partition to `out_path`
+    '''
+    path, partition, partitions, dropped, out_path = task
+    blocks = defaultdict(list)
+    for url, keys in iter_cbor(path):
+        keys = frozenset(key for key in keys if key not in dropped)
+        for key in keys:
+            if partition_of(key, partitions) == partition:
+                blocks[key].append((url, keys))
+    count = 0
+    with open(out_path, 'wb') as fh:
+        for key, members in blocks.iteritems():
+            for (url_a, keys_a), (url_b, keys_b) in \
+                    itertools.combinations(members, 2):
+                if url_a == url_b or min(keys_a & keys_b) != key:
+                    continue
+                cbor.dump(sorted([url_a, url_b]) + [key], fh)
+                count += 1
+    return count
+
+
+def make_pairs(records, block_cap=100, workers=1, partitions=None,
+               ngram_size=4, tmpdir=None):
+    '''yield `(url_a, url_b, key)` for each pair of `records` that
+    share a blocking key, where `key` is the smallest one they share
+
+    :param block_cap: keys in more than this many records are not used
+      for blocking
+
+    :param workers: number of processes to pair up partitions with
+
+    :param partitions: number of partitions to spool to, by default
+      four per worker; more partitions means less memory per worker
+
+    :param tmpdir: directory for the spool files
+
+    '''
+    partitions = partitions or 4 * workers
+    spool = tempfile.mkdtemp(prefix='akagraph-pairs-', dir=tmpdir)
+    pool = None
+    try:
+        paths = [os.path.join(spool, 'keys-%d.cbor' % i)
+                 for i in range(partitions)]
+        fhs = [open(path, 'wb') for path in paths]
+        total = 0
+        for rec in records:
+            keys = sorted(blocking_keys(rec, ngram_size))
+            for partition in {partition_of(key, partitions) for key in keys}:
+                cbor.dump([rec['url'], keys], fhs[partition])
+            total += 1
+        for fh in fhs:
+            fh.close()
+        logger.debug('spooled %d records to %d partitions',
+                     total, partitions)
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            imap = pool.imap
+        else:
+            imap = itertools.imap
+        dropped = set()
+        for keys in imap(_count_worker, [
+                (path, i, partitions, block_cap)
+                for i, path in enumerate(paths)]):
+            dropped.update(keys)
+        logger.debug('dropped %d keys in more than %d records',
+                     len(dropped), block_cap)
+        out_paths = [os.path.join(spool, 'pairs-%d.cbor' % i)
+                     for i in range(partitions)]
+        tasks = [(path, i, partitions, dropped, out_path)
+                 for i, (path, out_path) in enumerate(zip(paths, out_paths))]
+        for out_path, _ in itertools.izip(out_paths,
+                                          imap(_pair_worker, tasks)):
+            for url_a, url_b, key in iter_cbor(out_path):
+                yield url_a, url_b, key
+            os.remove(out_path)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(spool)
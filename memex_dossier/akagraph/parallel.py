@@ -0,0 +1,247 @@
+'''Multi-process ingest for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+:func:`parallel_ingest` splits an ``--ingest`` run across a pool of
+workers, each with its own elasticsearch connection, in three phases:
+
+ 1. each input file is parsed by one worker, which bulk loads its
+    records without analyzing them and spools them to local chunk
+    files;
+ 2. after a single refresh, each chunk is analyzed by one worker,
+    which runs `find_equivs` and the scorer over it and spools the
+    resulting edges to a local file;
+ 3. each worker unites every edge in its own share of the replicas in
+    an in-process :class:`~memex_dossier.akagraph.union_find.ArrayUnionFind`
+    and bulk loads the result.
+
+Since every record is loaded before any is analyzed, the second phase
+finds an edge from each of its ends, where a serial ingest only finds
+it from the later one.  Edges that are united by chance are drawn once,
+from the last edge file that has them, as a serial ingest would.
+
+Partitioning the third phase by replica, rather than by record, means
+no two workers ever write the same `union_find` doc, so the forests
+need no merging and no locking.
+
+'''
+from __future__ import absolute_import, division, print_function
+import logging
+import multiprocessing
+import multiprocessing.dummy
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import cbor
+from elasticsearch import Elasticsearch
+
+from .core import AKAGraph, MemoryUnionFind, load_records
+from .union_find import ArrayUnionFind
+
+logger = logging.getLogger(__name__)
+
+#: per-worker state, set up by :func:`_init_worker`
+_local = threading.local()
+
+
+def clone_graph(aka):
+    '''make an `AKAGraph` with the same settings as `aka` but its own
+    elasticsearch connection, for use in another process
+    '''
+    hosts = getattr(getattr(aka.conn, 'transport', None), 'hosts', None)
+    if hosts:
+        conn = Elasticsearch(hosts=hosts, retry_on_timeout=True,
+                             max_retries=5)
+    else:
+        # unwrap the instrumented client, so that requests are only
+        # counted by the graph that makes them
+        conn = aka.conn.client
+    clone = AKAGraph(
+        index_name=aka.index, replicas=len(aka.replica_list),
+        soft_selectors=aka.soft_selectors,
+        hard_selectors=aka.hard_selectors,
+        hyper_edge_scorer=aka.hyper_edge_scorer,
+        shards=aka.shards, buffer_size=aka.buffer_size, conn=conn,
+        num_identifier_downweight=aka.num_identifier_downweight,
+        popular_identifier_downweight=aka.popular_identifier_downweight,
+        path_compression=aka.path_compression,
+        refresh_interval=aka.refresh_interval,
+        selector_index=aka.selector_index,
+        msearch_chunk_size=aka.msearch_chunk_size,
+        msearch_concurrency=aka.msearch_concurrency,
+        msearch_retries=aka.msearch_retries,
+        mget_chunk_size=aka.mget_chunk_size,
+        parent_cache_size=(aka.parent_cache.size
+                           if aka.parent_cache is not None else 0),
+        score_cache=aka.score_cache,
+        popular_threshold=aka.popular_threshold,
+        username_lsh=aka.username_lsh,
+        cache_ttl=aka.cache_ttl,
+    )
+    clone.replica_list = list(aka.replica_list)
+    clone.score_cutoff = aka.score_cutoff
+    return clone
+
+
+def _init_worker(aka, loader):
+    _local.graph = clone_graph(aka)
+    _local.loader = loader or load_records
+
+
+def iter_cbor(path):
+    with open(path, 'rb') as fh:
+        while True:
+            try:
+                yield cbor.load(fh)
+            except EOFError:
+                break
+
+
+def _load_worker(task):
+    '''phase 1: add the records in one input file without analyzing
+    them, and spool them to chunk files of at most `chunk_size` records
+    '''
+    path, chunk_prefix, chunk_size = task
+    aka = _local.graph
+    chunk_paths = []
+    fh = None
+    count = 0
+    try:
+        with aka:
+            for rec in _local.loader(path, hard_selectors=aka.hard_selectors):
+                if count % chunk_size == 0:
+                    if fh is not None:
+                        fh.close()
+                    chunk_paths.append('%s-%d.cbor' % (chunk_prefix,
+                                                       len(chunk_paths)))
+                    fh = open(chunk_paths[-1], 'wb')
+                aka.add(rec, analyze_and_union=False)
+                cbor.dump(rec, fh)
+                count += 1
+    finally:
+        if fh is not None:
+            fh.close()
+    logger.debug('loaded %d records from %s', count, path)
+    return count, chunk_paths
+
+
+def _equivs_worker(task):
+    '''phase 2: find the edges for the records in one chunk file and
+    spool them as `[equivs, score, score_reason]`
+    '''
+    chunk_path, edge_path = task
+    aka = _local.graph
+    if aka.popular_threshold is not None:
+        # pick up the counts of the records the other workers loaded
+        aka.load_popularity()
+    count = 0
+    with open(edge_path, 'wb') as fh:
+        batch = []
+        for rec in iter_cbor(chunk_path):
+            batch.append(rec)
+            if len(batch) >= aka.buffer_size:
+                count += _dump_equivs(aka, batch, fh)
+                batch = []
+        count += _dump_equivs(aka, batch, fh)
+    return count
+
+
+def _dump_equivs(aka, records, fh):
+    count = 0
+    for rec, score, score_reason, equivs in aka.find_equivs(records):
+        equivs.add(rec['url'])
+        cbor.dump([sorted(equivs), score, score_reason], fh)
+        count += 1
+    return count
+
+
+def _iter_edges(edge_paths):
+    for edge_path in edge_paths:
+        for edge in iter_cbor(edge_path):
+            yield edge
+
+
+def _union_worker(task):
+    '''phase 3: unite every edge in `replicas` and bulk load the result;
+    of the edges with a score below 1 that have the same urls, only the
+    last is drawn
+    '''
+    replicas, edge_paths = task
+    aka = _local.graph
+    aka.replica_list = replicas
+    aka.union_find = ArrayUnionFind(replicas)
+    if aka.conn.indices.exists(index=aka.index):
+        aka.union_find.load_unions(aka.get_all_unions(replicas=replicas))
+    last = {}
+    for position, (equivs, score, _) in enumerate(_iter_edges(edge_paths)):
+        if score < 1:
+            last[tuple(equivs)] = position
+    local_union_find = MemoryUnionFind()
+    for position, (equivs, score, score_reason) \
+            in enumerate(_iter_edges(edge_paths)):
+        if score < 1 and last[tuple(equivs)] != position:
+            continue
+        aka.probabilistically_unite_edges(
+            set(equivs), score, score_reason, local_union_find)
+    aka.push_union_find()
+    return len(aka.union_find)
+
+
+def parallel_ingest(aka, paths, loader=None, workers=2, chunk_size=10000,
+                    threads=False):
+    '''ingest the records in `paths` into `aka` using `workers` processes
+
+    :param loader: function to read records from a path, as for
+    :func:`~memex_dossier.akagraph.core.run_ingest`; defaults to
+    :func:`~memex_dossier.akagraph.core.load_records`
+
+    :param chunk_size: number of records per unit of work in the
+    analysis phase
+
+    :param threads: use threads instead of processes, which only pays
+    off when elasticsearch rather than parsing and scoring is the
+    bottleneck
+
+    :returns: number of records ingested
+
+    '''
+    start = time.time()
+    if not aka.conn.indices.exists(index=aka.index):
+        aka.create_index()
+    pool_class = multiprocessing.dummy.Pool if threads else multiprocessing.Pool
+    tmpdir = tempfile.mkdtemp(prefix='akagraph-ingest-')
+    pool = pool_class(workers, _init_worker, (aka, loader))
+    try:
+        results = pool.map(_load_worker, [
+            (path, os.path.join(tmpdir, 'records-%d' % i), chunk_size)
+            for i, path in enumerate(paths)])
+        total = sum(count for count, _ in results)
+        chunk_paths = [p for _, chunk in results for p in chunk]
+        aka.sync()
+        logger.info('loaded %d records in %.1f sec', total,
+                    time.time() - start)
+
+        edge_paths = [os.path.join(tmpdir, 'edges-%d.cbor' % i)
+                      for i in range(len(chunk_paths))]
+        edges = sum(pool.map(_equivs_worker, zip(chunk_paths, edge_paths)))
+        logger.info('found %d edges in %.1f sec', edges,
+                    time.time() - start)
+
+        partitions = [aka.replica_list[i::workers] for i in range(workers)]
+        pool.map(_union_worker, [(replicas, edge_paths)
+                                 for replicas in partitions if replicas])
+        pool.close()
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        shutil.rmtree(tmpdir)
+    aka.sync()
+    logger.info('ingested %d records with %d workers in %.1f sec',
+                total, workers, time.time() - start)
+    return total
@@ -0,0 +1,101 @@
+'''Hard-selector inverted index for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+Finding the records that share an email, phone, skype or hostname with
+a record is an exact-match lookup, yet `AKAGraph.find_equivs` asks
+elasticsearch for each one with a search.  :class:`SelectorIndex`
+keeps a posting list of urls for every `(selector_type, value)` in a
+kvlayer table, e.g. on the ``filestorage`` or ``redis`` backends, so
+that the equivalents for a whole buffer of records are found without
+searching, and elasticsearch is only the system of record.
+
+Every posting is a key of its own, so writers only ever add or delete
+keys and never rewrite a list, and the `--workers` of a parallel
+ingest can share one index without losing each other's postings.
+
+'''
+from __future__ import absolute_import, division, print_function
+from itertools import islice
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+class SelectorIndex(object):
+    '''maps `(selector_type, value)` to the set of urls of the records
+    that have it, as keys `(selector_type, value, url)` of the kvlayer
+    table `TABLE`
+
+    :param kvl: kvlayer client
+
+    :param max_postings: read at most this many urls for any one
+    value, since values that popular carry no evidence and reading
+    all of their postings would dominate the cost of ingest
+
+    '''
+    TABLE = 'akagraph_selector_postings'
+
+    _kvlayer_namespace = {
+        # (selector_type, value, url) -> empty
+        TABLE: (str, str, str),
+    }
+
+    def __init__(self, kvl, max_postings=10000):
+        self.kvl = kvl
+        self.kvl.setup_namespace(self._kvlayer_namespace)
+        self.max_postings = max_postings
+
+    def key(self, pair):
+        selector_type, value = pair
+        return (utf8(selector_type), utf8(value))
+
+    def postings(self, records, selector_types):
+        '''get the keys of the postings of each of `records` for its values
+        of `selector_types`
+        '''
+        keys = set()
+        for rec in records:
+            for selector_type in selector_types:
+                for value in rec.get(selector_type) or []:
+                    if value:
+                        keys.add(self.key((selector_type, value))
+                                 + (utf8(rec['url']),))
+        return keys
+
+    def lookup(self, pairs, limit=None):
+        '''get a dict mapping each of `pairs` to the set of urls that
+        have it, with at most `limit` urls for each, by default
+        `max_postings`
+        '''
+        if limit is None:
+            limit = self.max_postings
+        found = {}
+        for pair in set(pairs):
+            key = self.key(pair)
+            found[pair] = {url.decode('utf-8') for _, _, url in islice(
+                self.kvl.scan_keys(self.TABLE, (key, key)), limit)}
+        return found
+
+    def add_records(self, records, selector_types):
+        '''add the url of each of `records` to the posting lists for its
+        values of `selector_types`
+        '''
+        keys = self.postings(records, selector_types)
+        if keys:
+            self.kvl.put(self.TABLE, *[(key, '') for key in keys])
+
+    def remove_records(self, records, selector_types):
+        '''remove the url of each of `records` from the posting lists for
+        its values of `selector_types`, e.g. because it was retracted
+        '''
+        keys = self.postings(records, selector_types)
+        if keys:
+            self.kvl.delete(self.TABLE, *keys)
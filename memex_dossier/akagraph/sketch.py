@@ -0,0 +1,81 @@
+'''Count-min sketch of selector popularity for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+A phone number or email that is in thousands of records carries no
+evidence that they are the same person, but `find_equivs` only learns
+that from the hits of a query for it.  :class:`CountMinSketch` counts
+how many records have each selector value in a fixed amount of memory,
+never undercounting, so that popular values can be skipped before any
+query is built.  Sketches add up cell by cell, so each writer can
+merge its new counts into the one sketch persisted for an index.
+
+'''
+from __future__ import absolute_import, division, print_function
+from array import array
+import base64
+from itertools import imap
+from operator import add
+import sys
+import zlib
+
+import mmh3
+
+COUNT_TYPE = 'I'
+
+
+class CountMinSketch(object):
+    '''`depth` rows of `width` counters; a key is counted in one cell of
+    each row, and its estimate is the smallest of those cells
+    '''
+    def __init__(self, width=2 ** 18, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array(COUNT_TYPE, [0]) * width for _ in range(depth)]
+        self.total = 0
+
+    def cells(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        for seed in range(self.depth):
+            yield seed, mmh3.hash(key, seed) % self.width
+
+    def add(self, key, count=1):
+        for row, cell in self.cells(key):
+            self.rows[row][cell] += count
+        self.total += count
+
+    def estimate(self, key):
+        return min(self.rows[row][cell] for row, cell in self.cells(key))
+
+    def update(self, other):
+        '''add the counts of `other`, which must have the same shape'''
+        assert (other.width, other.depth) == (self.width, self.depth)
+        self.rows = [array(COUNT_TYPE, imap(add, row, other_row))
+                     for row, other_row in zip(self.rows, other.rows)]
+        self.total += other.total
+
+    def to_source(self):
+        '''get a JSON-serializable dict for storing in elasticsearch'''
+        raw = b''.join(row.tostring() for row in self.rows)
+        return {
+            'width': self.width,
+            'depth': self.depth,
+            'total': self.total,
+            'byteorder': sys.byteorder,
+            'counts': base64.b64encode(zlib.compress(raw)),
+        }
+
+    @classmethod
+    def from_source(cls, source):
+        sketch = cls(source['width'], source['depth'])
+        counts = array(COUNT_TYPE)
+        counts.fromstring(zlib.decompress(base64.b64decode(source['counts'])))
+        if source['byteorder'] != sys.byteorder:
+            counts.byteswap()
+        for row in range(sketch.depth):
+            sketch.rows[row] = counts[row * sketch.width:
+                                      (row + 1) * sketch.width]
+        sketch.total = source['total']
+        return sketch
@@ -0,0 +1,198 @@
+'''Binary snapshots of :class:`~memex_dossier.akagraph.core.AKAGraph` indexes
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+A snapshot is a gzipped sequence of CBOR objects:
+
+ 1. a header, ``{"format": "akagraph-snapshot", "version": 1, ...}``;
+ 2. the forest of every replica, as
+    :meth:`~memex_dossier.akagraph.union_find.ArrayUnionFind.to_dict`
+    gives it: one interned table of urls and per-replica arrays of
+    parents, ranks and cardinalities;
+ 3. the popularity sketches, as ``{"sketches": [...]}``, which are
+    imported as one sketch;
+ 4. any number of ``{"records": [...]}`` chunks;
+ 5. a trailer, ``{"records": count, "sha256": digest}``, where
+    `digest` is of all the uncompressed bytes before the trailer.
+
+:func:`export_snapshot` writes one with two scans of the index, and
+:func:`import_snapshot` checks the digest and then restores it into an
+empty index with parallel bulk loads.  The unused `root_size` type is not included.
+
+'''
+from __future__ import absolute_import, division, print_function
+import gzip
+import hashlib
+import logging
+import time
+
+import cbor
+from elasticsearch.helpers import parallel_bulk, scan
+
+from .core import POPULARITY_ID, RECORD_TYPE, SKETCH_TYPE, \
+    UNION_FIND_TYPE
+from .sketch import CountMinSketch
+from .union_find import ArrayUnionFind
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 'akagraph-snapshot'
+FORMAT_VERSION = 1
+
+
+class HashingFile(object):
+    '''wraps a file to keep a sha256 of everything written or read'''
+    def __init__(self, fh):
+        self.fh = fh
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        self.fh.write(data)
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if 0 <= size != len(data):
+            # the C cbor decoder spins forever on a short read
+            raise EOFError
+        self.sha.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def export_snapshot(aka, path, chunk_size=1000):
+    '''write a snapshot of the index of `aka` to `path`
+
+    :returns: number of records written
+
+    '''
+    start = time.time()
+    forest = ArrayUnionFind(aka.replica_list)
+    forest.load_unions(aka.get_all_unions())
+    sketches = [item['_source'] for item in scan(
+        aka.conn, index=aka.index, doc_type=SKETCH_TYPE)]
+    count = 0
+    with gzip.open(path, 'wb') as raw:
+        fh = HashingFile(raw)
+        cbor.dump({
+            'format': FORMAT,
+            'version': FORMAT_VERSION,
+            'index': aka.index,
+            'created': time.time(),
+        }, fh)
+        cbor.dump(forest.to_dict(), fh)
+        cbor.dump({'sketches': sketches}, fh)
+        chunk = []
+        for item in scan(aka.conn, index=aka.index, doc_type=RECORD_TYPE):
+            chunk.append(item['_source'])
+            if len(chunk) >= chunk_size:
+                cbor.dump({'records': chunk}, fh)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            cbor.dump({'records': chunk}, fh)
+            count += len(chunk)
+        cbor.dump({'records': count, 'sha256': fh.hexdigest()}, raw)
+    logger.info('exported %d records and %d nodes to %s in %.1f sec',
+                count, len(forest), path, time.time() - start)
+    return count
+
+
+def iter_snapshot(path):
+    '''yield the objects in the snapshot at `path` after the header,
+    without the trailer, and raise ValueError if it is truncated or
+    does not match its checksum
+    '''
+    with gzip.open(path, 'rb') as raw:
+        fh = HashingFile(raw)
+        header = cbor.load(fh)
+        if header.get('format') != FORMAT or \
+                header.get('version') != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d akagraph snapshot'
+                             % (path, FORMAT_VERSION))
+        while True:
+            digest = fh.hexdigest()
+            try:
+                obj = cbor.load(fh)
+            except EOFError:
+                raise ValueError('%s is truncated' % path)
+            if 'sha256' in obj:
+                if obj['sha256'] != digest:
+                    raise ValueError('%s does not match its checksum'
+                                     % path)
+                return
+            yield obj
+
+
+def verify_snapshot(path):
+    '''check the checksum of the snapshot at `path`, raising ValueError
+    if it is bad
+    '''
+    for _ in iter_snapshot(path):
+        pass
+
+
+def import_snapshot(aka, path, thread_count=4):
+    '''load the snapshot at `path` into the index of `aka`, which is
+    created if needed; the snapshot is verified before anything is
+    written.  The index must not have any records or unions yet, since
+    those that are not in the snapshot would be left in its components.
+
+    :raises ValueError: if the snapshot is bad or the index is not empty
+
+    :returns: number of records loaded
+
+    '''
+    start = time.time()
+    verify_snapshot(path)
+    objs = iter_snapshot(path)
+    forest = ArrayUnionFind.from_dict(next(objs), path)
+    if forest.replica_list != list(aka.replica_list):
+        raise ValueError('%s has replicas %r, not %r'
+                         % (path, forest.replica_list, aka.replica_list))
+    sketches = next(objs)['sketches']
+    if not aka.conn.indices.exists(index=aka.index):
+        aka.create_index()
+    elif aka.conn.count(index=aka.index,
+                        doc_type=[RECORD_TYPE, UNION_FIND_TYPE])['count']:
+        raise ValueError('cannot import %s into %s, which is not empty'
+                         % (path, aka.index))
+    counter = {'records': 0}
+
+    def actions():
+        if sketches:
+            popularity = CountMinSketch.from_source(sketches[0])
+            for sketch in sketches[1:]:
+                popularity.update(CountMinSketch.from_source(sketch))
+            yield {
+                '_index': aka.index,
+                '_type': SKETCH_TYPE,
+                '_id': POPULARITY_ID,
+                '_op_type': 'index',
+                '_source': popularity.to_source(),
+            }
+        for obj in objs:
+            for rec in obj['records']:
+                counter['records'] += 1
+                yield {
+                    '_index': aka.index,
+                    '_type': RECORD_TYPE,
+                    '_id': rec['url'],
+                    '_op_type': 'index',
+                    '_source': rec,
+                }
+    for ok, item in parallel_bulk(aka.conn, actions(),
+                                  thread_count=thread_count,
+                                  timeout='60s', chunk_size=1000):
+        pass
+    union_find, aka.union_find = aka.union_find, forest
+    try:
+        aka.push_union_find(thread_count=thread_count)
+    finally:
+        aka.union_find = union_find
+    logger.info('imported %d records and %d nodes from %s in %.1f sec',
+                counter['records'], len(forest), path, time.time() - start)
+    return counter['records']
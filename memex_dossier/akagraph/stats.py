@@ -0,0 +1,117 @@
+'''Instrumentation for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+:class:`Metrics` holds the counters, timers and histograms behind
+`AKAGraph.stats`.  Methods are timed with the :func:`timed` decorator,
+and every elasticsearch request goes through
+:class:`InstrumentedElasticsearch`, so the number and cost of round
+trips can be read off without touching the call sites.
+
+'''
+from __future__ import absolute_import, division, print_function
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+
+class Metrics(object):
+    '''thread-safe counters, timers and histograms
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        # name -> [calls, seconds, max_seconds]
+        self.timers = defaultdict(lambda: [0, 0.0, 0.0])
+        self.histograms = defaultdict(Counter)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        '''add `value` to the histogram `name`'''
+        with self.lock:
+            self.histograms[name][value] += 1
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers[name]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.histograms.clear()
+
+    def to_dict(self):
+        '''get a JSON-serializable copy of everything recorded so far'''
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {
+                    name: {
+                        'calls': calls,
+                        'seconds': seconds,
+                        'mean_seconds': seconds / calls if calls else 0,
+                        'max_seconds': max_seconds,
+                    } for name, (calls, seconds, max_seconds)
+                    in self.timers.items()},
+                'histograms': {name: dict(histogram) for name, histogram
+                               in self.histograms.items()},
+            }
+
+
+def timed(name):
+    '''decorate a method of an object with a `metrics` attribute to time
+    every call under `name`
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedElasticsearch(object):
+    '''wraps an elasticsearch client, or its `indices` namespace, so that
+    every request is timed in `metrics` under ``es.<method>``; all
+    other attributes are those of `client`
+    '''
+    def __init__(self, client, metrics, prefix='es.'):
+        self.client = client
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name == 'indices':
+            return InstrumentedElasticsearch(attr, self.metrics,
+                                             self.prefix + 'indices.')
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def request(*args, **kwargs):
+            with self.metrics.timer(self.prefix + name):
+                result = attr(*args, **kwargs)
+            if name == 'bulk':
+                self.metrics.count('docs_written',
+                                   len(result.get('items') or []))
+            return result
+        return request
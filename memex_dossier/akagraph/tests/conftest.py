@@ -0,0 +1,57 @@
+'''fixtures shared by the `akagraph` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+from hashlib import md5
+import os
+
+import kvlayer
+import pytest
+
+import memex_dossier.akagraph.core as core
+
+
+@pytest.yield_fixture(scope='function')
+def unique_index_name():
+    yield 'test_' + md5(repr(os.urandom(10))).hexdigest()
+
+
+@pytest.yield_fixture
+def kvl():
+    client = kvlayer.client(config={
+        'storage_type': 'local',
+        'app_name': 'diffeo',
+        'namespace': 'memex_dossier.akagraph.tests',
+    })
+    yield client
+    client.delete_namespace()
+    client.close()
+
+
+@pytest.yield_fixture
+def make_graph(elastic_address):
+    '''factory for `AKAGraph`s on fresh indexes, which are deleted after
+    the test; keyword arguments override the defaults of 5 replicas,
+    soft selectors scored by length and no downweighting
+    '''
+    graphs = []
+
+    def make(**kwargs):
+        settings = dict(
+            replicas=5,
+            hyper_edge_scorer=(lambda s: max(0, .5 - 1.0 / len(s))),
+            num_identifier_downweight=0,
+            popular_identifier_downweight=0,
+        )
+        settings.update(kwargs)
+        aka = core.AKAGraph(
+            elastic_address,
+            'test_' + md5(repr(os.urandom(10))).hexdigest(),
+            **settings)
+        graphs.append(aka)
+        return aka
+    yield make
+    for aka in graphs:
+        aka.delete_index()
@@ -0,0 +1,103 @@
+'''`akagraph.union_find` tests for the in-process union-find backend
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from memex_dossier.akagraph.union_find import ArrayUnionFind
+
+
+@pytest.fixture
+def uf():
+    uf = ArrayUnionFind(3)
+    uf.union(0, 'a', 'b')
+    uf.union(0, 'c', 'd')
+    uf.union(0, 'b', 'd', 'e')
+    uf.union(1, 'a', 'e')
+    return uf
+
+
+def test_components(uf):
+    assert set(uf.members(0, 'a')) == set('abcde')
+    assert set(uf.members(1, 'a')) == set('ae')
+    assert set(uf.members(1, 'b')) == set('b')
+    assert set(uf.members(2, 'c')) == set('c')
+    assert set(uf.members(0, 'unknown')) == {'unknown'}
+
+
+def test_roots_and_ranks(uf):
+    root, rank, cardinality = uf.get_root(0, 'e')
+    assert cardinality == 5
+    assert rank == 3
+    assert uf.get_parent(0, root) is None
+    assert all(uf.get_root(0, name)[0] == root for name in 'abcde')
+    assert uf.get_root(2, 'a') == ('a', 1, 1)
+
+
+def test_children(uf):
+    root, _, _ = uf.get_root(0, 'a')
+    children = set(uf.get_children(0, root))
+    assert children
+    for child in children:
+        assert uf.get_parent(0, child) == root
+
+
+def test_load_unions(uf):
+    docs = []
+    for replica, name, parent, rank, cardinality in uf.iter_nodes():
+        doc = {'child': [name, '%d://%s' % (replica, name)],
+               'replica': replica}
+        if parent is None:
+            doc.update(rank=rank, cardinality=cardinality)
+        else:
+            doc['parent'] = [parent, '%d://%s' % (replica, parent)]
+        docs.append(doc)
+    other = ArrayUnionFind(3)
+    other.load_unions(docs)
+    for replica in range(3):
+        for name in 'abcde':
+            assert other.get_root(replica, name) == uf.get_root(replica, name)
+            assert set(other.members(replica, name)) == \
+                set(uf.members(replica, name))
+
+
+def test_save_and_load(uf, tmpdir):
+    path = str(tmpdir.join('uf.cbor.gz'))
+    uf.save(path)
+    loaded = ArrayUnionFind.load(path)
+    assert len(loaded) == len(uf)
+    for replica in range(3):
+        for name in 'abcde':
+            assert loaded.get_root(replica, name) == \
+                uf.get_root(replica, name)
+            assert set(loaded.members(replica, name)) == \
+                set(uf.members(replica, name))
+            assert loaded.get_generation(replica, name) == \
+                uf.get_generation(replica, name)
+    loaded.union(1, 'b', 'c')
+    assert set(loaded.members(1, 'b')) == set('bc')
+
+
+def test_replica_subset(uf, tmpdir):
+    docs = []
+    for replica, name, parent, rank, cardinality in uf.iter_nodes():
+        doc = {'child': [name, '%d://%s' % (replica, name)],
+               'replica': replica}
+        if parent is None:
+            doc.update(rank=rank, cardinality=cardinality)
+        else:
+            doc['parent'] = [parent, '%d://%s' % (replica, parent)]
+        docs.append(doc)
+    other = ArrayUnionFind([1, 2])
+    other.load_unions(docs)
+    assert set(other.members(1, 'a')) == set('ae')
+    assert set(other.members(2, 'a')) == set('a')
+    assert {replica for replica, _, _, _, _ in other.iter_nodes()} == {1}
+    with pytest.raises(KeyError):
+        other.get_root(0, 'a')
+    path = str(tmpdir.join('uf.cbor.gz'))
+    other.save(path)
+    assert ArrayUnionFind.load(path).replica_list == [1, 2]
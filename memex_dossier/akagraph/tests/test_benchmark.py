@@ -0,0 +1,48 @@
+'''`akagraph.benchmark` and `akagraph.fake_es` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+
+import memex_dossier.akagraph.core as core
+from memex_dossier.akagraph.benchmark import make_records, run_benchmark
+from memex_dossier.akagraph.fake_es import FakeElasticsearch, fixed_latency
+from memex_dossier.akagraph.tests.test_union_find import fake_data, truth_cc
+
+
+def test_fake_counts_requests():
+    es = FakeElasticsearch(latency=fixed_latency(0, bulk=0))
+    aka = core.AKAGraph(
+        index_name='test_fake', conn=es, replicas=3,
+        hyper_edge_scorer=(lambda s: max(0, .5 - 1.0 / len(s))),
+        mget_chunk_size=2, record_cache_size=0,
+    )
+    with aka:
+        for rec in fake_data:
+            aka.add(rec)
+    assert es.calls['bulk'] > 0
+    assert es.docs_written >= len(fake_data)
+    assert sorted(aka.get_all_urls()) == sorted(truth_cc)
+    es.reset_counts()
+    assert len(list(aka.get_recs('a', 'b', 'c'))) == 3
+    assert es.calls == {'mget': 2}
+    assert es.round_trips == 2
+
+
+def test_make_records():
+    flat = list(make_records(100, skew=0))
+    skewed = list(make_records(100, skew=2))
+    assert len(flat) == len(skewed) == 100
+    def distinct(records):
+        return len({v for rec in records for v in rec['email']})
+    assert distinct(skewed) < distinct(flat)
+
+
+def test_run_benchmark():
+    report = run_benchmark(size=50, lookups=6, unites=5, replicas=2)
+    for name in ['add', 'unite', 'find_connected_component']:
+        assert report[name]['calls'] > 0
+        assert abs(report[name]['calls'] -
+                   sum(report[name]['by_request'].values())) < 1e-9
+    assert report['graph']['size'] == 50
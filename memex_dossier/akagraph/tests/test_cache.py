@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''`akagraph.cache` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+
+from memex_dossier.akagraph.cache import LRUCache, ComponentCache, \
+    ScoreCache
+
+
+def test_lru_cache():
+    evicted = []
+    cache = LRUCache(2, on_evict=lambda k, v: evicted.append(k))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert evicted == ['b']
+    assert cache.get('b') is None
+    assert cache.keys() == ['a', 'c']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('memex_dossier.akagraph.cache.time.time',
+                        lambda: now[0])
+    cache = LRUCache(2, ttl=10)
+    cache.put('a', 1)
+    now[0] += 5
+    assert cache.get('a') == 1
+    now[0] += 5
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    cache.put('a', 2)
+    assert cache.get('a') == 2
+
+
+def test_component_cache_spill(kvl):
+    cache = ComponentCache(size=1, kvl=kvl)
+    entry = {'roots': [['0://a', 1, 2]], 'results': [[{'url': 'a'}, 1.0]]}
+    cache.put(('a', True, 0, None), entry)
+    cache.put(('b', True, 0, None), entry)
+    assert len(cache) == 1
+    # spilled to kvlayer and read back
+    assert cache.get(('a', True, 0, None)) == entry
+    cache.discard_selectors(['a', 'b'])
+    assert cache.get(('a', True, 0, None)) is None
+    assert cache.get(('b', True, 0, None)) is None
+
+
+def test_score_cache(kvl):
+    scored = []
+    def scorer(value):
+        scored.append(value)
+        return len(value) / 10
+
+    cache = ScoreCache(version='len/1', kvl=kvl)
+    values = [u'ab', u'кс', u'abcd']
+    assert cache.score_all(values, scorer) == \
+        {u'ab': .2, u'кс': .2, u'abcd': .4}
+    assert cache.score_all(values, scorer)[u'abcd'] == .4
+    assert sorted(scored) == sorted(values)
+
+    # another instance shares the scores through kvlayer
+    other = ScoreCache(version='len/1', kvl=kvl)
+    assert other.score_all(values, scorer) == \
+        {u'ab': .2, u'кс': .2, u'abcd': .4}
+    assert len(scored) == 3
+
+    # but not with another version of the scorer
+    ScoreCache(version='len/2', kvl=kvl).score_all([u'ab'], scorer)
+    assert len(scored) == 4
@@ -0,0 +1,57 @@
+'''`akagraph.lsh` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+
+from memex_dossier.akagraph.lsh import UsernameLSH
+
+records = [
+    {'url': u'a', 'username': [u'john_smith88']},
+    {'url': u'b', 'username': [u'johnsmith_88']},
+    {'url': u'c', 'username': [u'JohnSmith88', u'quietriver']},
+    {'url': u'd', 'username': [u'bluebird']},
+]
+
+
+def test_find_similar(kvl):
+    lsh = UsernameLSH(kvl)
+    lsh.add_records(records)
+    similar = lsh.find_similar([u'john_smith88', u'bluebird', u'nobody'])
+    assert [(other, urls) for other, _, urls
+            in similar[u'john_smith88']] == [
+        (u'JohnSmith88', {u'c'}),
+        (u'johnsmith_88', {u'b'}),
+    ]
+    assert similar[u'bluebird'] == []
+    assert similar[u'nobody'] == []
+
+
+def test_remove_records(kvl):
+    lsh = UsernameLSH(kvl)
+    lsh.add_records(records)
+    lsh.remove_records([rec for rec in records if rec['url'] == u'b'])
+    similar = lsh.find_similar([u'john_smith88'])
+    assert [other for other, _, _ in similar[u'john_smith88']] == \
+        [u'JohnSmith88']
+
+
+def test_find_equivs_fuzzy(make_graph, kvl):
+    aka = make_graph(
+        hyper_edge_scorer=(lambda s: .8),
+        username_lsh=UsernameLSH(kvl, comparison=lambda a, b: .5),
+    )
+    with aka:
+        for rec in records:
+            aka.add(rec, analyze_and_union=False)
+    fuzzy = sorted((rec['url'], score, reason, sorted(equivs))
+                   for rec, score, reason, equivs
+                   in aka.find_equivs(records[:2])
+                   if u'~' in reason)
+    assert fuzzy == [
+        (u'a', .4, u'JohnSmith88~john_smith88', [u'c']),
+        (u'a', .4, u'john_smith88~johnsmith_88', [u'b']),
+        (u'b', .4, u'JohnSmith88~johnsmith_88', [u'c']),
+        (u'b', .4, u'john_smith88~johnsmith_88', [u'a']),
+    ]
@@ -0,0 +1,55 @@
+'''`akagraph.pairs` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+import itertools
+
+import pytest
+
+from memex_dossier.akagraph.benchmark import make_records
+from memex_dossier.akagraph.pairs import blocking_keys, make_pairs
+
+
+def test_blocking_keys():
+    assert blocking_keys({
+        'url': 'a',
+        'phone': [u'+1 (555) 123-4567', u'911'],
+        'email': [u'Bob.Smith@Mail.com'],
+        'username': [u'bob'],
+    }) == {
+        u'phone:5551234567',
+        u'email:bob.smith@mail.com',
+        u'username:bob.', u'username:ob.s', u'username:b.sm',
+        u'username:.smi', u'username:smit', u'username:mith',
+        u'username:bob',
+    }
+
+
+def brute_force_pairs(records, block_cap):
+    keys = {rec['url']: blocking_keys(rec) for rec in records}
+    counts = {}
+    for rec_keys in keys.values():
+        for key in rec_keys:
+            counts[key] = counts.get(key, 0) + 1
+    pairs = set()
+    for url_a, url_b in itertools.combinations(sorted(keys), 2):
+        shared = {key for key in keys[url_a] & keys[url_b]
+                  if counts[key] <= block_cap}
+        if shared:
+            pairs.add((url_a, url_b, min(shared)))
+    return pairs
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_make_pairs(workers, tmpdir):
+    records = list(make_records(300, skew=1.2))
+    expected = brute_force_pairs(records, block_cap=20)
+    assert expected
+    found = list(make_pairs(records, block_cap=20, workers=workers,
+                            tmpdir=str(tmpdir)))
+    assert len(found) == len(set(found))
+    assert set(found) == expected
+    # the spool is cleaned up
+    assert tmpdir.listdir() == []
@@ -0,0 +1,73 @@
+'''`akagraph.parallel` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+import cbor
+import pytest
+
+import memex_dossier.akagraph.core as core
+from memex_dossier.akagraph.parallel import parallel_ingest
+from memex_dossier.akagraph.tests.test_union_find import fake_data
+
+@pytest.yield_fixture(scope='function')
+def record_paths(tmpdir):
+    paths = []
+    for i in range(3):
+        path = str(tmpdir.join('recs-%d.cbor' % i))
+        with open(path, 'wb') as fh:
+            for rec in fake_data[i::3]:
+                cbor.dump(rec, fh)
+        paths.append(path)
+    yield paths
+
+
+def components(aka, records=fake_data):
+    return {rec['url']: sorted((other['url'], count) for other, count
+                               in aka.find_connected_component(rec['url']))
+            for rec in records}
+
+
+def test_parallel_ingest_matches_serial(make_graph, record_paths):
+    serial = make_graph()
+    with serial:
+        for path in record_paths:
+            for rec in core.load_records(path):
+                serial.add(rec)
+    parallel = make_graph()
+    count = parallel_ingest(parallel, record_paths, workers=2,
+                            chunk_size=2, threads=True)
+    assert count == len(fake_data)
+    assert components(parallel) == components(serial)
+
+
+def test_parallel_ingest_matches_serial_downweighted(make_graph, tmpdir):
+    # pairs that share an email but not a phone, so that each end of
+    # an edge makes a different query for it
+    records = []
+    for i in range(20):
+        for end in 'xy':
+            records.append({
+                u'url': u'%s%d' % (end, i),
+                u'email': [u'%d@mail.com' % i],
+                u'phone': [u'%s%d' % (end, i)],
+            })
+    paths = []
+    for i in range(2):
+        path = str(tmpdir.join('recs-%d.cbor' % i))
+        with open(path, 'wb') as fh:
+            for rec in records[i::2]:
+                cbor.dump(rec, fh)
+        paths.append(path)
+    # one record at a time, so that serial ingest finds each edge only
+    # from its later end, where parallel ingest finds it from both
+    serial = make_graph(num_identifier_downweight=0.3,
+                        buffer_size=1)
+    with serial:
+        for path in paths:
+            for rec in core.load_records(path):
+                serial.add(rec)
+    parallel = make_graph(num_identifier_downweight=0.3)
+    parallel_ingest(parallel, paths, workers=2, chunk_size=4, threads=True)
+    assert components(parallel, records) == components(serial, records)
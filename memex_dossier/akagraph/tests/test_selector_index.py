@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''`akagraph.selector_index` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+
+import memex_dossier.akagraph.core as core
+from memex_dossier.akagraph.selector_index import SelectorIndex
+from memex_dossier.akagraph.tests.test_union_find import fake_data
+
+
+def test_lookup(kvl):
+    index = SelectorIndex(kvl, max_postings=2)
+    index.add_records(fake_data, ['skype', 'name'])
+    index.add_records([{'url': u'd', 'name': [u'x']}], ['name'])
+    found = index.lookup([('skype', u'skype1'), ('name', u'x'),
+                          ('name', u'кс'), ('email', u'foo@mail.com')])
+    assert found == {
+        ('skype', u'skype1'): {'b', 'c'},
+        # full posting lists are left alone
+        ('name', u'x'): {'c', 'c2'},
+        ('name', u'кс'): {'b', 'b2'},
+        ('email', u'foo@mail.com'): set(),
+    }
+
+
+def test_remove_records(kvl):
+    index = SelectorIndex(kvl)
+    index.add_records(fake_data, ['skype'])
+    index.remove_records([fake_data[1]], ['skype'])
+    assert index.lookup([('skype', u'skype1'), ('skype', u'skype2')]) == {
+        ('skype', u'skype1'): {'c'},
+        ('skype', u'skype2'): {'b2', 'c2'},
+    }
+
+
+def test_find_equivs_from_index(make_graph, kvl):
+    searched = make_graph()
+    indexed = make_graph(selector_index=SelectorIndex(kvl))
+    for aka in [searched, indexed]:
+        with aka:
+            for rec in fake_data:
+                aka.add(rec, analyze_and_union=False)
+    def edges(aka):
+        return sorted((rec['url'], score, reason, sorted(equivs))
+                      for rec, score, reason, equivs
+                      in aka.find_equivs(fake_data))
+    assert edges(indexed) == edges(searched)
+
+
+def test_find_equivs_capped(make_graph, kvl):
+    searched = make_graph()
+    indexed = make_graph(selector_index=SelectorIndex(kvl))
+    records = [{'url': u'r%d' % i, 'phone': [u'555']} for i in range(15)]
+    for aka in [searched, indexed]:
+        aka.num_identifier_downweight = .1
+        aka.popular_identifier_downweight = .1
+        with aka:
+            for rec in records:
+                aka.add(rec, analyze_and_union=False)
+
+    def edges(aka):
+        return sorted((rec['url'], score, len(equivs))
+                      for rec, score, _, equivs
+                      in aka.find_equivs(records))
+    # as many urls as a search returns, so the same scores
+    assert edges(indexed) == edges(searched)
+    assert all(count == core.SEARCH_HITS
+               for _, _, count in edges(indexed))
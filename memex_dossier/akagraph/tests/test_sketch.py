@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+'''`akagraph.sketch` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+from collections import Counter
+import random
+
+from memex_dossier.akagraph.sketch import CountMinSketch
+
+
+def test_estimates_never_undercount():
+    rand = random.Random(0)
+    truth = Counter(u'value-%d' % int(rand.paretovariate(1))
+                    for _ in range(5000))
+    sketch = CountMinSketch(width=256, depth=4)
+    for key, count in truth.iteritems():
+        sketch.add(key, count)
+    assert sketch.total == 5000
+    for key, count in truth.iteritems():
+        assert sketch.estimate(key) >= count
+    assert sketch.estimate(u'value-1') < truth[u'value-1'] * 1.1
+
+
+def test_update_and_round_trip():
+    one = CountMinSketch(width=64, depth=3)
+    two = CountMinSketch(width=64, depth=3)
+    one.add('a', 3)
+    two.add('a', 2)
+    two.add(u'кс'.encode('utf-8'))
+    one.update(two)
+    assert one.estimate('a') >= 5
+    assert one.total == 6
+    copy = CountMinSketch.from_source(one.to_source())
+    assert copy.rows == one.rows
+    assert copy.total == 6
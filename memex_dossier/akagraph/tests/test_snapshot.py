@@ -0,0 +1,66 @@
+'''`akagraph.snapshot` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+import gzip
+
+import pytest
+
+from memex_dossier.akagraph.snapshot import export_snapshot, \
+    import_snapshot, verify_snapshot
+from memex_dossier.akagraph.tests.test_union_find import fake_data
+
+
+def components(aka):
+    return {rec['url']: sorted(aka.connected_component(rec['url']))
+            for rec in fake_data}
+
+
+def test_export_and_import(make_graph, tmpdir):
+    path = str(tmpdir.join('graph.snapshot'))
+    source = make_graph(popular_threshold=10)
+    target = make_graph(popular_threshold=10)
+    with source:
+        for rec in fake_data:
+            source.add(rec)
+    assert export_snapshot(source, path, chunk_size=4) == len(fake_data)
+    assert import_snapshot(target, path) == len(fake_data)
+    target.sync()
+    assert sorted(target.get_all_urls()) == \
+        sorted(rec['url'] for rec in fake_data)
+    assert list(target.get_recs('b')) == list(source.get_recs('b'))
+    assert components(target) == components(source)
+    assert target.is_popular('skype', u'skype1') == \
+        source.is_popular('skype', u'skype1')
+    # roots keep their generations
+    def generations(aka):
+        return {(int(doc['replica']), doc['child'][0]):
+                doc.get('generation')
+                for doc in aka.get_all_unions() if 'parent' not in doc}
+    assert generations(target) == generations(source)
+    assert any(generations(target).values())
+    # and nothing is imported over what the index already has
+    with pytest.raises(ValueError):
+        import_snapshot(target, path)
+
+
+def test_corrupt_snapshot(make_graph, tmpdir):
+    path = str(tmpdir.join('graph.snapshot'))
+    source = make_graph(popular_threshold=10)
+    with source:
+        for rec in fake_data:
+            source.add(rec)
+    export_snapshot(source, path)
+    verify_snapshot(path)
+    with gzip.open(path) as fh:
+        data = fh.read()
+    with gzip.open(path, 'wb') as fh:
+        fh.write(data.replace('skype1', 'skype9'))
+    with pytest.raises(ValueError):
+        verify_snapshot(path)
+    with gzip.open(path, 'wb') as fh:
+        fh.write(data[:len(data) // 2])
+    with pytest.raises(ValueError):
+        verify_snapshot(path)
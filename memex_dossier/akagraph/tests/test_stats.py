@@ -0,0 +1,49 @@
+'''`akagraph.stats` tests
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+'''
+from __future__ import absolute_import, division, print_function
+import json
+
+from memex_dossier.akagraph.stats import Metrics
+from memex_dossier.akagraph.tests.test_union_find import fake_data
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.count('things')
+    metrics.count('things', 2)
+    metrics.observe('depth', 1)
+    metrics.observe('depth', 1)
+    metrics.add_time('op', 1.0)
+    metrics.add_time('op', 3.0)
+    assert metrics.to_dict() == {
+        'counters': {'things': 3},
+        'timers': {'op': {'calls': 2, 'seconds': 4.0, 'mean_seconds': 2.0,
+                          'max_seconds': 3.0}},
+        'histograms': {'depth': {1: 2}},
+    }
+    metrics.clear()
+    assert metrics.to_dict() == {
+        'counters': {}, 'timers': {}, 'histograms': {}}
+
+
+def test_graph_stats(make_graph):
+    aka = make_graph()
+    with aka:
+        for rec in fake_data:
+            aka.add(rec)
+    list(aka.get_recs('a', 'b'))
+    list(aka.get_recs('a'))
+    stats = aka.stats()
+    json.dumps(stats)
+    assert stats['counters']['records_added'] == len(fake_data)
+    assert stats['counters']['docs_written'] >= len(fake_data)
+    for name in ['flush_records', 'sync', 'msearch', 'get_roots',
+                 'es.bulk', 'es.msearch', 'es.mget',
+                 'es.indices.refresh']:
+        assert stats['timers'][name]['calls'] > 0, name
+    assert sum(stats['histograms']['tree_depth'].values()) > 0
+    assert stats['caches']['records']['hit_rate'] > 0
+    assert stats['search']['searches'] > 0
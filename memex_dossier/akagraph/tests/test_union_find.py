@@ -6,12 +6,14 @@
 '''
 
 from __future__ import absolute_import
-from hashlib import md5
-import os
+import json
+from StringIO import StringIO
 import pytest
 import itertools
 
 import memex_dossier.akagraph.core as core
+from memex_dossier.akagraph.cache import ComponentCache
+from memex_dossier.akagraph.union_find import ArrayUnionFind
 
 # data has two connected components, to verify that they do not get
 # merged accidentally (or with soft selectors that they get merged the right amount)
@@ -85,10 +87,6 @@ def is_soft_fake_data(s):
                 is_soft = is_only_soft
     return is_soft
 
-@pytest.yield_fixture(scope='function')
-def unique_index_name():
-    yield 'test_' + md5(repr(os.urandom(10))).hexdigest()
-
 @pytest.yield_fixture(scope='function')
 def populated_akagraph(unique_index_name, elastic_address):
     """ constructs an AKAGraph without any probabilistic connections
@@ -146,6 +144,36 @@ def test_find_equivs(populated_akagraph, record):
         if score == 1.0:
             assert equivs == correct_hard_equivs[record['url']]
 
+def test_find_equivs_retries_rejected_searches(populated_akagraph):
+    aka = populated_akagraph
+    aka.msearch_chunk_size = 2
+    aka.msearch_backoff = 0
+    expected = sorted((rec['url'], score, sorted(equivs))
+                      for rec, score, _, equivs in aka.find_equivs(fake_data))
+    msearch = aka.conn.msearch
+    sent = []
+
+    def flaky_msearch(body):
+        res = msearch(body=body)
+        sent.append(len(body) // 2)
+        if len(sent) % 2:
+            # the search queue fills up on every other request
+            res['responses'][0] = {'error': 'EsRejectedExecutionException'
+                                   '[rejected execution (queue capacity '
+                                   '1000) on ...]'}
+        return res
+    aka.conn.msearch = flaky_msearch
+    try:
+        observed = sorted((rec['url'], score, sorted(equivs))
+                          for rec, score, _, equivs
+                          in aka.find_equivs(fake_data))
+    finally:
+        aka.conn.msearch = msearch
+    assert observed == expected
+    assert max(sent) <= 2
+    assert aka.search_stats['retried'] > 0
+    assert aka.search_stats['failed'] == 0
+
 def test_roots(populated_akagraph, record):
     observed_component = [url for url, count in populated_akagraph.connected_component(record['url'])]
     assert set(observed_component) == truth_cc[record['url']]
@@ -181,6 +209,154 @@ def test_get_all_roots(populated_akagraph):
 def test_connected_component(populated_akagraph):
     assert set('abc') == set([url for url, count in populated_akagraph.connected_component('a')])
 
+def test_probability(soft_akagraph):
+    aka = soft_akagraph
+    counts = dict(aka.connected_component('a'))
+    pairs = [('a', url) for url in sorted(counts)] + [('a', 'nothing')]
+    expected = [counts[url] / float(replica_count) for _, url in pairs[:-1]] + [0]
+    assert aka.probabilities(pairs) == expected
+    for url in counts:
+        assert aka.probability(url, 'a') == \
+            counts[url] / float(replica_count)
+
+def test_write_clusters(soft_akagraph):
+    fh = StringIO()
+    stats = soft_akagraph.write_clusters(fh, batch_size=2)
+    clusters = [json.loads(line) for line in fh.getvalue().splitlines()]
+    assert stats['clusters'] == len(clusters) > 0
+    assert sum(stats['histogram'].values()) == len(clusters)
+    assert stats['largest'] == max(c['count'] for c in clusters)
+    seen = set()
+    for cluster in clusters:
+        assert cluster['count'] == len(cluster['urls']) >= 2
+        assert not seen.intersection(cluster['urls'])
+        seen.update(cluster['urls'])
+        roots = soft_akagraph.get_roots(
+            [core.AKANode(url, 0) for url in cluster['urls']])
+        assert len({root.name for root in roots}) == 1
+        recs = list(soft_akagraph.get_recs(*cluster['urls']))
+        assert cluster['overlaps'] == \
+            json.loads(json.dumps(core.find_overlaps(recs)))
+    # the limit counts records, as --limit does
+    fh = StringIO()
+    soft_akagraph.write_clusters(fh, limit=2)
+    sizes = [json.loads(line)['count'] for line in fh.getvalue().splitlines()]
+    assert sum(sizes[:-1]) < 2 <= sum(sizes)
+
+def test_component_cache(soft_akagraph):
+    aka = soft_akagraph
+    aka.component_cache = ComponentCache()
+    expected = list(aka.find_connected_component('b'))
+    assert len(aka.component_cache) == 1
+
+    search = aka.conn.search
+    def no_search(*args, **kwargs):
+        raise AssertionError('should have been served from the cache')
+    aka.conn.search = no_search
+    try:
+        assert list(aka.find_connected_component('b')) == expected
+    finally:
+        aka.conn.search = search
+
+    # uniting anything into one of its roots bumps its generation
+    with aka:
+        aka.unite(*[core.AKANode(url, 0) for url in ['b', 'a']])
+    root = aka.get_root(core.AKANode('b', 0))
+    assert root.generation > 0
+    entry = aka.component_cache.get(('b', True, 0, None, None, None, None))
+    assert not aka.roots_unchanged(entry['roots'])
+    observed = list(aka.find_connected_component('b'))
+    assert 'a' in {rec['url'] for rec, _ in observed}
+
+    # a selector that matches nothing yet is not cached, so records
+    # added by another writer are seen
+    assert list(aka.find_connected_component(u'new@mail.com')) == []
+    other = core.AKAGraph(index_name=aka.index, conn=aka.conn.client,
+                          replicas=replica_count,
+                          hyper_edge_scorer=(lambda x: 0))
+    with other:
+        for url in [u'new1', u'new2']:
+            other.add({u'url': url, u'email': [u'new@mail.com']})
+    assert sorted(rec['url'] for rec, _ in aka.find_connected_component(
+        u'new@mail.com')) == ['new1', 'new2']
+
+def test_iter_recs(populated_akagraph):
+    aka = populated_akagraph
+    aka.mget_chunk_size = 2
+    urls = ['c2', 'a', 'missing', 'b', 'a', 'c']
+    recs = list(aka.iter_recs(urls))
+    assert [rec['url'] for rec in recs] == urls
+    assert recs[1] == fake_data[0]
+    assert recs[2] == {'url': 'missing'}
+
+    # whole records are now cached, and projected from the cache
+    mget = aka.conn.mget
+    def no_mget(*args, **kwargs):
+        raise AssertionError('should have been served from the cache')
+    aka.conn.mget = no_mget
+    try:
+        recs = list(aka.iter_recs(['a', 'b'], fields=['email']))
+    finally:
+        aka.conn.mget = mget
+    assert recs == [{'url': 'a', 'email': [u'foo@mail.com']}, {'url': 'b'}]
+
+    aka.record_cache.clear()
+    recs = list(aka.iter_recs(['a', 'b'], fields=['email']))
+    assert recs == [{'url': 'a', 'email': [u'foo@mail.com']}, {'url': 'b'}]
+    assert len(aka.record_cache) == 0
+
+def test_popular_selectors(unique_index_name, elastic_address):
+    def make_graph():
+        return core.AKAGraph(
+            elastic_address, unique_index_name,
+            hyper_edge_scorer=(lambda x: 0), popular_threshold=1)
+    aka = make_graph()
+    try:
+        with aka:
+            for data in fake_data:
+                aka.add(data, analyze_and_union=False)
+        assert aka.is_popular('skype', u'skype1')
+        assert not aka.is_popular('email', u'foo@mail.com')
+        # skype1 is the only thing b and c have in common
+        assert list(aka.find_equivs([fake_data[1]])) == []
+
+        # other writers see the persisted counts
+        other = make_graph()
+        assert other.is_popular('skype', u'skype1')
+        assert other.get_popularity().total == aka.get_popularity().total
+    finally:
+        aka.delete_index()
+
+def test_popularity_one_sketch(unique_index_name, elastic_address):
+    def make_graph():
+        return core.AKAGraph(
+            elastic_address, unique_index_name,
+            hyper_edge_scorer=(lambda x: 0), popular_threshold=10)
+    aka = make_graph()
+    try:
+        writers = [make_graph() for _ in range(2)]
+        for writer in writers:
+            with writer:
+                for data in fake_data:
+                    writer.add(data, analyze_and_union=False)
+        # a sketch left by a writer that saved its own counts is folded in
+        legacy = core.CountMinSketch()
+        legacy.add(core.popularity_key('skype', u'skype1'))
+        core.bulk(aka.conn, [{
+            '_index': aka.index, '_type': core.SKETCH_TYPE, '_id': 'legacy',
+            '_op_type': 'index', '_source': legacy.to_source()}])
+        aka.conn.indices.refresh(index=aka.index)
+        assert aka.get_popularity().estimate(
+            core.popularity_key('skype', u'skype1')) == 5
+        aka.conn.indices.refresh(index=aka.index)
+        ids = [item['_id'] for item in core.scan(
+            aka.conn, index=aka.index, doc_type=core.SKETCH_TYPE)]
+        assert ids == [core.POPULARITY_ID]
+        assert make_graph().get_popularity().total == \
+            aka.get_popularity().total
+    finally:
+        aka.delete_index()
+
 #def test_find_perf(populated_akagraph, record):
 #    equivs = list(populated_akagraph.find_equivs(record))
 #    assert len(equivs) > 0
@@ -214,6 +390,34 @@ def test_unite(populated_akagraph):
         for node in nodes:
             assert root == populated_akagraph.get_root(node)
 
+def test_get_roots(soft_akagraph):
+    nodes = [core.AKANode(rec['url'], replica)
+             for rec in fake_data
+             for replica in soft_akagraph.replica_list]
+    roots = soft_akagraph.get_roots(nodes)
+    assert len(roots) == len(nodes)
+    for node, root in zip(nodes, roots):
+        assert root == soft_akagraph.get_root(node)
+        assert root.cardinality >= 1
+
+def test_unite_all(populated_akagraph):
+    aka = populated_akagraph
+    groups = [[core.AKANode(url, replica) for url in ['a', 'a2', 'c2']]
+              for replica in aka.replica_list]
+    new_roots = aka.unite_all(groups)
+    assert len(new_roots) == len(groups)
+    # nothing has been sent yet, but the overlay already sees the unions
+    assert aka.union_buffer
+    for group, root in zip(groups, new_roots):
+        for node in group:
+            assert aka.get_root(node) == root
+    aka.flush_unions()
+    aka.sync()
+    assert not aka.union_buffer
+    for group, root in zip(groups, new_roots):
+        for node in group:
+            assert aka.get_root(node) == root
+
 @pytest.mark.xfail
 def test_find(populated_akagraph, record):
     # verify that ingest actually found and united the three; requires
@@ -375,3 +579,377 @@ def test_add_edge(soft_akagraph):
 
     counts_h = get_counts('h')
     assert not counts_h
+
+@pytest.yield_fixture(scope='function')
+def array_akagraph(unique_index_name, elastic_address):
+    '''constructs an AKAGraph that keeps its forest in an ArrayUnionFind
+    '''
+    client = core.AKAGraph(
+        elastic_address,
+        unique_index_name,
+        replicas=replica_count,
+        hyper_edge_scorer=(lambda x: 0),
+        union_find=ArrayUnionFind(replica_count),
+    )
+    yield client
+    client.delete_index()
+
+def test_array_union_find_push(array_akagraph):
+    with array_akagraph:
+        array_akagraph.add_edge(['a', 'b'], 1)
+        array_akagraph.add_edge(['b', 'c'], 1)
+        array_akagraph.add_edge(['d', 'e'], 1)
+    expected = dict(array_akagraph.connected_component('a'))
+    assert expected == {'a': replica_count, 'b': replica_count,
+                        'c': replica_count}
+
+    array_akagraph.push_union_find()
+    array_akagraph.union_find = None
+    assert dict(array_akagraph.connected_component('a')) == expected
+    assert set(dict(array_akagraph.connected_component('e'))) == {'d', 'e'}
+
+def test_merge_edges():
+    merged = dict(core.merge_edges([
+        ('b', 'a', .5), ('a', 'b', .5), ('c', 'c', 1),
+        ('a', 'c', .2, 'x'), ('c', 'a', .6, 'x'), ('a', 'c', .3, 'y'),
+    ]))
+    assert merged == {
+        ('a', 'b', None): .75,
+        ('a', 'c', 'x'): .6,
+        ('a', 'c', 'y'): .3,
+    }
+
+
+def test_add_edges(unique_index_name, elastic_address, tmpdir):
+    edges = [
+        (u'a', u'b', 1.0),
+        (u'c', u'b', 1.0),
+        (u'b', u'a', 1.0),
+        (u'd', u'e', .5, u'shared'),
+        (u'e', u'f', .5, u'shared'),
+        (u'f', u'g', .7, u'other'),
+        (u'h', u'h', 1.0),
+    ]
+    path = str(tmpdir.join('edges.tsv'))
+    with open(path, 'wb') as fh:
+        fh.write('# url_a\turl_b\tstrength\tevidence\n')
+        for edge in edges:
+            fh.write('\t'.join(map(unicode, edge)).encode('utf-8') + '\n')
+    assert list(core.load_edges(path)) == edges
+
+    one_at_a_time = core.AKAGraph(
+        elastic_address, unique_index_name + '_one',
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0))
+    in_bulk = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0))
+    try:
+        with one_at_a_time:
+            for edge in edges:
+                one_at_a_time.add_edge(edge[:2], *edge[2:])
+        one_at_a_time.sync()
+        # a tiny batch size sends each component in its own batch
+        assert in_bulk.add_edges(core.load_edges(path), batch_size=2) == 5
+        assert dict(in_bulk.connected_component('a')) == \
+            {'a': replica_count, 'b': replica_count, 'c': replica_count}
+        for url in 'defg':
+            assert dict(in_bulk.connected_component(url)) == \
+                dict(one_at_a_time.connected_component(url))
+        # both edges lead to the root of a, b and c in every replica
+        in_bulk.add_edges([(u'c', u'd', 1.0), (u'g', u'a', 1.0)])
+        counts = dict(in_bulk.connected_component('a'))
+        assert {url for url, count in counts.items()
+                if count == replica_count} == set('abcdg')
+    finally:
+        one_at_a_time.delete_index()
+        in_bulk.delete_index()
+
+
+def test_rank_members_stops_early(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0))
+    try:
+        edges = [(u'a', u'b', 1.0), (u'b', u'c', 1.0)]
+        edges.extend((u'a', u'spoke%d' % i, .3, u'spoke%d' % i)
+                     for i in range(30))
+        aka.add_edges(edges)
+        roots = set(aka.get_roots([core.AKANode('a', replica)
+                                   for replica in aka.replica_list]))
+        full, truncated = aka.rank_members(roots)
+        assert not truncated
+        assert full[:3] == [('a', replica_count), ('b', replica_count),
+                            ('c', replica_count)]
+        aka.metrics.clear()
+        assert aka.rank_members(roots, limit=3) == (full[:3], False)
+        scanned, = aka.metrics.histograms['replicas_scanned']
+        assert scanned < replica_count
+        assert aka.rank_members(roots, limit=5) == (full[:5], False)
+
+        ranked, truncated = aka.rank_members(roots, budget=10)
+        assert truncated
+        # the counts of the members that were seen are exact
+        assert set(ranked) <= set(full)
+        assert ranked[:3] == full[:3]
+    finally:
+        aka.delete_index()
+
+
+def test_rank_members_over_budget(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0))
+    try:
+        aka.add_edges([(u'a', u'spoke%d' % i, 1.0) for i in range(50)])
+        roots = set(aka.get_roots([core.AKANode('a', replica)
+                                   for replica in aka.replica_list]))
+        # every tree is bigger than the budget
+        ranked, truncated = aka.rank_members(roots, budget=20)
+        assert truncated
+        assert len(ranked) == 20
+        assert all(count == replica_count for _, count in ranked)
+        results = list(aka.find_connected_component(
+            u'a', budget=20, limit=5))
+        assert len(results) == 5
+        assert all(confidence == 1 for _, confidence in results)
+    finally:
+        aka.delete_index()
+
+
+def test_rank_members_concurrency(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0),
+        parent_cache_size=0)
+    try:
+        aka.add_edges([(u'a', u'spoke%d' % i, .5, u'spoke%d' % i)
+                       for i in range(30)])
+        roots = set(aka.get_roots([core.AKANode('a', replica)
+                                   for replica in aka.replica_list]))
+        nodes = [core.AKANode(u'spoke%d' % i, replica)
+                 for i in range(5) for replica in aka.replica_list]
+
+        def run():
+            return ([aka.rank_members(roots, **kwargs)
+                     for kwargs in [{}, {'limit': 3}, {'budget': 10}]],
+                    aka.get_roots(nodes))
+        aka.msearch_concurrency = 1
+        aka.mget_chunk_size = 1000
+        expected = run()
+        aka.msearch_concurrency = 4
+        aka.mget_chunk_size = 2
+        aka.metrics.clear()
+        assert run() == expected
+        # the root lookups were split into chunks of two ids
+        assert aka.metrics.timers['es.mget'][0] >= len(nodes) // 2
+        # leaving the with statement stops the thread pool
+        assert aka._search_pool is not None
+        with aka:
+            pass
+        assert aka._search_pool is None
+        assert run() == expected
+    finally:
+        aka.delete_index()
+
+
+def test_flush_looks_up_roots_once(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0),
+        buffer_size=100, mget_chunk_size=10000)
+    try:
+        with aka:
+            aka.add_edge(['a', 'b'], 1)
+        aka.metrics.clear()
+        with aka:
+            for i in range(20):
+                aka.add_edge(['b', 'spoke%d' % i], 1)
+                aka.add_edge(['x%d' % i, 'y%d' % i], .5, 'xy%d' % i)
+        assert aka.metrics.timers['get_roots'][0] == 1
+        assert dict(aka.connected_component('a'))['spoke7'] == replica_count
+    finally:
+        aka.delete_index()
+
+
+def test_remove(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name,
+        replicas=replica_count, hyper_edge_scorer=(lambda x: 0))
+    try:
+        with aka:
+            for rec in [
+                    {u'url': u'p', u'email': [u'p@mail.com']},
+                    {u'url': u'q', u'email': [u'p@mail.com'],
+                     u'phone': [u'555']},
+                    {u'url': u'r', u'phone': [u'555', u'spam']},
+                    {u'url': u's', u'phone': [u'spam']},
+                    {u'url': u't', u'email': [u't@mail.com']},
+                    {u'url': u'u', u'email': [u't@mail.com']}]:
+                aka.add(rec)
+
+        def component(url):
+            return {name for name, _ in aka.connected_component(url)}
+        assert component('p') == set('pqrs')
+        untouched = [core.AKANode('t', replica)
+                     for replica in aka.replica_list]
+        before = aka.get_union_find_docs(
+            [root.get_id() for root in aka.get_roots(untouched)])
+
+        assert aka.remove(u'q') == 3
+        assert component('p') == {'p'}
+        assert component('r') == set('rs')
+        assert list(aka.find_urls_by_selector(u'p@mail.com')) == ['p']
+        assert list(aka.iter_recs(['q'])) == [{'url': 'q'}]
+
+        assert aka.remove_selector(u'spam') == 2
+        assert component('r') == {'r'}
+        assert component('s') == {'s'}
+        assert list(aka.iter_recs(['r']))[0]['phone'] == ['555']
+
+        # other components are left alone
+        assert component('t') == set('tu')
+        assert aka.get_union_find_docs(list(before)) == before
+    finally:
+        aka.delete_index()
+
+
+def test_remove_from_deep_tree(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name, replicas=1,
+        hyper_edge_scorer=(lambda x: 0))
+    try:
+        with aka:
+            for rec in [{u'url': u'p', u'email': [u'p@mail.com']},
+                        {u'url': u'q', u'email': [u'p@mail.com']},
+                        {u'url': u'r', u'phone': [u'x']},
+                        {u'url': u's', u'phone': [u'x']}]:
+                aka.add(rec, analyze_and_union=False)
+        nodes = [core.AKANode(name, 0) for name in 'pqrs']
+        for node in nodes:
+            node.set_rank_from_record(None)
+        # build a chain s -> r -> q -> p
+        for child, parent in reversed(zip(nodes[1:], nodes)):
+            aka.set_parents(parent, child)
+        aka.sync()
+
+        def component(url):
+            return {name for name, _ in aka.connected_component(url)}
+        # no lookups yet, so nothing has compressed the chain
+        assert aka.remove_selector(u'x') == 4
+        assert component('p') == set('pq')
+        assert component('r') == {'r'}
+        assert component('s') == {'s'}
+        assert [rec['url'] for rec, _ in
+                aka.find_connected_component(u's')] == ['s']
+    finally:
+        aka.delete_index()
+
+
+def test_parent_cache(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address, unique_index_name, replicas=1,
+        hyper_edge_scorer=(lambda x: 0), path_compression=False)
+    try:
+        nodes = [core.AKANode(name, 0) for name in 'pqrstu']
+        aka.create_index()
+        # build a chain u -> t -> s -> r -> q -> p
+        for child, parent in reversed(zip(nodes[1:], nodes)):
+            aka.set_parents(parent, child)
+        aka.sync()
+        assert [root.name for root in aka.get_roots(nodes)] == ['p'] * 6
+        aka.metrics.clear()
+        hits = aka.parent_cache.hits
+        assert [root.name for root in aka.get_roots(nodes)] == ['p'] * 6
+        # only the root itself was fetched again
+        assert aka.metrics.timers['es.mget'][0] == 1
+        assert aka.stats()['caches']['parents']['hits'] > hits
+        assert aka.get_parent(nodes[-1]).name == 't'
+
+        # writes are seen through the cache
+        aka.set_parents(core.AKANode('v', 0), nodes[0])
+        aka.sync()
+        assert [root.name for root in aka.get_roots(nodes)] == ['v'] * 6
+    finally:
+        aka.delete_index()
+
+
+def test_compress(populated_akagraph):
+    aka = populated_akagraph
+    replica = aka.replica_list[0]
+    nodes = [core.AKANode(name, replica) for name in 'pqrstu']
+    # build a chain u -> t -> s -> r -> q -> p
+    for child, parent in reversed(zip(nodes[1:], nodes)):
+        aka.set_parents(parent, child)
+        aka.sync()
+    aka.sync()
+    assert aka.compress() == 4
+    for node in nodes[1:]:
+        assert aka.get_parent(node) == nodes[0]
+    assert aka.compress() == 0
+
+def test_path_compression(populated_akagraph):
+    aka = populated_akagraph
+    replica = aka.replica_list[0]
+    nodes = [core.AKANode(name, replica) for name in 'pqrs']
+    for child, parent in reversed(zip(nodes[1:], nodes)):
+        aka.set_parents(parent, child)
+        aka.sync()
+    aka.sync()
+    # queries never write
+    assert dict(aka.connected_component('s'))['p'] == 1
+    assert aka.probability('s', 'p') > 0
+    list(aka.find_connected_component(u's'))
+    assert aka.compression_buffer == {}
+    assert aka.get_root(nodes[-1]) == nodes[0]
+    assert aka.compression_buffer
+    # a full buffer is sent in the background
+    aka.flush_compressions(wait=False)
+    assert aka.compression_buffer == {}
+    assert aka.get_parent(nodes[-1]) == nodes[0]
+    aka.flush_compressions()
+    assert aka.compressions_written == 2
+    aka.sync()
+    for node in nodes[1:]:
+        assert aka.get_parent(node) == nodes[0]
+
+def test_membership_index(populated_akagraph):
+    aka = populated_akagraph
+    replica = aka.replica_list[0]
+    nodes = [core.AKANode(name, replica) for name in 'pqrstu']
+    with aka:
+        aka.add_edge(['p', 'q'], 1)
+        aka.add_edge(['r', 's'], 1)
+        aka.add_edge(['t', 'u'], 1)
+        aka.add_edge(['q', 's'], 1)
+        aka.add_edge(['s', 'u'], 1)
+    root = aka.get_root(nodes[0])
+    assert set(node.name for node in aka.get_members(root)) == set('pqrstu')
+    assert dict(aka.connected_component('u')) == \
+        {name: len(aka.replica_list) for name in 'pqrstu'}
+
+def test_overlay_read_your_writes(unique_index_name, elastic_address):
+    aka = core.AKAGraph(
+        elastic_address,
+        unique_index_name,
+        hyper_edge_scorer=(lambda x: 0),
+        refresh_interval=None,
+    )
+    try:
+        with aka:
+            aka.add({u'url': u'x1', u'email': [u'x@mail.com']})
+            aka.flush()
+            aka.add({u'url': u'x2', u'email': [u'x@mail.com']})
+            aka.add({u'url': u'x3', u'phone': [u'+1555']})
+            aka.flush()
+            aka.add({u'url': u'x4', u'phone': [u'+1555'],
+                     u'email': [u'x@mail.com']})
+            aka.flush()
+            # nothing has been refreshed yet
+            assert aka.overlay
+            assert set(dict(aka.connected_component('x1'))) == \
+                {'x1', 'x2', 'x3', 'x4'}
+        assert not aka.overlay
+        assert set(dict(aka.connected_component('x3'))) == \
+            {'x1', 'x2', 'x3', 'x4'}
+    finally:
+        aka.delete_index()
@@ -0,0 +1,333 @@
+'''In-process union-find backend for :class:`~memex_dossier.akagraph.core.AKAGraph`
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2016 Diffeo, Inc.
+
+:class:`ArrayUnionFind` keeps the forests of all `k` replicas in
+compact integer arrays, with every URL interned to a dense id that is
+shared across replicas.  It is used by `AKAGraph` in place of the
+`union_find` doc type when the entire forest fits in memory, e.g. for
+an offline ``--ingest`` that pushes the final forest to elasticsearch
+in one bulk load.
+
+'''
+from __future__ import absolute_import, division, print_function
+from array import array
+import gzip
+import logging
+import sys
+
+import cbor
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+#: typecodes of the per-replica arrays
+PARENT_TYPE = 'l'
+RANK_TYPE = 'B'
+CARDINALITY_TYPE = 'l'
+GENERATION_TYPE = 'l'
+
+
+class ArrayUnionFind(object):
+    '''`replicas` independent disjoint-set forests over one shared table
+    of interned names.  `replicas` is either the number of replicas,
+    or a list of the replica ids to hold, e.g. for a worker that only
+    handles some of the replicas.
+
+    For each replica, `parents[slot][i]` is the id of the parent of
+    node `i`, or `i` itself if `i` is a root, where `slot` is the
+    position of the replica in `replica_list`.  Only the entries for
+    roots are meaningful in `ranks`, `cardinalities` and
+    `generations`, the last of which counts the unions made at a root
+    as the `generation` of its `union_find` doc does.  Each
+    component is also threaded onto a circular linked list through
+    `links`, so that its members can be enumerated in time
+    proportional to its size rather than to the size of the forest.
+
+    '''
+    def __init__(self, replicas):
+        if isinstance(replicas, (int, long)):
+            replicas = range(replicas)
+        self.replica_list = list(replicas)
+        self.slots = {replica: slot
+                      for slot, replica in enumerate(self.replica_list)}
+        self.replicas = len(self.replica_list)
+        self.ids = {}
+        self.names = []
+        self.parents = [array(PARENT_TYPE) for _ in self.replica_list]
+        self.ranks = [array(RANK_TYPE) for _ in self.replica_list]
+        self.cardinalities = [array(CARDINALITY_TYPE)
+                              for _ in self.replica_list]
+        self.generations = [array(GENERATION_TYPE)
+                            for _ in self.replica_list]
+        self.links = [array(PARENT_TYPE) for _ in self.replica_list]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def intern(self, name):
+        '''get the dense id for `name`, adding it as a singleton root in
+        every replica if it has not been seen before
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+            for slot in range(self.replicas):
+                self.parents[slot].append(i)
+                self.ranks[slot].append(1)
+                self.cardinalities[slot].append(1)
+                self.generations[slot].append(0)
+                self.links[slot].append(i)
+        return i
+
+    def find(self, replica, i):
+        '''get the id of the root of `i`, halving the path on the way
+        '''
+        parents = self.parents[self.slots[replica]]
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def get_root(self, replica, name):
+        '''get `(root_name, rank, cardinality)` for `name` in `replica`
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            return name, 1, 1
+        root = self.find(replica, i)
+        slot = self.slots[replica]
+        return (self.names[root], self.ranks[slot][root],
+                self.cardinalities[slot][root])
+
+    def get_parent(self, replica, name):
+        '''get the name of the parent of `name` in `replica`, or None if
+        `name` is a root
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            return None
+        parent = self.parents[self.slots[replica]][i]
+        if parent == i:
+            return None
+        return self.names[parent]
+
+    def get_rank(self, replica, name):
+        '''get `(rank, cardinality)` of `name`, which must be a root
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            return 1, 1
+        slot = self.slots[replica]
+        return self.ranks[slot][i], self.cardinalities[slot][i]
+
+    def get_generation(self, replica, name):
+        '''get the generation of `name`, which must be a root
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            return 0
+        return self.generations[self.slots[replica]][i]
+
+    def set_parents(self, replica, new_root, rank, cardinality, others):
+        '''make `new_root` the parent of each of the roots named in
+        `others`, and record its new `rank` and `cardinality`
+        '''
+        slot = self.slots[replica]
+        parents = self.parents[slot]
+        links = self.links[slot]
+        root = self.intern(new_root)
+        for name in others:
+            child = self.intern(name)
+            if self.find(replica, child) != self.find(replica, root):
+                # splice the two circular member lists together
+                links[root], links[child] = links[child], links[root]
+            parents[child] = root
+        self.ranks[slot][root] = rank
+        self.cardinalities[slot][root] = cardinality
+        self.generations[slot][root] += 1
+
+    def union(self, replica, *names):
+        '''unite the components of all of `names` by rank, and return the
+        name of the resulting root
+        '''
+        roots = {self.find(replica, self.intern(name)) for name in names}
+        slot = self.slots[replica]
+        ranks = self.ranks[slot]
+        roots = sorted(roots, key=lambda i: ranks[i])
+        new_root = roots.pop()
+        if not roots:
+            return self.names[new_root]
+        rank = ranks[new_root]
+        if rank == ranks[roots[-1]]:
+            rank += 1
+        cardinality = sum(self.cardinalities[slot][i]
+                          for i in roots + [new_root])
+        self.set_parents(replica, self.names[new_root], rank, cardinality,
+                         [self.names[i] for i in roots])
+        return self.names[new_root]
+
+    def _member_ids(self, replica, i):
+        links = self.links[self.slots[replica]]
+        yield i
+        j = links[i]
+        while j != i:
+            yield j
+            j = links[j]
+
+    def members(self, replica, name):
+        '''yield the names of all nodes in the same component as `name`
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            yield name
+            return
+        for j in self._member_ids(replica, i):
+            yield self.names[j]
+
+    def get_children(self, replica, name):
+        '''yield the names of the nodes whose parent is `name`
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            return
+        parents = self.parents[self.slots[replica]]
+        for j in self._member_ids(replica, i):
+            if j != i and parents[j] == i:
+                yield self.names[j]
+
+    def iter_roots(self, replica):
+        '''yield `(root_name, cardinality)` for every root in `replica`
+        '''
+        slot = self.slots[replica]
+        parents = self.parents[slot]
+        cardinalities = self.cardinalities[slot]
+        for i in range(len(self.names)):
+            if parents[i] == i:
+                yield self.names[i], cardinalities[i]
+
+    def iter_nodes(self):
+        '''yield `(replica, name, parent_name, rank, cardinality)` for
+        every node that is not a singleton; `parent_name` is None for
+        roots, and `rank` and `cardinality` are None for non-roots.
+        '''
+        for slot, replica in enumerate(self.replica_list):
+            parents = self.parents[slot]
+            ranks = self.ranks[slot]
+            cardinalities = self.cardinalities[slot]
+            for i, name in enumerate(self.names):
+                parent = parents[i]
+                if parent != i:
+                    yield replica, name, self.names[parent], None, None
+                elif cardinalities[i] > 1:
+                    yield replica, name, None, ranks[i], cardinalities[i]
+
+    def load_unions(self, unions):
+        '''add the parent pointers and root ranks, cardinalities and
+        generations from an iterable of
+        `union_find` documents as produced by
+        :meth:`~memex_dossier.akagraph.core.AKAGraph.get_all_unions`;
+        documents for replicas not held here are skipped.
+        '''
+        for doc in unions:
+            slot = self.slots.get(int(doc['replica']))
+            if slot is None:
+                continue
+            child = self.intern(doc['child'][0])
+            if 'parent' in doc:
+                self.parents[slot][child] = self.intern(doc['parent'][0])
+            else:
+                self.ranks[slot][child] = doc['rank']
+                self.cardinalities[slot][child] = doc['cardinality']
+                self.generations[slot][child] = doc.get('generation', 0)
+        self._relink()
+
+    def _relink(self):
+        '''rebuild the circular member lists from the parent arrays
+        '''
+        for slot, replica in enumerate(self.replica_list):
+            links = self.links[slot]
+            parents = self.parents[slot]
+            last = {}
+            for i in range(len(self.names)):
+                root = self.find(replica, i)
+                if root != i:
+                    links[last.get(root, root)] = i
+                    last[root] = i
+            # close each list by pointing its last member at the root
+            for i in range(len(self.names)):
+                if parents[i] == i:
+                    links[last.get(i, i)] = i
+
+    def to_dict(self):
+        '''get this forest as a dict of the interned names and the raw
+        bytes of the arrays, for CBOR
+        '''
+        return {
+            'version': FORMAT_VERSION,
+            'byteorder': sys.byteorder,
+            'replicas': self.replica_list,
+            'names': self.names,
+            'parents': [a.tostring() for a in self.parents],
+            'ranks': [a.tostring() for a in self.ranks],
+            'cardinalities': [a.tostring() for a in self.cardinalities],
+            'generations': [a.tostring() for a in self.generations],
+        }
+
+    def save(self, path):
+        '''write this forest to a gzipped CBOR file at `path`
+        '''
+        with gzip.open(path, 'wb') as fh:
+            cbor.dump(self.to_dict(), fh)
+        logger.info('saved %d nodes in %d replicas to %s',
+                    len(self.names), self.replicas, path)
+
+    @classmethod
+    def load(cls, path):
+        '''read a forest written by :meth:`save`
+        '''
+        with gzip.open(path, 'rb') as fh:
+            data = cbor.load(fh)
+        uf = cls.from_dict(data, path)
+        logger.info('loaded %d nodes in %d replicas from %s',
+                    len(uf.names), uf.replicas, path)
+        return uf
+
+    @classmethod
+    def from_dict(cls, data, path=None):
+        '''make a forest from the output of :meth:`to_dict`; one written
+        before generations were kept has them all 0
+        '''
+        if data['version'] != FORMAT_VERSION:
+            raise ValueError('unsupported union-find format %r in %s'
+                             % (data['version'], path))
+        uf = cls(data['replicas'])
+        uf.names = data['names']
+        uf.ids = {name: i for i, name in enumerate(uf.names)}
+        if 'generations' not in data:
+            data = dict(data, generations=[
+                array(GENERATION_TYPE, [0] * len(uf.names)).tostring()
+                for _ in range(uf.replicas)])
+        for field, typecode in [('parents', PARENT_TYPE),
+                                ('ranks', RANK_TYPE),
+                                ('cardinalities', CARDINALITY_TYPE),
+                                ('generations', GENERATION_TYPE)]:
+            arrays = []
+            for raw in data[field]:
+                a = array(typecode)
+                a.fromstring(raw)
+                if data['byteorder'] != sys.byteorder:
+                    a.byteswap()
+                arrays.append(a)
+            setattr(uf, field, arrays)
+        uf.links = [array(PARENT_TYPE, range(len(uf.names)))
+                    for _ in range(uf.replicas)]
+        uf._relink()
+        return uf
@@ -2,9 +2,13 @@ from __future__ import absolute_import, division, print_function
 import logging
 
 from gensim import models
+import kvlayer
 
 from memex_dossier.models.openquery.google import Google
 from memex_dossier.akagraph import AKAGraph
+from memex_dossier.akagraph.cache import ComponentCache, ScoreCache
+from memex_dossier.akagraph.lsh import UsernameLSH
+from memex_dossier.akagraph.selector_index import SelectorIndex
 import memex_dossier.web as web
 from memex_dossier.handles.char_ngram_model import load_ngrams
 
@@ -33,12 +37,46 @@ class Config(web.Config):
 
         akagraph_config = self.config.get('akagraph')
         if akagraph_config:
+            selector_index = None
+            if 'selector_index' in akagraph_config:
+                # a kvlayer config for the selector index
+                kvl = kvlayer.client(
+                    config=akagraph_config['selector_index'])
+                selector_index = SelectorIndex(kvl)
+            username_lsh = None
+            if 'username_lsh' in akagraph_config:
+                # a kvlayer config for the fuzzy username index
+                kvl = kvlayer.client(
+                    config=akagraph_config['username_lsh'])
+                username_lsh = UsernameLSH(kvl)
+            component_cache = None
+            if 'component_cache' in akagraph_config:
+                cache_config = akagraph_config['component_cache']
+                kvl = None
+                if 'kvlayer' in cache_config:
+                    kvl = kvlayer.client(config=cache_config['kvlayer'])
+                component_cache = ComponentCache(
+                    size=cache_config.get('size', 1000), kvl=kvl)
+            score_cache = None
+            if 'score_cache' in akagraph_config:
+                cache_config = akagraph_config['score_cache']
+                kvl = None
+                if 'kvlayer' in cache_config:
+                    kvl = kvlayer.client(config=cache_config['kvlayer'])
+                score_cache = ScoreCache(
+                    version=cache_config.get('version', 'prob_username/1'),
+                    size=cache_config.get('size', 100000), kvl=kvl)
             self._akagraph = AKAGraph(
                 akagraph_config['hosts'], akagraph_config['index_name'],
                 akagraph_config['k_replicas'],
                 # could make hyper_edge_scorer configurable here
                 soft_selectors=akagraph_config.get('soft_selectors'),
                 hard_selectors=akagraph_config.get('hard_selectors'),
+                selector_index=selector_index,
+                component_cache=component_cache,
+                score_cache=score_cache,
+                popular_threshold=akagraph_config.get('popular_threshold'),
+                username_lsh=username_lsh,
             )
         else:
             self._akagraph = None
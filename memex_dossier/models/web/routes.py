@@ -200,7 +200,53 @@ def v1_akagraph_get(request, response, akagraph):
             json.dumps(rec, indent=4, sort_keys=True) + \
             '</pre>'
 
+get_akagraph_probability_usage = '?url_a=<string>&url_b=<string>'
 
+@app.get('/dossier/v1/akagraph_probability', json=True)
+def v1_akagraph_get_probability(request, response, akagraph):
+    url_a = request.query.getunicode('url_a')
+    url_b = request.query.getunicode('url_b')
+    if not url_a or not url_b:
+        response.status = 400
+        return {"usage": get_akagraph_probability_usage}
+    return {'url_a': url_a, 'url_b': url_b,
+            'probability': akagraph.probability(url_a, url_b)}
+
+post_akagraph_probability_usage = '[{"url_a": <string>, "url_b": <string>}, ...]'
+
+@app.post('/dossier/v1/akagraph_probability', json=True)
+def v1_akagraph_post_probability(request, response, akagraph):
+    try:
+        request.json
+    except ValueError:
+        response.status = 400
+        return {"error": "request body must be valid json"}
+
+    if isinstance(request.json, list):
+        pairs = request.json
+    elif isinstance(request.json, dict):
+        pairs = [request.json]
+    else:
+        response.status = 400
+        return {"usage": post_akagraph_probability_usage}
+
+    valid = [pair for pair in pairs
+             if isinstance(pair, dict) and pair.get('url_a')
+             and pair.get('url_b')]
+    if len(valid) < len(pairs):
+        response.status = 400
+        return {"error": ('only %s of %s pairs had both a "url_a" and a '
+                          '"url_b" field' % (len(valid), len(pairs))),
+                "usage": post_akagraph_probability_usage}
+    probabilities = akagraph.probabilities(
+        [(pair['url_a'], pair['url_b']) for pair in pairs])
+    return [{'url_a': pair['url_a'], 'url_b': pair['url_b'],
+             'probability': probability}
+            for pair, probability in zip(pairs, probabilities)]
+
+
+get_suggest_usage = ('?limit=<int>&budget=<int>&timeout=<float>'
+                     '&min_score=<float>, all optional and not negative')
 
 @app.get('/dossier/v1/suggest/<query:path>', json=True)
 def v1_suggest_get(request, response, tfidf, akagraph, query):
@@ -211,6 +257,23 @@ def v1_suggest_get(request, response, tfidf, akagraph, query):
     if not isinstance(query, unicode):
         query = query.decode('utf8')
 
+    params = {}
+    for name, parse in [('limit', int), ('budget', int),
+                        ('timeout', float), ('min_score', float)]:
+        value = request.query.get(name)
+        if not value:
+            params[name] = None
+            continue
+        try:
+            params[name] = parse(value)
+        except ValueError:
+            params[name] = -1
+        if not params[name] >= 0:
+            response.status = 400
+            return {"error": '%s must be a number that is not negative, '
+                             'not %r' % (name, value),
+                    "usage": get_suggest_usage}
+
     config = yakonfig.get_global_config('memex_dossier.models')
     suggest_services = config.get('suggest_services', [])
     session = requests.Session()
@@ -225,7 +288,11 @@ def v1_suggest_get(request, response, tfidf, akagraph, query):
         #    break
         cluster = []
         logger.info('doing query %r', query)
-        cc = akagraph.find_connected_component(query, use_soft=False)
+        cc = akagraph.find_connected_component(
+            query, use_soft=False,
+            min_score=params['min_score'] or 0,
+            limit=params['limit'], budget=params['budget'],
+            timeout=params['timeout'])
         for rec, confidence in cc:
             rec['confidence'] = confidence
             cluster.append(rec)
@@ -105,6 +105,7 @@ setup(
             'memex_dossier.models.linker = memex_dossier.models.linker.run:main',
             'memex_dossier.etl = memex_dossier.models.etl:main',
             'memex_dossier.akagraph = memex_dossier.akagraph.core:main',
+            'memex_dossier.akagraph.benchmark = memex_dossier.akagraph.benchmark:main',
             'memex_dossier.structured = memex_dossier.streamcorpus_structured.run:main',
             'memex_dossier.snsfetcher = memex_dossier.snsfetcher.run:main',
             'memex_dossier.handles.ngrams = memex_dossier.handles.ngrams:main',